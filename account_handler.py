@@ -0,0 +1,106 @@
+import sqlite3
+from datetime import datetime
+
+
+class AccountHandler:
+    """Bank accounts, grouped by tenant.
+
+    Every transaction carries the ``account_id`` of the account its
+    statement was uploaded to and the ``tenant_id`` that owns the account
+    (denormalized, for tenant-wide jobs such as reconciliation). The
+    transaction indexes lead with ``account_id``, so a query for one account
+    reads only that account's index range no matter how many accounts share
+    the table.
+
+    Account names are unique per tenant. Rows imported before accounts
+    existed are assigned to a default account by ``adopt_orphans``.
+    """
+
+    DEFAULT_NAME = 'Conta principal'
+
+    def __init__(self, get_connection):
+        self.get_connection = get_connection
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS accounts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tenant_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                bank TEXT,
+                created_at TIMESTAMP NOT NULL,
+                UNIQUE (tenant_id, name)
+            )
+        ''')
+
+    @classmethod
+    def adopt_orphans(cls, cursor, tenant_id):
+        """Moves rows without an account into the tenant's default account; returns its id or None"""
+        if not cursor.execute('SELECT 1 FROM transactions WHERE account_id IS NULL LIMIT 1').fetchone():
+            return None
+        account_id = cls._ensure_default(cursor, tenant_id)
+        cursor.execute('UPDATE transactions SET account_id = ?, tenant_id = ? WHERE account_id IS NULL',
+                       (account_id, tenant_id))
+        return account_id
+
+    @classmethod
+    def _ensure_default(cls, cursor, tenant_id):
+        row = cursor.execute('SELECT id FROM accounts WHERE tenant_id = ? ORDER BY id LIMIT 1', (tenant_id,)).fetchone()
+        if row:
+            return row[0]
+        return cursor.execute(
+            'INSERT INTO accounts (tenant_id, name, created_at) VALUES (?, ?, ?)',
+            (tenant_id, cls.DEFAULT_NAME, datetime.now())
+        ).lastrowid
+
+    def list(self, tenant_id):
+        conn = self.get_connection()
+        try:
+            return [dict(row) for row in conn.execute(
+                'SELECT id, tenant_id, name, bank FROM accounts WHERE tenant_id = ? ORDER BY name', (tenant_id,)
+            )]
+        finally:
+            conn.close()
+
+    def get(self, tenant_id, account_id):
+        """The account if it belongs to the tenant, else None"""
+        if account_id is None:
+            return None
+        conn = self.get_connection()
+        try:
+            row = conn.execute('SELECT id, tenant_id, name, bank FROM accounts WHERE id = ? AND tenant_id = ?',
+                               (account_id, tenant_id)).fetchone()
+            return dict(row) if row else None
+        finally:
+            conn.close()
+
+    def default(self, tenant_id):
+        """The tenant's first account, created on first use"""
+        conn = self.get_connection()
+        try:
+            account_id = self._ensure_default(conn.cursor(), tenant_id)
+            conn.commit()
+        finally:
+            conn.close()
+        return self.get(tenant_id, account_id)
+
+    def create(self, tenant_id, name, bank=None):
+        """Creates an account and returns it; an existing name returns the existing account"""
+        name = ' '.join(name.split())
+        if not name:
+            raise ValueError('Nome da conta obrigatório')
+        conn = self.get_connection()
+        try:
+            try:
+                account_id = conn.execute(
+                    'INSERT INTO accounts (tenant_id, name, bank, created_at) VALUES (?, ?, ?, ?)',
+                    (tenant_id, name, bank or None, datetime.now())
+                ).lastrowid
+                conn.commit()
+            except sqlite3.IntegrityError:
+                account_id = conn.execute('SELECT id FROM accounts WHERE tenant_id = ? AND name = ?',
+                                          (tenant_id, name)).fetchone()[0]
+        finally:
+            conn.close()
+        return self.get(tenant_id, account_id)
@@ -0,0 +1,335 @@
+from datetime import datetime
+
+
+class AnomalyHandler:
+    """Flags suspicious transactions while a statement is imported.
+
+    Rolling statistics of log(1 + |value|) are kept in ``anomaly_stats`` per
+    account and key: one key per counterparty document and direction
+    (``document:<doc>|CREDITO``) and one per fee type (``type:JUROS``).
+    Amounts are roughly log-normal, so distances are measured in log space:
+    a z-score above ``threshold`` means an amount several times larger or
+    smaller than usual, not a few standard deviations of a skewed
+    distribution.
+
+    Each imported batch is scored against the statistics as they were before
+    it and then merged into them with the parallel form of Welford's update
+    (count, mean and M2 of the batch combined with the stored ones). Only
+    the keys present in the batch are read and written, so an import costs
+    the same however long the history is.
+
+    Flags are written to ``anomaly_flags``, one per transaction and kind:
+
+    - ``duplicate``: a TARIFA/IOF row with the same date, type and value as
+      an earlier row of the account (in the batch or already stored);
+    - ``fee``: a JUROS/MULTA/TARIFA/IOF amount far from that type's usual;
+    - ``outlier``: an amount far from the counterparty's usual range.
+
+    ``rebuild`` reads through ``history_connection`` when given
+    (partition_handler.connect), so archived years count in the statistics.
+    """
+
+    DUPLICATE_TYPES = ('TARIFA', 'IOF')
+    FEE_TYPES = ('JUROS', 'MULTA', 'TARIFA', 'IOF')
+    STATUSES = ('open', 'confirmed', 'dismissed')
+    # Desvio mínimo em escala log (~10% do valor): séries de valor constante não dão z infinito
+    MIN_STD = 0.1
+    # Limite de parâmetros por consulta IN do SQLite
+    CHUNK = 500
+
+    def __init__(self, get_connection, threshold=4.0, min_samples=5, history_connection=None):
+        self.get_connection = get_connection
+        self.history_connection = history_connection or get_connection
+        self.threshold = threshold
+        self.min_samples = min_samples
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS anomaly_stats (
+                account_id INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                m2 REAL NOT NULL,
+                PRIMARY KEY (account_id, key)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS anomaly_flags (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                account_id INTEGER NOT NULL,
+                transaction_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                score REAL NOT NULL,
+                expected REAL,
+                status TEXT NOT NULL DEFAULT 'open',
+                created_at TIMESTAMP NOT NULL,
+                reviewed_at TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_anomaly_flags_transaction ON anomaly_flags(transaction_id, kind)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_anomaly_flags_account_status ON anomaly_flags(account_id, status, id)')
+
+    def _samples(self, values, transaction_types, documents):
+        """One row per (transaction, statistics key) with the log amount ``x``"""
+        import numpy as np
+        import pandas as pd
+
+        values = np.asarray(values, dtype=float)
+        frame = pd.DataFrame({
+            'row': np.arange(len(values)),
+            'x': np.log1p(np.abs(values)),
+            'sign': np.where(values < 0, -1.0, 1.0),
+            'transaction_type': pd.Series(transaction_types, dtype=object).fillna(''),
+            'document': pd.Series(documents, dtype=object).fillna('')
+        })
+        by_document = frame[frame['document'] != '']
+        by_document = by_document.assign(
+            key='document:' + by_document['document'] + np.where(by_document['sign'] > 0, '|CREDITO', '|DEBITO'),
+            kind='outlier'
+        )
+        by_type = frame[frame['transaction_type'].isin(self.FEE_TYPES)]
+        by_type = by_type.assign(key='type:' + by_type['transaction_type'], kind='fee')
+        return pd.concat([by_document, by_type], ignore_index=True)[['row', 'key', 'kind', 'x', 'sign']]
+
+    @staticmethod
+    def _batch_stats(samples):
+        grouped = samples.groupby('key', sort=False)['x']
+        stats = grouped.agg(count='size', mean='mean')
+        stats['m2'] = grouped.var(ddof=0) * stats['count']
+        return stats
+
+    @staticmethod
+    def _combine(prior, batch):
+        """Merges two (count, mean, m2) frames indexed by key (Chan et al. parallel Welford)"""
+        prior = prior.reindex(batch.index).fillna(0)
+        count = prior['count'] + batch['count']
+        delta = batch['mean'] - prior['mean']
+        return batch.assign(
+            count=count,
+            mean=prior['mean'] + delta * batch['count'] / count,
+            m2=prior['m2'] + batch['m2'] + delta ** 2 * prior['count'] * batch['count'] / count
+        )
+
+    def _load_stats(self, conn, account_id, keys):
+        import pandas as pd
+
+        rows = []
+        for start in range(0, len(keys), self.CHUNK):
+            chunk = keys[start:start + self.CHUNK]
+            rows += conn.execute(f'''
+                SELECT key, count, mean, m2 FROM anomaly_stats
+                WHERE account_id = ? AND key IN ({', '.join('?' for _ in chunk)})
+            ''', [account_id] + chunk).fetchall()
+        return pd.DataFrame([tuple(row) for row in rows], columns=['key', 'count', 'mean', 'm2']).set_index('key')
+
+    def _save_stats(self, conn, account_id, stats):
+        conn.executemany('''
+            INSERT INTO anomaly_stats (account_id, key, count, mean, m2) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(account_id, key) DO UPDATE SET
+                count = excluded.count, mean = excluded.mean, m2 = excluded.m2
+        ''', zip([account_id] * len(stats), stats.index.tolist(), stats['count'].astype(int).tolist(),
+                 stats['mean'].tolist(), stats['m2'].tolist()))
+
+    def _duplicates(self, conn, account_id, ids, dates, transaction_types):
+        """(transaction_id, copies, value) of the batch's fee rows that repeat an earlier row"""
+        import pandas as pd
+
+        days = sorted({d for d, t in zip(dates, transaction_types) if t in self.DUPLICATE_TYPES})
+        if not days:
+            return pd.DataFrame(columns=['id', 'copies', 'value'])
+        rows = []
+        types = ', '.join('?' for _ in self.DUPLICATE_TYPES)
+        # Só os dias de tarifa do lote: índice (account_id, transaction_type, date, value)
+        for start in range(0, len(days), self.CHUNK):
+            chunk = days[start:start + self.CHUNK]
+            rows += conn.execute(f'''
+                SELECT id, date, transaction_type, value FROM main.transactions
+                WHERE account_id = ? AND transaction_type IN ({types})
+                AND date IN ({', '.join('?' for _ in chunk)})
+            ''', [account_id, *self.DUPLICATE_TYPES, *chunk]).fetchall()
+        fees = pd.DataFrame([tuple(row) for row in rows], columns=['id', 'date', 'transaction_type', 'value'])
+        fees['cents'] = (fees['value'] * 100).round().astype('int64')
+        fees = fees.sort_values('id')
+        group = fees.groupby(['date', 'transaction_type', 'cents'], sort=False)
+        fees['copies'] = group['id'].transform('size')
+        repeated = fees[group.cumcount().to_numpy() > 0]
+        return repeated[repeated['id'].isin(ids)][['id', 'copies', 'value']]
+
+    def apply(self, conn, account_id, ids, dates, values, transaction_types, documents):
+        """Scores a just-inserted batch (``ids`` of its rows, in order) and updates the statistics.
+
+        Runs inside the caller's transaction, after the insert; returns the
+        number of flags written.
+        """
+        import numpy as np
+
+        ids = np.asarray(ids, dtype='int64')
+        created_at = datetime.now().isoformat(' ')
+        flags = []
+
+        samples = self._samples(values, transaction_types, documents)
+        if not samples.empty:
+            prior = self._load_stats(conn, account_id, samples['key'].unique().tolist())
+            scored = samples.join(prior, on='key', how='inner')
+            scored = scored[scored['count'] >= self.min_samples]
+            std = np.maximum(np.sqrt(scored['m2'] / (scored['count'] - 1)), self.MIN_STD)
+            scored = scored.assign(score=(scored['x'] - scored['mean']) / std)
+            scored = scored[scored['score'].abs() > self.threshold]
+            flags += zip(
+                ids[scored['row'].to_numpy()].tolist(), scored['kind'].tolist(), scored['score'].round(2).tolist(),
+                (scored['sign'] * np.expm1(scored['mean'])).round(2).tolist()
+            )
+            self._save_stats(conn, account_id, self._combine(prior, self._batch_stats(samples)))
+
+        duplicates = self._duplicates(conn, account_id, ids, dates, transaction_types)
+        flags += zip(duplicates['id'].tolist(), ['duplicate'] * len(duplicates),
+                     duplicates['copies'].astype(float).tolist(), duplicates['value'].tolist())
+
+        conn.executemany('''
+            INSERT OR IGNORE INTO anomaly_flags (account_id, transaction_id, kind, score, expected, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(account_id, int(transaction_id), kind, score, expected, created_at)
+              for transaction_id, kind, score, expected in flags])
+        return len(flags)
+
+    def needs_rebuild(self):
+        """True until a full ``rebuild`` has run once (first run after the upgrade)"""
+        conn = self.get_connection()
+        try:
+            return not conn.execute("SELECT 1 FROM app_metadata WHERE key = 'anomaly_stats_built'").fetchone()
+        finally:
+            conn.close()
+
+    def _accumulate(self, cursor):
+        """Statistics of the (value, transaction_type, document) rows of an executed cursor, read in chunks"""
+        import pandas as pd
+
+        stats = pd.DataFrame(columns=['count', 'mean', 'm2'], dtype=float)
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                break
+            values, transaction_types, documents = zip(*rows)
+            batch = self._batch_stats(self._samples(values, transaction_types, documents))
+            stats = pd.concat([stats[~stats.index.isin(batch.index)], self._combine(stats, batch)])
+        return stats
+
+    def refresh_types(self, account_id, transaction_types):
+        """Recomputes the per-type statistics (``type:JUROS``...) of an account after rows changed type.
+
+        Only the fee types among ``transaction_types`` have statistics; each
+        is read from the (account_id, transaction_type) index range, archived
+        years included. Returns the number of keys recomputed.
+        """
+        types = sorted(set(transaction_types) & set(self.FEE_TYPES))
+        if not types:
+            return 0
+        conn = self.history_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            conn.execute(f'''
+                DELETE FROM anomaly_stats WHERE account_id = ? AND key IN ({', '.join('?' for _ in types)})
+            ''', [account_id] + [f'type:{t}' for t in types])
+            # Sem documento: só as chaves por tipo são recalculadas
+            cursor.execute(f'''
+                SELECT value, transaction_type, NULL FROM transactions
+                WHERE account_id = ? AND transaction_type IN ({', '.join('?' for _ in types)})
+            ''', [account_id] + types)
+            self._save_stats(conn, account_id, self._accumulate(cursor))
+            conn.commit()
+        finally:
+            conn.close()
+        return len(types)
+
+    def rebuild(self, account_id=None):
+        """Recomputes the statistics of one account (or of all) from the transactions, archived years included"""
+        conn = self.history_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            everything = account_id is None
+            if everything:
+                accounts = [row[0] for row in cursor.execute('SELECT id FROM accounts ORDER BY id').fetchall()]
+            else:
+                accounts = [account_id]
+            for account_id in accounts:
+                conn.execute('DELETE FROM anomaly_stats WHERE account_id = ?', (account_id,))
+                cursor.execute('''
+                    SELECT value, transaction_type, document FROM transactions WHERE account_id = ?
+                ''', (account_id,))
+                self._save_stats(conn, account_id, self._accumulate(cursor))
+            if everything:
+                # Marca a reconstrução inicial: um banco sem histórico não é reconstruído a cada execução
+                conn.execute('''
+                    INSERT INTO app_metadata (key, value) VALUES ('anomaly_stats_built', ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value
+                ''', (datetime.now().isoformat(' '),))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def review(self, account_id, status='open', kind=None, limit=200):
+        """Flags of an account with their transactions, newest first, plus open counts per kind"""
+        conn = self.get_connection()
+        try:
+            params = [account_id, status]
+            kind_filter = ''
+            if kind:
+                kind_filter = 'AND f.kind = ?'
+                params.append(kind)
+            flags = [dict(flag) for flag in conn.execute(f'''
+                SELECT f.id, f.kind, f.score, f.expected, f.status, f.created_at,
+                       f.transaction_id, t.date, t.description, t.value, t.transaction_type, t.document
+                FROM anomaly_flags f
+                LEFT JOIN main.transactions t ON t.id = f.transaction_id
+                WHERE f.account_id = ? AND f.status = ? {kind_filter}
+                ORDER BY f.id DESC
+                LIMIT ?
+            ''', params + [limit]).fetchall()]
+            counts = dict(conn.execute('''
+                SELECT kind, COUNT(*) FROM anomaly_flags
+                WHERE account_id = ? AND status = 'open'
+                GROUP BY kind
+            ''', (account_id,)).fetchall())
+        finally:
+            conn.close()
+
+        # Transações de anos arquivados: lidas pelas partições só quando a página tem alguma
+        archived = [flag for flag in flags if flag['date'] is None]
+        if archived:
+            found = self._transactions([flag['transaction_id'] for flag in archived])
+            for flag in archived:
+                flag.update(found.get(flag['transaction_id'], {}))
+        return {'flags': [flag for flag in flags if flag['date'] is not None], 'counts': counts}
+
+    def _transactions(self, ids):
+        """{id: row} of transactions read through ``history_connection`` (archived years included)"""
+        found = {}
+        conn = self.history_connection()
+        try:
+            for start in range(0, len(ids), self.CHUNK):
+                chunk = ids[start:start + self.CHUNK]
+                for row in conn.execute(f'''
+                    SELECT id, date, description, value, transaction_type, document FROM transactions
+                    WHERE id IN ({', '.join('?' for _ in chunk)})
+                ''', chunk).fetchall():
+                    found[row['id']] = {key: row[key] for key in row.keys() if key != 'id'}
+        finally:
+            conn.close()
+        return found
+
+    def set_status(self, account_id, flag_id, status):
+        if status not in self.STATUSES:
+            raise ValueError(f'Status inválido: {status}')
+        conn = self.get_connection()
+        try:
+            conn.execute('''
+                UPDATE anomaly_flags SET status = ?, reviewed_at = ?
+                WHERE id = ? AND account_id = ?
+            ''', (status, datetime.now(), flag_id, account_id))
+            conn.commit()
+        finally:
+            conn.close()
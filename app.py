@@ -1,34 +1,53 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash
-import pandas as pd
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash, Response, stream_with_context, g
 import sqlite3
 import os
 import json
+import re
 from werkzeug.utils import secure_filename
 import threading
+import time
 import uuid
 from functools import wraps
 from datetime import datetime, timedelta
-import re
 from auth_client import AuthClient
 from cnpj_handler import CNPJHandler
 from transaction_handler import TransactionHandler
+from document_extractor import extract_document, extract_documents
+from export_handler import ExportHandler
+from partition_handler import PartitionHandler
+from classifier import classify, RULES_VERSION
+from reclassify_handler import ReclassifyHandler
+from reconciliation_handler import ReconciliationHandler
+from counterparty_handler import CounterpartyHandler
+from import_handler import ImportHandler
+from columnar import encode_columns, json_response
+from forecast_handler import ForecastHandler
+from account_handler import AccountHandler
+from anomaly_handler import AnomalyHandler
+from maintenance_handler import MaintenanceHandler
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key')
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Uploads are streamed to disk in chunks (ImportHandler.save), so memory stays flat
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 100)) * 1024 * 1024
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=1)
+# Tenant usado quando o servidor de autenticação não informa um
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', 'default')
 
 # Global variables
-upload_progress = {}  # Dictionary to track file upload progress
+IMPORT_PROGRESS_EVERY = 500
+# Heartbeat da importação: bem abaixo de ImportHandler.stale_minutes, mesmo com consultas lentas à BrasilAPI
+IMPORT_HEARTBEAT_SECONDS = 30
 failed_cnpjs = set()  # Set to track failed CNPJ lookups
+db_ready = False  # Set once init_db has run in this process
+db_lock = threading.Lock()
 
 # Initialize handlers
 auth_client = AuthClient(
     auth_server_url=os.getenv('AUTH_SERVER_URL', 'https://af360bank.onrender.com'),
     app_name=os.getenv('APP_NAME', 'financeiro')
 )
-cnpj_handler = CNPJHandler()
 transaction_handler = TransactionHandler()
 
 def ensure_upload_folder():
@@ -48,6 +67,23 @@ def login_required(f):
             session.clear()
             return redirect('https://af360bank.onrender.com/login')
         
+        g.tenant_id = str(verification.get('tenant_id') or DEFAULT_TENANT)
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Tenants que podem executar as tarefas que afetam o banco inteiro (manutenção);
+# numa instalação de um tenant só, o tenant padrão
+ADMIN_TENANTS = set(os.environ.get('ADMIN_TENANTS', DEFAULT_TENANT).split(','))
+
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if g.tenant_id not in ADMIN_TENANTS:
+            if request.path.startswith('/api/'):
+                return jsonify({'success': False, 'message': 'Forbidden'}), 403
+            flash('Acesso restrito a administradores', 'danger')
+            return redirect(url_for('index'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -57,10 +93,121 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+EXPORT_FOLDER = os.path.join('instance', 'exports')
+cnpj_handler = CNPJHandler(get_db_connection, ttl_days=int(os.environ.get('CNPJ_CACHE_TTL_DAYS', 30)))
+partition_handler = PartitionHandler(get_db_connection)
+# Conexões pelas partições: a reclassificação e as reconstruções incluem os anos arquivados
+# As séries da previsão tocadas por cada lote ficam pendentes no mesmo commit
+reclassify_handler = ReclassifyHandler(partition_handler.connect, on_change=ForecastHandler.touch)
+reconciliation_handler = ReconciliationHandler(
+    get_db_connection,
+    tolerance_days=int(os.environ.get('RECONCILIATION_TOLERANCE_DAYS', 3))
+)
+counterparty_handler = CounterpartyHandler(get_db_connection, history_connection=partition_handler.connect)
+account_handler = AccountHandler(get_db_connection)
+import_handler = ImportHandler(get_db_connection, app.config['UPLOAD_FOLDER'])
+anomaly_handler = AnomalyHandler(
+    get_db_connection,
+    threshold=float(os.environ.get('ANOMALY_THRESHOLD', 4)),
+    history_connection=partition_handler.connect
+)
+maintenance_handler = MaintenanceHandler(
+    get_db_connection,
+    tick_seconds=int(os.environ.get('MAINTENANCE_TICK_SECONDS', 60))
+)
+# Os recálculos leem pelas partições para que os anos arquivados entrem no saldo;
+# a página só lê o cache
+forecast_handler = ForecastHandler(
+    get_db_connection,
+    horizon_days=int(os.environ.get('FORECAST_HORIZON_DAYS', 60)),
+    history_connection=partition_handler.connect
+)
+
+def ensure_column(cursor, table, column, definition):
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def backfill_documents(chunk_size=50000):
+    """Extracts transactions.document for the rows imported before the column was filled.
+
+    Runs once (app_metadata 'documents_backfilled') over the hot table and
+    the archive. Rows without a valid CNPJ/CPF get '', so NULL keeps meaning
+    "not extracted yet". When documents were found the counterparty profiles
+    are rebuilt from them and the anomaly statistics are left for the
+    scheduler to rebuild. Returns the number of rows updated.
+    """
+    import pandas as pd
+
+    conn = get_db_connection()
+    try:
+        if conn.execute("SELECT 1 FROM app_metadata WHERE key = 'documents_backfilled'").fetchone():
+            return 0
+    finally:
+        conn.close()
+
+    updated = 0
+    found = 0
+    conn = partition_handler.connect()
+    try:
+        # O arquivo só está anexado quando há anos arquivados
+        tables = ['main.transactions'] + [
+            f'archive.{table}' for row in conn.execute('PRAGMA database_list') if row[1] == 'archive'
+            for table in PartitionHandler.ARCHIVE_TABLES
+        ]
+        for table in tables:
+            last_id = 0
+            while True:
+                rows = conn.execute(f'''
+                    SELECT id, description FROM {table}
+                    WHERE id > ? AND document IS NULL
+                    ORDER BY id
+                    LIMIT ?
+                ''', (last_id, chunk_size)).fetchall()
+                if not rows:
+                    break
+                ids, descriptions = zip(*rows)
+                documents = extract_documents(pd.Series(descriptions, dtype=object))['document']
+                conn.executemany(f'UPDATE {table} SET document = ? WHERE id = ?', zip(documents.tolist(), ids))
+                conn.commit()
+                last_id = ids[-1]
+                updated += len(rows)
+                found += int((documents != '').sum())
+
+        conn.execute('''
+            INSERT INTO app_metadata (key, value) VALUES ('documents_backfilled', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (datetime.now().isoformat(' '),))
+        if found:
+            # As chaves por documento das estatísticas passam a existir: o agendador as reconstrói.
+            # As séries da previsão também mudam de chave: sem cache, a próxima consulta recalcula tudo
+            conn.execute("DELETE FROM app_metadata WHERE key = 'anomaly_stats_built'")
+            conn.execute("DELETE FROM app_metadata WHERE key LIKE 'forecast_data_version:%'")
+        conn.commit()
+    finally:
+        conn.close()
+
+    if found:
+        counterparty_handler.rebuild()
+        conn = get_db_connection()
+        try:
+            documents = [row[0] for row in conn.execute('SELECT DISTINCT document FROM counterparties WHERE name IS NULL')]
+            counterparty_handler.set_names(conn, company_names(documents))
+            conn.commit()
+        finally:
+            conn.close()
+    return updated
+
 def init_db():
     conn = get_db_connection()
     cursor = conn.cursor()
     
+    # Só vale para um banco novo; bancos existentes são convertidos à mão (python maintenance_handler.py convert)
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    
+    # WAL: jobs longos de escrita (reclassificação) não bloqueiam as leituras
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS transactions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -73,17 +220,156 @@ def init_db():
         )
     ''')
     
+    # Versão das regras de classificação que definiu transaction_type
+    ensure_column(cursor, 'transactions', 'rule_version', 'INTEGER')
+    
+    # Conta e tenant de cada transação; linhas anteriores às contas vão para a conta padrão
+    ensure_column(cursor, 'transactions', 'account_id', 'INTEGER')
+    ensure_column(cursor, 'transactions', 'tenant_id', 'TEXT')
+    AccountHandler.init_schema(cursor)
+    AccountHandler.adopt_orphans(cursor, DEFAULT_TENANT)
+    
+    # Toda consulta de tela filtra por conta: os índices começam por account_id, e
+    # cada conta lê só a sua faixa, qualquer que seja o número de contas no banco
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(date)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_type ON transactions(type)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_document ON transactions(document)')
+    cursor.execute('DROP INDEX IF EXISTS idx_transactions_type')
+    cursor.execute('DROP INDEX IF EXISTS idx_transactions_document')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_account_date ON transactions(account_id, date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_account_type ON transactions(account_id, type)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_account_document ON transactions(account_id, document)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_tenant_date ON transactions(tenant_id, date)')
+    # Reclassificação incremental: lê só as linhas com versão de regras antiga
+    created = not cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_transactions_account_rule_version'"
+    ).fetchone()
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_account_rule_version ON transactions(account_id, rule_version)')
+    # Num banco já analisado, um índice sem estatísticas desvia o planejador das demais consultas
+    # (ex.: /api/transactions ordenava em memória em vez de seguir (account_id, date))
+    if created and cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        cursor.execute('ANALYZE idx_transactions_account_rule_version')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS app_metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+    
+    PartitionHandler.init_schema(cursor)
+    ReconciliationHandler.init_schema(cursor)
+    CounterpartyHandler.init_schema(cursor)
+    ImportHandler.init_schema(cursor)
+    ReclassifyHandler.init_schema(cursor)
+    ForecastHandler.init_schema(cursor)
+    AnomalyHandler.init_schema(cursor)
+    CNPJHandler.init_schema(cursor)
+    MaintenanceHandler.init_schema(cursor)
     
     conn.commit()
     conn.close()
+    
+    # Anos arquivados em arquivos por ano passam para o arquivo único; colunas novas chegam ao arquivo
+    partition_handler.prepare()
+    
+    # Linhas importadas antes da extração de documentos: preenchidas antes de montar os perfis
+    backfill_documents()
+
+def ensure_db():
+    # Under gunicorn init_db already ran once in the master (on_starting in
+    # gunicorn.conf.py) and DB_INITIALIZED is inherited by the workers
+    global db_ready
+    if db_ready or os.environ.get('DB_INITIALIZED'):
+        return
+    with db_lock:
+        if not db_ready:
+            init_db()
+            db_ready = True
+
+@app.before_request
+def setup_database():
+    ensure_db()
+
+def tenant_accounts():
+    # Uma consulta por requisição: alimenta current_account e o seletor da barra lateral
+    if 'accounts' not in g:
+        g.accounts = account_handler.list(g.tenant_id)
+    return g.accounts
+
+def current_account():
+    """Account selected in the session (must belong to the tenant), else the tenant's first account"""
+    if 'account' not in g:
+        account = next((a for a in tenant_accounts() if a['id'] == session.get('account_id')), None)
+        if account is None:
+            account = account_handler.default(g.tenant_id)
+            session['account_id'] = account['id']
+            g.pop('accounts', None)
+        g.account = account
+    return g.account
+
+@app.context_processor
+def inject_accounts():
+    # Seletor de conta da barra lateral; só nas páginas autenticadas
+    if 'tenant_id' not in g:
+        return {}
+    return {'current_account': current_account(), 'accounts': tenant_accounts(),
+            'is_admin': g.tenant_id in ADMIN_TENANTS}
+
+def data_version_key(account_id=None):
+    return 'data_version' if account_id is None else f'data_version:{account_id}'
+
+def get_data_version(conn, account_id=None):
+    row = conn.execute('SELECT value FROM app_metadata WHERE key = ?', (data_version_key(account_id),)).fetchone()
+    return int(row['value']) if row else 0
+
+def bump_data_version(conn, account_id):
+    # Incrementado a cada escrita em transactions: a versão global invalida os exports em cache,
+    # a da conta só a previsão dessa conta
+    conn.executemany('''
+        INSERT INTO app_metadata (key, value) VALUES (?, '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    ''', [(data_version_key(),), (data_version_key(account_id),)])
+
+def build_transaction_filters(args, account_id):
+    """Builds the WHERE conditions shared by /recebidos, the exports and /api/transactions"""
+    conditions = ['account_id = ?']
+    params = [account_id]
+    
+    if args.get('type') in ['CREDITO', 'DEBITO']:
+        conditions.append('type = ?')
+        params.append(args['type'])
+    
+    tipo_filtro = args.get('tipo', 'todos')
+    cnpj_filtro = args.get('cnpj', 'todos')
+    # Datas inválidas são ignoradas, como em partition_handler.connect
+    start_date = partition_handler.parse_date(args.get('start_date'))
+    end_date = partition_handler.parse_date(args.get('end_date'))
+    
+    if tipo_filtro != 'todos':
+        conditions.append('description LIKE ?')
+        params.append(f'{tipo_filtro}%')
+    
+    if cnpj_filtro != 'todos':
+        # Documento extraído na importação: busca pelo índice (account_id, document).
+        # Linhas ainda sem extração (document NULL, antes de backfill_documents) caem no LIKE
+        cnpj = re.sub(r'\D', '', cnpj_filtro)
+        conditions.append('(document = ? OR document IS NULL AND description LIKE ?)')
+        params += [cnpj, f'%CNPJ {cnpj}%']
+    
+    if start_date:
+        conditions.append('date >= ?')
+        params.append(start_date)
+    if end_date:
+        conditions.append('date <= ?')
+        params.append(end_date)
+    
+    return conditions, params
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'xls', 'xlsx'}
 
 def find_header_row(df):
+    import pandas as pd
+
     header_keywords = ['data', 'histórico', 'valor', 'date', 'historic', 'value']
     
     for idx, row in df.iterrows():
@@ -99,35 +385,35 @@ def find_matching_column(df, possible_names):
             return matches[0]
     return None
 
-def extract_and_enrich_cnpj(description, transaction_type):
-    cnpj_patterns = [
-        r'CNPJ[:\s]*(\d{14,15})',
-        r'CNPJ[:\s]*(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})',
-        r'(\d{14})(?=\D|$)'
-    ]
-    
-    for pattern in cnpj_patterns:
-        match = re.search(pattern, description)
-        if match:
-            cnpj = match.group(1)
-            cnpj = re.sub(r'\D', '', cnpj)
-            
-            if len(cnpj) >= 14:
-                cnpj = cnpj[:14]
-                
-                if transaction_type in ['PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO']:
-                    company_info = cnpj_handler.get_company_info(cnpj)
-                    if company_info and 'razao_social' in company_info:
-                        return description.replace(
-                            match.group(0),
-                            f"CNPJ {cnpj} - {company_info['razao_social']}"
-                        )
-                    else:
-                        failed_cnpjs.add(cnpj)
+def extract_and_enrich_cnpj(description, transaction_type, document=None):
+    # document: resultado de extract_document/extract_documents ({} quando não há
+    # documento; None só quando ninguém extraiu); só CNPJs com dígitos
+    # verificadores válidos chegam até a API
+    if document is None:
+        document = extract_document(description)
+    if not document or document['document_kind'] != 'CNPJ':
+        return description
+
+    cnpj = document['document']
+    if transaction_type in ['PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO']:
+        company_info = cnpj_handler.get_company_info(cnpj)
+        if company_info and 'razao_social' in company_info:
+            return description.replace(
+                document['document_text'],
+                f"CNPJ {cnpj} - {company_info['razao_social']}"
+            )
+        else:
+            failed_cnpjs.add(cnpj)
     
     return description
 
-def extract_transaction_info(historico, valor):
+def company_names(documents):
+    # Razões sociais já consultadas (cache do CNPJHandler) dos documentos informados
+    return {document: company_info['razao_social']
+            for document, company_info in cnpj_handler.lookup(list(set(documents))).items()
+            if company_info.get('razao_social')}
+
+def extract_transaction_info(historico, valor, document=None):
     historico = historico.upper()
     info = {
         'tipo': None,
@@ -137,48 +423,37 @@ def extract_transaction_info(historico, valor):
         'description': historico
     }
     
-    tipo_mapping = {
-        'PIX RECEBIDO': ['PIX RECEBIDO'],
-        'PIX ENVIADO': ['PIX ENVIADO'],
-        'TED RECEBIDA': ['TED RECEBIDA', 'TED CREDIT'],
-        'TED ENVIADA': ['TED ENVIADA', 'TED DEBIT'],
-        'PAGAMENTO': ['PAGAMENTO', 'PGTO', 'PAG'],
-        'TARIFA': ['TARIFA', 'TAR'],
-        'IOF': ['IOF'],
-        'RESGATE': ['RESGATE'],
-        'APLICACAO': ['APLICACAO', 'APLICAÇÃO'],
-        'COMPRA': ['COMPRA'],
-        'COMPENSACAO': ['COMPENSACAO', 'COMPENSAÇÃO'],
-        'CHEQUE DEVOLVIDO': ['CHEQUE DEVOLVIDO', 'CH DEVOLVIDO'],
-        'JUROS': ['JUROS'],
-        'MULTA': ['MULTA'],
-        'ANTECIPACAO': ['ANTECIPACAO', 'ANTECIPAÇÃO'],
-        'CHEQUE EMITIDO': ['CHEQUE EMITIDO', 'CH EMITIDO']
-    }
-    
-    for tipo, keywords in tipo_mapping.items():
-        if any(keyword in historico for keyword in keywords):
-            info['tipo'] = tipo
-            break
-    
-    if info['tipo'] is None:
-        info['tipo'] = 'OUTROS'
+    info['tipo'] = classify(historico)
     
+    if document is None:
+        document = extract_document(historico)
+    if document and document['document']:
+        info['document'] = document['document']
+    else:
+        # Já extraído e sem documento válido: {} (None faria extract_and_enrich_cnpj extrair de novo)
+        document = {}
+
     # Enrich description with CNPJ info if available
-    info['description'] = extract_and_enrich_cnpj(historico, info['tipo'])
+    info['description'] = extract_and_enrich_cnpj(historico, info['tipo'], document)
     
     return info
 
-def process_file_with_progress(filepath, process_id):
+def process_file_with_progress(filepath, process_id, account):
+    # pandas/openpyxl are only needed for ingestion; importing them here keeps
+    # worker startup and page views free of their import cost
+    import pandas as pd
+    from transaction_batch import TransactionBatchBuilder
+
+    # O progresso fica na linha da importação: qualquer worker responde a /upload_progress
+    reported_at = time.monotonic()
+
+    def report(**fields):
+        nonlocal reported_at
+        import_handler.report(process_id, **fields)
+        reported_at = time.monotonic()
+
     try:
-        # Initialize database first
-        init_db()
-        
-        # Initialize progress
-        upload_progress[process_id].update({
-            'status': 'processing',
-            'message': 'Reading file...'
-        })
+        report(message='Reading file...')
 
         # Read Excel file
         df = pd.read_excel(filepath)
@@ -191,11 +466,7 @@ def process_file_with_progress(filepath, process_id):
             df.columns = new_columns
             df = df.iloc[header_row + 1:].reset_index(drop=True)
 
-        upload_progress[process_id].update({
-            'total': len(df),
-            'current': 0,
-            'message': 'Processing transactions...'
-        })
+        report(total=len(df), current=0, message='Processing transactions...')
 
         # Find columns
         data_col = find_matching_column(df, ['Data', 'DATE', 'DT'])
@@ -205,14 +476,17 @@ def process_file_with_progress(filepath, process_id):
         if not all([data_col, desc_col, valor_col]):
             raise Exception("Required columns not found")
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        # Extract and validate CNPJs/CPFs for the whole column at once
+        documents = extract_documents(df[desc_col].fillna('').astype(str).str.strip())
+
+        transactions = TransactionBatchBuilder()
 
         for index, row in df.iterrows():
             try:
-                # Update progress
-                upload_progress[process_id]['current'] = index + 1
-                upload_progress[process_id]['message'] = f'Processing row {index + 1} of {len(df)}'
+                # Update progress (a cada IMPORT_PROGRESS_EVERY linhas: cada atualização é uma escrita),
+                # e por tempo: uma linha pode esperar segundos pela BrasilAPI
+                if index % IMPORT_PROGRESS_EVERY == 0 or time.monotonic() - reported_at >= IMPORT_HEARTBEAT_SECONDS:
+                    report(current=index + 1, message=f'Processing row {index + 1} of {len(df)}')
 
                 # Skip empty rows
                 if pd.isna(row[data_col]) or pd.isna(row[desc_col]) or pd.isna(row[valor_col]):
@@ -242,38 +516,67 @@ def process_file_with_progress(filepath, process_id):
                     value = float(valor_str.replace('.', '').replace(',', '.'))
 
                 # Extract transaction info
-                info = extract_transaction_info(description, value)
+                info = extract_transaction_info(description, value, documents.loc[index].to_dict())
 
-                # Insert into database
-                cursor.execute('''
-                    INSERT INTO transactions (date, description, value, type, transaction_type, document)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
-                    date,
-                    info['description'],
-                    value,
-                    'CREDITO' if value > 0 else 'DEBITO',
-                    info['tipo'],
-                    info.get('document', '')
-                ))
+                transactions.append(date, info['description'], value, info['tipo'], info.get('document', ''))
 
             except Exception as e:
                 print(f"Error processing row {index}: {str(e)}")
                 continue
 
+        batch = transactions.build()
+        report(current=len(df), message=f'Saving {len(batch)} transactions...')
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        # Uma linha por vez: lastrowid dá os ids realmente gerados, na ordem do lote
+        # (executemany não os devolve, e RETURNING exige SQLite 3.35)
+        ids = []
+        for date, description, value, tipo, document in batch.iter_tuples(['date', 'description', 'value', 'type', 'document']):
+            cursor.execute('''
+                INSERT INTO transactions
+                    (date, description, value, type, transaction_type, document, rule_version, account_id, tenant_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (date, description, value, 'CREDITO' if value > 0 else 'DEBITO', tipo, document or '', RULES_VERSION,
+                  account['id'], account['tenant_id']))
+            ids.append(cursor.lastrowid)
+
+        # Perfis das contrapartes atualizados na mesma transação do insert
+        counterparty_handler.apply(conn, account['id'], batch.column('document'), batch.dates, batch.values)
+        counterparty_handler.set_names(conn, company_names(batch.column('document')))
+
+        # Anomalias: o lote é pontuado contra as estatísticas anteriores a ele e depois as atualiza
+        flagged = 0
+        if len(batch):
+            flagged = anomaly_handler.apply(
+                conn, account['id'], ids, batch.column('date'), batch.values,
+                batch.column('type'), batch.column('document')
+            )
+
+        # Séries para a previsão alcançar caso a atualização abaixo falhe
+        ForecastHandler.touch(conn, account['id'], batch.column('description'), batch.column('document'),
+                              batch.column('type'))
+        bump_data_version(conn, account['id'])
+        data_version = get_data_version(conn, account['id'])
         conn.commit()
         conn.close()
+        report(message=f'{len(batch)} transactions saved, {flagged} flagged for review')
 
-        upload_progress[process_id].update({
-            'status': 'completed',
-            'message': 'Processing completed successfully'
-        })
+        # Previsão de caixa: reavalia só as séries recorrentes tocadas pelo import
+        report(message='Updating forecast...')
+        try:
+            forecast_handler.update(
+                account['id'], batch.column('description'), batch.column('document'), batch.column('type'),
+                data_version
+            )
+        except Exception as e:
+            print(f"Error updating forecast: {str(e)}")
+
+        import_handler.finish(process_id, 'completed', len(batch),
+                              f'{len(batch)} transactions imported, {flagged} flagged for review')
 
     except Exception as e:
-        upload_progress[process_id].update({
-            'status': 'error',
-            'message': str(e)
-        })
+        import_handler.finish(process_id, 'error', message=str(e))
     finally:
         if os.path.exists(filepath):
             os.remove(filepath)
@@ -309,24 +612,42 @@ def upload_file():
     if file.filename == '':
         return jsonify({'success': False, 'message': 'No file selected'})
     
+    # Conta escolhida no formulário de upload (padrão: a conta selecionada na sessão)
+    account = account_handler.get(g.tenant_id, request.form.get('account_id', type=int)) \
+        if request.form.get('account_id') else current_account()
+    if account is None:
+        return jsonify({'success': False, 'message': 'Invalid account'})
+    
     if file and allowed_file(file.filename):
         ensure_upload_folder()
         
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        file.save(filepath)
+        # Caminho único por upload, gravado em blocos enquanto calcula o SHA-256
+        filepath, sha256, size = import_handler.save(file.stream, os.path.splitext(filename)[1])
         
         process_id = str(uuid.uuid4())
-        upload_progress[process_id] = {
-            'status': 'processing',
-            'current': 0,
-            'total': 0,
-            'message': 'Starting process...'
-        }
+        started, previous = import_handler.begin(account['id'], sha256, filename, size, process_id)
+        if not started:
+            os.remove(filepath)
+            if previous['status'] == 'processing':
+                # Mesmo arquivo ainda em processamento: acompanha o progresso existente
+                return jsonify({
+                    'success': True,
+                    'process_id': previous['process_id'],
+                    'message': 'File is already being processed'
+                })
+            return jsonify({
+                'success': True,
+                'duplicate': True,
+                'import': previous,
+                'message': f"File already imported on {previous['created_at'][:16]} "
+                           f"as {previous['filename']} ({previous['row_count']} transactions)"
+            })
         
-        thread = threading.Thread(target=process_file_with_progress, args=(filepath, process_id))
+        thread = threading.Thread(target=process_file_with_progress, args=(filepath, process_id, account))
         thread.start()
+        # As telas passam a mostrar a conta que recebeu o extrato
+        session['account_id'] = account['id']
         
         return jsonify({
             'success': True,
@@ -336,110 +657,110 @@ def upload_file():
     
     return jsonify({'success': False, 'message': 'Invalid file type'})
 
+def reclassify_with_progress(process_id, account_id):
+    try:
+        result = reclassify_handler.run(account_id, process_id)
+    except Exception as e:
+        print(f"Error reclassifying transactions: {str(e)}")
+        return
+    
+    if not result['changed']:
+        return
+    conn = get_db_connection()
+    bump_data_version(conn, account_id)
+    data_version = get_data_version(conn, account_id)
+    conn.commit()
+    conn.close()
+    
+    # Agregados que dependem do tipo: só os tipos e as séries das linhas alteradas
+    try:
+        anomaly_handler.refresh_types(account_id, result['types'])
+        forecast_handler.catch_up(account_id, data_version)
+    except Exception as e:
+        print(f"Error updating rollups after reclassification: {str(e)}")
+
+@app.route('/reclassify', methods=['POST'])
+@login_required
+def reclassify():
+    if reclassify_handler.running:
+        return jsonify({'success': False, 'message': 'Reclassification already running'})
+    
+    process_id = str(uuid.uuid4())
+    account_id = current_account()['id']
+    reclassify_handler.begin(account_id, process_id)
+    
+    thread = threading.Thread(target=reclassify_with_progress, args=(process_id, account_id))
+    thread.start()
+    
+    return jsonify({
+        'success': True,
+        'process_id': process_id,
+        'message': 'Reclassification started'
+    })
+
 @app.route('/upload_progress/<process_id>')
 @login_required
 def get_upload_progress(process_id):
-    if process_id in upload_progress:
-        progress = upload_progress[process_id]
-        if progress['status'] in ['completed', 'error']:
-            del upload_progress[process_id]
+    # Importações e reclassificações: lidas do banco, gravado pelo worker que executa o processo
+    progress = import_handler.progress(g.tenant_id, process_id) or reclassify_handler.progress(g.tenant_id, process_id)
+    if progress:
         return jsonify(progress)
     return jsonify({'status': 'not_found'})
 
+@app.route('/contas', methods=['POST'])
+@login_required
+def create_account():
+    try:
+        account = account_handler.create(g.tenant_id, request.form.get('name', ''), request.form.get('bank'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(request.referrer or url_for('index'))
+    session['account_id'] = account['id']
+    flash(f"Conta {account['name']} selecionada", 'success')
+    return redirect(request.referrer or url_for('index'))
+
+@app.route('/conta', methods=['POST'])
+@login_required
+def select_account():
+    account = account_handler.get(g.tenant_id, request.form.get('account_id', type=int))
+    if account is None:
+        flash('Conta não encontrada', 'warning')
+    else:
+        session['account_id'] = account['id']
+    return redirect(request.referrer or url_for('index'))
+
 @app.route('/recebidos')
 @login_required
 def recebidos():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # Get filter parameters
     tipo_filtro = request.args.get('tipo', 'todos')
     cnpj_filtro = request.args.get('cnpj', 'todos')
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
     
-    # Base query with transaction_type extraction
-    query = '''
-        SELECT 
-            *,
-            CASE 
-                WHEN description LIKE 'PIX%' THEN 'PIX'
-                WHEN description LIKE 'TED%' THEN 'TED'
-                WHEN description LIKE 'PAGAMENTO%' THEN 'PAGAMENTO'
-                ELSE 'OUTROS'
-            END as transaction_type
-        FROM transactions 
-        WHERE type = 'CREDITO'
-    '''
-    params = []
-    
-    # Add tipo filter
-    if tipo_filtro != 'todos':
-        query += ' AND description LIKE ?'
-        params.append(f'{tipo_filtro}%')
-    
-    # Add CNPJ filter
-    if cnpj_filtro != 'todos':
-        query += ' AND description LIKE ?'
-        params.append(f'%CNPJ {cnpj_filtro}%')
-    
-    # Add date filters
-    if start_date:
-        query += ' AND date >= ?'
-        params.append(start_date)
-    if end_date:
-        query += ' AND date <= ?'
-        params.append(end_date)
-    
-    # Add ordering
-    query += ' ORDER BY date DESC'
+    # Archived years outside the date range are not attached
+    conn = partition_handler.connect(start_date, end_date)
+    cursor = conn.cursor()
     
-    # Get transactions
-    cursor.execute(query, params)
-    transactions = cursor.fetchall()
+    account_id = current_account()['id']
+    conditions, params = build_transaction_filters(request.args, account_id)
+    where = ' AND '.join(["type = 'CREDITO'"] + conditions)
     
-    # Calculate totals
-    totals_query = '''
+    # The rows themselves are fetched by the page in windows from /api/transactions
+    # Calculate totals with the same filters
+    cursor.execute(f'''
         SELECT 
             SUM(CASE WHEN description LIKE 'PIX%' THEN value ELSE 0 END) as pix_recebido,
             SUM(CASE WHEN description LIKE 'TED%' THEN value ELSE 0 END) as ted_recebida,
             SUM(CASE WHEN description LIKE 'PAGAMENTO%' THEN value ELSE 0 END) as pagamento,
             SUM(value) as total
         FROM transactions 
-        WHERE type = 'CREDITO'
-    '''
-    
-    # Apply the same filters to totals
-    if tipo_filtro != 'todos' or cnpj_filtro != 'todos' or start_date or end_date:
-        totals_query = totals_query.replace('WHERE type = ', 'WHERE type = ') + query[query.find('AND'):]
-    
-    cursor.execute(totals_query, params)
+        WHERE {where}
+    ''', params)
     totals_row = cursor.fetchone()
     
-        # Get unique CNPJs for filter dropdown
-    cursor.execute('''
-        SELECT DISTINCT 
-            CASE 
-                WHEN description LIKE '%CNPJ ______________%' 
-                THEN substr(description, 
-                    instr(description, 'CNPJ ') + 5, 
-                    14)
-                ELSE NULL 
-            END as cnpj,
-            MAX(description) as name
-        FROM transactions 
-        WHERE type = 'CREDITO' 
-        AND description LIKE '%CNPJ%'
-        GROUP BY CASE 
-            WHEN description LIKE '%CNPJ ______________%' 
-            THEN substr(description, 
-                instr(description, 'CNPJ ') + 5, 
-                14)
-            ELSE NULL 
-        END
-        HAVING cnpj IS NOT NULL
-    ''')
-    cnpjs = [{'cnpj': row['cnpj'], 'name': row['name']} for row in cursor.fetchall()]
+    # CNPJs for the filter dropdown come from the materialized counterparties table
+    cnpjs = [{'cnpj': row['cnpj'], 'name': row['name']} for row in counterparty_handler.cnpj_options(conn, account_id)]
     
     totals = {
         'pix_recebido': totals_row['pix_recebido'] or 0,
@@ -451,7 +772,6 @@ def recebidos():
     conn.close()
     
     return render_template('recebidos.html', 
-                         transactions=transactions,
                          totals=totals,
                          cnpjs=cnpjs,
                          tipo_filtro=tipo_filtro,
@@ -461,6 +781,50 @@ def recebidos():
                          active_page='recebidos',
                          failed_cnpjs=len(failed_cnpjs))
 
+@app.route('/export/<fmt>')
+@login_required
+def export_transactions(fmt):
+    if fmt not in ExportHandler.FORMATS:
+        return jsonify({'success': False, 'message': 'Invalid export format'}), 400
+    
+    conditions, params = build_transaction_filters(request.args, current_account()['id'])
+    where = f"WHERE {' AND '.join(conditions)}"
+    query = f'''
+        SELECT id, date, description, value, type, transaction_type, document
+        FROM transactions
+        {where}
+        ORDER BY date DESC, id DESC
+    '''
+    
+    # ?cache=1 reutiliza o arquivo gerado enquanto os dados não mudarem
+    data_version = None
+    # Só anexa as partições arquivadas que cruzam o período pedido
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    export_handler = ExportHandler(
+        lambda: partition_handler.connect(start_date, end_date),
+        cache_folder=EXPORT_FOLDER
+    )
+    if request.args.get('cache') == '1':
+        conn = get_db_connection()
+        data_version = get_data_version(conn)
+        conn.close()
+        export_handler.prune_cache(data_version)
+    
+    try:
+        body = export_handler.export(fmt, query, params, data_version)
+    except RuntimeError as e:
+        return jsonify({'success': False, 'message': str(e)}), 501
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 413
+    
+    filename = f"transacoes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    return Response(
+        stream_with_context(body),
+        mimetype=ExportHandler.FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
 @app.route('/retry_failed_cnpjs')
 @login_required
 def retry_failed_cnpjs():
@@ -468,12 +832,15 @@ def retry_failed_cnpjs():
     success = True
     
     try:
-        # Create a copy of failed_cnpjs to iterate over
-        cnpjs_to_retry = failed_cnpjs.copy()
-        
+        account_id = current_account()['id']
         conn = get_db_connection()
         cursor = conn.cursor()
         
+        # Só os CNPJs que aparecem na conta selecionada; os das outras contas ficam para elas
+        cnpjs_to_retry = [cnpj for cnpj in failed_cnpjs.copy() if cursor.execute(
+            'SELECT 1 FROM counterparties WHERE account_id = ? AND document = ?', (account_id, cnpj)
+        ).fetchone()]
+        
         for cnpj in cnpjs_to_retry:
             company_info = cnpj_handler.get_company_info(cnpj)
             if company_info and 'razao_social' in company_info:
@@ -485,11 +852,13 @@ def retry_failed_cnpjs():
                         'CNPJ ' || ?,
                         'CNPJ ' || ? || ' - ' || ?
                     )
-                    WHERE description LIKE ?
-                ''', (cnpj, cnpj, company_info['razao_social'], f'%CNPJ {cnpj}%'))
+                    WHERE account_id = ? AND document = ? AND description LIKE ?
+                ''', (cnpj, cnpj, company_info['razao_social'], account_id, cnpj, f'%CNPJ {cnpj}%'))
+                counterparty_handler.set_names(conn, {cnpj: company_info['razao_social']}, account_id)
                 
                 failed_cnpjs.remove(cnpj)
         
+        bump_data_version(conn, account_id)
         conn.commit()
         conn.close()
         
@@ -502,62 +871,296 @@ def retry_failed_cnpjs():
 @app.route('/enviados')
 @login_required
 def enviados():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT * FROM transactions 
-        WHERE type = 'DEBITO' 
-        ORDER BY date DESC
-    ''')
-    transactions = cursor.fetchall()
-    conn.close()
-    
+    # Débitos carregados sob demanda pela tabela virtualizada, como em /transactions
     return render_template('enviados.html', 
-                         transactions=transactions, 
                          active_page='enviados',
                          failed_cnpjs=len(failed_cnpjs))
 
 @app.route('/transactions')
 @login_required
 def transactions():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM transactions ORDER BY date DESC')
-    transactions = cursor.fetchall()
-    conn.close()
-    
+    # Rows are loaded on demand by the virtualized table (static/js/script.js)
     return render_template('transactions.html', 
-                         transactions=transactions, 
                          active_page='transactions',
                          failed_cnpjs=len(failed_cnpjs))
 
+API_TRANSACTION_FIELDS = ['id', 'date', 'description', 'value', 'transaction_type', 'document']
+API_MAX_LIMIT = 5000
+
+@app.route('/api/transactions')
+@login_required
+def api_transactions():
+    """A window of transactions in columnar form.
+
+    Same filters as /recebidos and the exports (type, tipo, cnpj,
+    start_date, end_date) plus limit, always within the selected account.
+    Rows come newest first, ordered by (date, id); windows are paged by key:
+    ``next`` holds the (date, id) of the window's last row (null on the last
+    window), and passing it back as after_date/after_id returns the rows
+    right after it, read from the index however deep the window is.
+    transaction_type and document are dictionary-encoded and the
+    counterparty names of the window's documents come in
+    ``counterparties``. ``total`` is only counted for the first window.
+    """
+    limit = min(max(request.args.get('limit', 500, type=int), 1), API_MAX_LIMIT)
+    after_date = request.args.get('after_date')
+    after_id = request.args.get('after_id', type=int)
+    
+    account_id = current_account()['id']
+    conditions, params = build_transaction_filters(request.args, account_id)
+    where = f"WHERE {' AND '.join(conditions)}"
+    first_window = not after_date or after_id is None
+    window_where, window_params = where, params
+    if not first_window:
+        window_where += ' AND (date, id) < (?, ?)'
+        window_params = params + [after_date, after_id]
+    
+    conn = partition_handler.connect(request.args.get('start_date'), request.args.get('end_date'))
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(f'''
+            SELECT {', '.join(API_TRANSACTION_FIELDS)}
+            FROM transactions
+            {window_where}
+            ORDER BY date DESC, id DESC
+            LIMIT ?
+        ''', window_params + [limit]).fetchall()
+        columns, dictionaries = encode_columns(rows, API_TRANSACTION_FIELDS, ['transaction_type', 'document'])
+        
+        last = rows[-1] if len(rows) == limit else None
+        payload = {
+            'count': len(rows),
+            'columns': columns,
+            'dictionaries': dictionaries,
+            'next': {
+                'date': last[API_TRANSACTION_FIELDS.index('date')],
+                'id': last[API_TRANSACTION_FIELDS.index('id')]
+            } if last else None
+        }
+        if first_window:
+            payload['total'] = cursor.execute(f'SELECT COUNT(*) FROM transactions {where}', params).fetchone()[0]
+        
+        documents = dictionaries['document']
+        payload['counterparties'] = dict(cursor.execute(f'''
+            SELECT document, name FROM counterparties
+            WHERE account_id = ? AND name IS NOT NULL AND document IN ({', '.join('?' for _ in documents)})
+        ''', [account_id] + documents).fetchall()) if documents else {}
+    finally:
+        conn.close()
+    
+    body, headers = json_response(payload, request.headers.get('Accept-Encoding', ''))
+    return Response(body, headers=headers)
+
+SUMMARY_DETAILS = 10
+
 @app.route('/transactions_summary')
 @login_required
 def transactions_summary():
-    conn = get_db_connection()
+    conn = partition_handler.connect()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT 
-            strftime('%Y-%m', date) as month,
-            SUM(CASE WHEN type = 'CREDITO' THEN value ELSE 0 END) as total_credits,
-            SUM(CASE WHEN type = 'DEBITO' THEN value ELSE 0 END) as total_debits,
-            COUNT(CASE WHEN type = 'CREDITO' THEN 1 END) as credit_count,
-            COUNT(CASE WHEN type = 'DEBITO' THEN 1 END) as debit_count
-        FROM transactions 
-        GROUP BY strftime('%Y-%m', date)
-        ORDER BY month DESC
-    ''')
-    summary = cursor.fetchall()
+    account_id = current_account()['id']
+    summary = {}
+    # Totais lidos só do índice (account_id, transaction_type, date, value)
+    for transaction_type, total, count in cursor.execute('''
+        SELECT transaction_type, SUM(value), COUNT(*)
+        FROM transactions
+        WHERE account_id = ?
+        GROUP BY transaction_type
+    ''', (account_id,)).fetchall():
+        # As mais recentes de cada tipo, pelo mesmo índice
+        details = cursor.execute('''
+            SELECT description, value FROM transactions
+            WHERE account_id = ? AND transaction_type IS ?
+            ORDER BY date DESC, id DESC
+            LIMIT ?
+        ''', (account_id, transaction_type, SUMMARY_DETAILS)).fetchall()
+        # Linhas anteriores ao classificador não têm tipo
+        summary[transaction_type or 'SEM TIPO'] = {
+            'total': total,
+            'count': count,
+            'details': [f'{description} ({value})' for description, value in details]
+        }
     conn.close()
     
     return render_template('transactions_summary.html', 
-                         transactions_summary=summary, 
+                         summary=summary, 
                          active_page='transactions_summary',
                          failed_cnpjs=len(failed_cnpjs))
 
+@app.route('/reconciliacao')
+@login_required
+def reconciliacao():
+    review = reconciliation_handler.review(current_account()['id'])
+    return render_template('reconciliacao.html',
+                         active_page='reconciliacao',
+                         tolerance_days=reconciliation_handler.tolerance_days,
+                         failed_cnpjs=len(failed_cnpjs),
+                         **review)
+
+@app.route('/reconciliacao/run', methods=['POST'])
+@login_required
+def run_reconciliation():
+    try:
+        result = reconciliation_handler.run(g.tenant_id, request.form.get('start_date'), request.form.get('end_date'))
+        flash(f"{result['transfers']} transferências e {result['expected']} pagamentos previstos conciliados", 'success')
+    except Exception as e:
+        print(f"Error running reconciliation: {str(e)}")
+        flash('Erro ao executar a conciliação', 'danger')
+    return redirect(url_for('reconciliacao'))
+
+@app.route('/reconciliacao/expected', methods=['POST'])
+@login_required
+def add_expected_payment():
+    try:
+        value = float(request.form['value'].replace('.', '').replace(',', '.'))
+        document = ''.join(filter(str.isdigit, request.form.get('document', '')))
+        reconciliation_handler.add_expected_payment(
+            current_account()['id'], request.form['due_date'], value, document, request.form.get('description')
+        )
+        flash('Pagamento previsto cadastrado', 'success')
+    except (KeyError, ValueError):
+        flash('Dados do pagamento previsto inválidos', 'danger')
+    return redirect(url_for('reconciliacao'))
+
+@app.route('/reconciliacao/<int:reconciliation_id>/desfazer', methods=['POST'])
+@login_required
+def undo_reconciliation(reconciliation_id):
+    reconciliation_handler.unmatch(g.tenant_id, reconciliation_id)
+    return redirect(url_for('reconciliacao'))
+
+@app.route('/contrapartes')
+@login_required
+def contrapartes():
+    by = request.args.get('by', 'credit')
+    start_month = request.args.get('start_month')
+    end_month = request.args.get('end_month')
+    counterparties = counterparty_handler.top(
+        current_account()['id'], request.args.get('top', 20, type=int), by, start_month, end_month
+    )
+    return render_template('contrapartes.html',
+                         counterparties=counterparties,
+                         by=by,
+                         start_month=start_month,
+                         end_month=end_month,
+                         active_page='contrapartes',
+                         failed_cnpjs=len(failed_cnpjs))
+
+@app.route('/contrapartes/<document>')
+@login_required
+def contraparte(document):
+    profile = counterparty_handler.profile(current_account()['id'], document)
+    if not profile:
+        flash('Contraparte não encontrada', 'warning')
+        return redirect(url_for('contrapartes'))
+    return render_template('contraparte.html',
+                         profile=profile,
+                         active_page='contrapartes',
+                         failed_cnpjs=len(failed_cnpjs))
+
+@app.route('/contrapartes/rebuild', methods=['POST'])
+@login_required
+def rebuild_counterparties():
+    counterparty_handler.rebuild(current_account()['id'])
+    flash('Perfis de contrapartes recalculados', 'success')
+    return redirect(url_for('contrapartes'))
+
+@app.route('/api/counterparties')
+@login_required
+def api_counterparties():
+    # ?top=N&by=credit|debit&start_month=YYYY-MM&end_month=YYYY-MM
+    return jsonify(counterparty_handler.top(
+        current_account()['id'],
+        request.args.get('top', 10, type=int),
+        request.args.get('by', 'credit'),
+        request.args.get('start_month'),
+        request.args.get('end_month')
+    ))
+
+@app.route('/api/counterparties/<document>')
+@login_required
+def api_counterparty(document):
+    profile = counterparty_handler.profile(current_account()['id'], document)
+    if not profile:
+        return jsonify({'success': False, 'message': 'Counterparty not found'}), 404
+    return jsonify(profile)
+
+@app.route('/anomalias')
+@login_required
+def anomalias():
+    status = request.args.get('status', 'open')
+    kind = request.args.get('kind')
+    review = anomaly_handler.review(current_account()['id'], status, kind)
+    return render_template('anomalias.html',
+                         flags=review['flags'],
+                         counts=review['counts'],
+                         status=status,
+                         kind=kind,
+                         active_page='anomalias',
+                         failed_cnpjs=len(failed_cnpjs))
+
+@app.route('/anomalias/<int:flag_id>/revisar', methods=['POST'])
+@login_required
+def review_anomaly(flag_id):
+    try:
+        anomaly_handler.set_status(current_account()['id'], flag_id, request.form.get('status', 'dismissed'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+    return redirect(request.referrer or url_for('anomalias'))
+
+@app.route('/anomalias/rebuild', methods=['POST'])
+@login_required
+def rebuild_anomalies():
+    anomaly_handler.rebuild(current_account()['id'])
+    flash('Estatísticas de anomalias recalculadas', 'success')
+    return redirect(url_for('anomalias'))
+
+@app.route('/api/anomalies')
+@login_required
+def api_anomalies():
+    # ?status=open|confirmed|dismissed&kind=duplicate|fee|outlier
+    return jsonify(anomaly_handler.review(
+        current_account()['id'],
+        request.args.get('status', 'open'),
+        request.args.get('kind'),
+        request.args.get('limit', 200, type=int)
+    ))
+
+def current_forecast():
+    account_id = current_account()['id']
+    conn = get_db_connection()
+    data_version = get_data_version(conn, account_id)
+    conn.close()
+    return forecast_handler.forecast(account_id, data_version)
+
+@app.route('/previsao')
+@login_required
+def previsao():
+    forecast = current_forecast()
+    # Uma linha por semana na tabela; a série diária completa fica em /api/forecast
+    weeks = [day for i, day in enumerate(forecast['days']) if i % 7 == 6 or i == len(forecast['days']) - 1]
+    return render_template('previsao.html',
+                         weeks=weeks,
+                         recurring=forecast['recurring'],
+                         horizon_days=forecast_handler.horizon_days,
+                         stale=forecast['stale'],
+                         pending=forecast['pending'],
+                         active_page='previsao',
+                         failed_cnpjs=len(failed_cnpjs))
+
+@app.route('/api/forecast')
+@login_required
+def api_forecast():
+    forecast = current_forecast()
+    fields = ['date', 'inflow', 'outflow', 'baseline', 'balance']
+    days, _ = encode_columns([tuple(day[f] for f in fields) for day in forecast['days']], fields)
+    body, headers = json_response(
+        {'days': days, 'recurring': forecast['recurring'], 'stale': forecast['stale'], 'pending': forecast['pending']},
+        request.headers.get('Accept-Encoding', '')
+    )
+    return Response(body, headers=headers)
+
 @app.route('/cnpj_verification', methods=['GET', 'POST'])
 @login_required
 def cnpj_verification():
@@ -577,7 +1180,79 @@ def cnpj_verification():
                          active_page='cnpj_verification',
                          failed_cnpjs=len(failed_cnpjs))
 
+def refresh_cnpj_cache():
+    # Poucos CNPJs por execução, espaçados: a BrasilAPI limita as requisições
+    result = cnpj_handler.refresh_expiring(
+        limit=int(os.environ.get('CNPJ_REFRESH_BATCH', 20)),
+        interval=float(os.environ.get('CNPJ_REFRESH_INTERVAL', 1.0))
+    )
+    if result['renamed']:
+        conn = get_db_connection()
+        counterparty_handler.set_names(conn, result['renamed'])
+        conn.commit()
+        conn.close()
+    return {'refreshed': result['refreshed'], 'failed': result['failed'], 'renamed': len(result['renamed'])}
+
+def prune_records():
+    return {
+        'imports': import_handler.prune(),
+        'reclassify_runs': reclassify_handler.prune(),
+        'cnpj_cache': cnpj_handler.prune(),
+        'maintenance_runs': maintenance_handler.prune()
+    }
+
+def rebuild_anomaly_stats():
+    # Estatísticas calculadas do histórico uma única vez (primeira execução após a atualização),
+    # fora da inicialização dos workers; depois só as importações as atualizam
+    if not anomaly_handler.needs_rebuild():
+        return {'rebuilt': False}
+    anomaly_handler.rebuild()
+    return {'rebuilt': True}
+
+maintenance_handler.register('cnpj_refresh', 3600, refresh_cnpj_cache)
+maintenance_handler.register('prune', 24 * 3600, prune_records)
+maintenance_handler.register('anomaly_stats', 3600, rebuild_anomaly_stats)
+
+def start_maintenance():
+    # Chamado em cada worker (post_worker_init no gunicorn.conf.py); a concessão no banco
+    # garante que só um deles executa os jobs
+    if os.environ.get('MAINTENANCE_ENABLED', '1') == '1':
+        maintenance_handler.start()
+
+def run_maintenance_job(job):
+    try:
+        maintenance_handler.run_now(job)
+    except RuntimeError as e:
+        print(f"Maintenance job {job} not run: {str(e)}")
+
+@app.route('/manutencao')
+@admin_required
+def manutencao():
+    return render_template('manutencao.html',
+                         maintenance=maintenance_handler.status(),
+                         running=maintenance_handler.running,
+                         active_page='manutencao',
+                         failed_cnpjs=len(failed_cnpjs))
+
+@app.route('/manutencao/<job>/executar', methods=['POST'])
+@admin_required
+def run_maintenance(job):
+    if job not in maintenance_handler.jobs:
+        flash('Tarefa de manutenção desconhecida', 'danger')
+    elif maintenance_handler.running:
+        flash('Manutenção já em andamento', 'warning')
+    else:
+        threading.Thread(target=run_maintenance_job, args=(job,), daemon=True).start()
+        flash(f'Tarefa {job} iniciada', 'success')
+    return redirect(url_for('manutencao'))
+
+@app.route('/api/maintenance')
+@admin_required
+def api_maintenance():
+    return jsonify(maintenance_handler.status(request.args.get('limit', 50, type=int)))
+
 if __name__ == '__main__':
-    init_db()
+    ensure_db()
+    start_maintenance()
     port = int(os.environ.get('PORT', 5002))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -1,4 +1,3 @@
-import requests
 from functools import wraps
 from flask import request, redirect, session, url_for, flash
 
@@ -8,6 +7,9 @@ class AuthClient:
         self.app_name = app_name
 
     def verify_token(self, token):
+        # Imported here so that importing the app doesn't pay for requests
+        import requests
+
         try:
             response = requests.post(
                 f"{self.auth_server_url}/api/verify_token",
@@ -0,0 +1,385 @@
+"""Route latency and query-plan regression check against a seeded database.
+
+Builds a reproducible SQLite database with N synthetic transactions (valid
+CNPJs/CPFs, enriched descriptions, counterparty profiles) spread evenly over
+--accounts accounts once and caches it under benchmarks/.cache. Every route
+below is then requested through the Flask test client with login stubbed
+out and the first account selected, and:
+
+- the median latency of each route is compared with the stored baseline
+  (benchmarks/baseline_routes.json); a route slower than
+  baseline * (1 + threshold) + slack, or without a baseline for the seed
+  size, fails the run;
+- every SQL statement the route executed is run through EXPLAIN QUERY PLAN
+  and full scans of the large tables fail the run;
+- a GET route of the application that is neither measured nor listed in
+  UNMEASURED_ROUTES fails the run.
+
+    python benchmarks/bench_routes.py [--rows 100000] [--accounts 1] [--runs 5] [--threshold 0.25]
+    python benchmarks/bench_routes.py --rows 1000000 --update-baseline
+
+Per-account routes should cost the same for one account of --rows R
+--accounts A as for a single-account database of R / A rows.
+
+Exit status is 1 when a route fails, regresses, scans a large table or is
+not covered. benchmarks/test_bench_routes.py runs the same check under pytest.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from document_extractor import CNPJ_WEIGHTS, CPF_WEIGHTS
+
+CACHE_FOLDER = os.path.join(ROOT, 'benchmarks', '.cache')
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baseline_routes.json')
+
+# Incrementar quando o conteúdo gerado mudar, para invalidar os bancos em cache
+SEED_VERSION = 4
+SEED = 42
+
+# Tabelas que crescem com o volume de transações: SCAN sem índice nelas reprova
+LARGE_TABLES = {'transactions', 'counterparty_months', 'reconciliations', 'anomaly_flags'}
+
+# Rotas medidas. {cnpj} é trocado por um CNPJ existente no banco semeado.
+ROUTES = [
+    '/',
+    '/recebidos',
+    '/recebidos?tipo=PIX RECEBIDO&start_date=2023-01-01&end_date=2023-03-31',
+    '/recebidos?cnpj={cnpj}',
+    '/enviados',
+    '/transactions',
+    '/transactions_summary',
+    '/api/transactions?type=CREDITO&limit=500',
+    # Janela funda: a chave continua no índice sem percorrer as linhas anteriores
+    '/api/transactions?type=CREDITO&after_date=2021-06-30&after_id=999999999&limit=500',
+    '/api/transactions?tipo=PIX RECEBIDO&start_date=2023-01-01&end_date=2023-03-31',
+    '/export/csv?type=CREDITO&start_date=2023-01-01&end_date=2023-12-31',
+    '/contrapartes',
+    '/contrapartes/{cnpj}',
+    '/api/counterparties?top=10',
+    '/api/counterparties?top=10&start_month=2023-01&end_month=2023-03',
+    '/api/counterparties/{cnpj}',
+    '/reconciliacao',
+    '/previsao',
+    '/anomalias',
+    '/api/anomalies?kind=duplicate',
+    '/api/forecast',
+    '/cnpj_verification',
+    '/manutencao',
+    '/api/maintenance',
+]
+
+# Rotas GET da aplicação que não são medidas, com o motivo. Uma rota nova que não
+# esteja em ROUTES nem aqui reprova a execução.
+UNMEASURED_ROUTES = {
+    '/static/<path:filename>': 'arquivos estáticos, servidos pelo proxy em produção',
+    '/auth': 'redireciona para o servidor de autenticação',
+    '/upload_progress/<process_id>': 'depende de uma importação em andamento',
+    '/retry_failed_cnpjs': 'consulta a BrasilAPI e altera as descrições',
+}
+
+# Full scans aceitos, com o motivo: (rota, tabela)
+ALLOWED_SCANS = {
+    # Sem cache, a primeira requisição dispara o cálculo em segundo plano sobre todo
+    # o histórico (e o saldo soma a tabela inteira); as seguintes só leem forecast_days
+    ('/previsao', 'transactions'),
+    ('/api/forecast', 'transactions'),
+}
+
+COMPANY_WORDS = ['COMERCIO', 'SERVICOS', 'INDUSTRIA', 'TRANSPORTES', 'ALIMENTOS',
+                 'TECNOLOGIA', 'CONSTRUTORA', 'DISTRIBUIDORA', 'LOGISTICA', 'SAUDE']
+
+
+def check_digits(base, weights):
+    digits = [int(c) for c in base]
+    for w in weights:
+        remainder = sum(d * k for d, k in zip(digits, w)) % 11
+        digits.append(0 if remainder < 2 else 11 - remainder)
+    return ''.join(map(str, digits))
+
+
+def seed_rows(count, rng):
+    """Yields (date, description, value, type, transaction_type, document) tuples"""
+    from classifier import classify
+
+    companies = []
+    for _ in range(max(50, count // 200)):
+        cnpj = check_digits(f'{rng.randrange(10 ** 7, 10 ** 8)}0001', CNPJ_WEIGHTS)
+        name = f'{rng.choice(COMPANY_WORDS)} {rng.choice(COMPANY_WORDS)} LTDA'
+        companies.append((cnpj, name))
+    people = [check_digits(f'{rng.randrange(10 ** 8, 10 ** 9)}', CPF_WEIGHTS) for _ in range(500)]
+
+    start = date(2020, 1, 1)
+    for _ in range(count):
+        day = (start + timedelta(days=rng.randrange(5 * 365))).isoformat()
+        kind = rng.random()
+        # Poucas contrapartes concentram a maior parte do volume, como num extrato real
+        cnpj, name = companies[min(int(rng.paretovariate(1.2)) - 1, len(companies) - 1)]
+        if kind < 0.35:
+            description = f'{rng.choice(["PIX RECEBIDO", "TED RECEBIDA"])} CNPJ {cnpj} - {name}'
+            value, document = round(rng.lognormvariate(7, 1.2), 2), cnpj
+        elif kind < 0.45:
+            description = f'PAGAMENTO CNPJ {cnpj} - {name}'
+            value, document = round(rng.lognormvariate(8, 1), 2), cnpj
+        elif kind < 0.75:
+            cpf = rng.choice(people)
+            description = f'{rng.choice(["PIX ENVIADO", "TED ENVIADA"])} CPF {cpf}'
+            value, document = -round(rng.lognormvariate(6.5, 1.2), 2), cpf
+        elif kind < 0.9:
+            description = f'COMPRA CARTAO {rng.randrange(10 ** 6)}'
+            value, document = -round(rng.lognormvariate(4, 1), 2), ''
+        else:
+            description = rng.choice(['TARIFA BANCARIA', 'IOF', 'JUROS', 'APLICACAO'])
+            value, document = -round(rng.lognormvariate(2, 1), 2), ''
+        yield (day, description, value, 'CREDITO' if value > 0 else 'DEBITO',
+               classify(description), document)
+
+
+def seed_key(rows, accounts):
+    return str(rows) if accounts == 1 else f'{rows}x{accounts}'
+
+
+def build_seed(rows, app_module, accounts=1):
+    """Creates (or reuses) the cached seeded database; returns its path"""
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    path = os.path.join(CACHE_FOLDER, f'seed-{seed_key(rows, accounts)}-v{SEED_VERSION}.db')
+    if os.path.exists(path):
+        return path
+
+    print(f'Building seeded database with {rows} transactions in {accounts} accounts (cached in {path})...')
+    started = time.perf_counter()
+    workdir = tempfile.mkdtemp(prefix='seed-', dir=CACHE_FOLDER)
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        app_module.init_db()
+        tenant_id = app_module.DEFAULT_TENANT
+        account_ids = [app_module.account_handler.create(tenant_id, f'Conta {i + 1:03d}')['id']
+                       for i in range(accounts)]
+        conn = app_module.get_db_connection()
+        # Cada conta recebe um extrato contínuo de rows / accounts linhas
+        per_account = -(-rows // accounts)
+        conn.executemany('''
+            INSERT INTO transactions
+                (date, description, value, type, transaction_type, document, rule_version, account_id, tenant_id)
+            VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?)
+        ''', (row + (account_ids[i // per_account], tenant_id)
+              for i, row in enumerate(seed_rows(rows, random.Random(SEED)))))
+        conn.commit()
+        conn.close()
+        app_module.counterparty_handler.rebuild()
+        app_module.anomaly_handler.rebuild()
+
+        conn = app_module.get_db_connection()
+        conn.execute('UPDATE counterparties SET name = NULL')
+        names = conn.execute('''
+            SELECT DISTINCT document, substr(description, instr(description, ' - ') + 3)
+            FROM transactions WHERE description LIKE '%CNPJ % - %'
+        ''').fetchall()
+        conn.executemany('UPDATE counterparties SET name = ? WHERE document = ?', [(n, d) for d, n in names])
+        conn.execute('ANALYZE')
+        conn.commit()
+        conn.close()
+        shutil.move(os.path.join(workdir, 'instance', 'financas.db'), path)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f'Seeded in {time.perf_counter() - started:.1f}s')
+    return path
+
+
+class QueryRecorder:
+    """Captures the expanded SQL of every statement run through sqlite3.connect"""
+
+    def __init__(self):
+        self.statements = []
+        self._connect = sqlite3.connect
+
+    def __enter__(self):
+        def connect(*args, **kwargs):
+            conn = self._connect(*args, **kwargs)
+            conn.set_trace_callback(self.statements.append)
+            return conn
+        sqlite3.connect = connect
+        return self
+
+    def __exit__(self, *exc):
+        sqlite3.connect = self._connect
+
+
+def full_scans(conn, statements):
+    """(table, statement) for every large table scanned without an index"""
+    found = []
+    for sql in dict.fromkeys(statements):
+        if not re.match(r'\s*(SELECT|WITH)\b', sql, re.IGNORECASE):
+            continue
+        try:
+            plan = conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+        except sqlite3.Error:
+            continue
+        # O plano mostra o alias (SCAN t) quando a tabela tem um
+        aliases = {}
+        for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+(?:\w+\.)?(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.IGNORECASE):
+            aliases[table] = table
+            if alias:
+                aliases.setdefault(alias, table)
+        for row in plan:
+            match = re.match(r'SCAN (\w+)$', row[3])
+            table = match and aliases.get(match.group(1), match.group(1))
+            if table in LARGE_TABLES:
+                found.append((table, ' '.join(sql.split())[:160]))
+    return found
+
+
+def measure(client, url, runs):
+    client.get(url).get_data()  # aquecimento: caches de template e do SQLite
+    timings = []
+    status = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        response = client.get(url)
+        response.get_data()  # inclui respostas em streaming (exports)
+        timings.append((time.perf_counter() - started) * 1000)
+        status = response.status_code
+    return status, statistics.median(timings)
+
+
+def load_baseline():
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            return json.load(f)
+    return {}
+
+
+def unmeasured_routes(flask_app):
+    """GET rules of the application neither in ROUTES nor in UNMEASURED_ROUTES"""
+    adapter = flask_app.url_map.bind('localhost')
+    measured = {adapter.match(route.split('?')[0].format(cnpj='0'))[0] for route in ROUTES}
+    return sorted(rule.rule for rule in flask_app.url_map.iter_rules()
+                  if 'GET' in rule.methods and rule.rule not in UNMEASURED_ROUTES
+                  and rule.endpoint not in measured)
+
+
+def run(rows, accounts=1, runs=5, threshold=0.25, slack_ms=5.0, require_baseline=True):
+    """Measures every route against the seeded database; returns (results, failures)
+
+    ``results`` maps each route to its median latency in ms and
+    ``failures`` lists the routes that failed, regressed past
+    baseline * (1 + threshold) + slack_ms, have no baseline for this seed
+    (unless ``require_baseline`` is false, when recording one) or scanned
+    a large table, plus the application routes that are not covered.
+    """
+    import app as app_module
+
+    failures = [f'{rule}: not measured (add it to ROUTES or UNMEASURED_ROUTES)'
+                for rule in unmeasured_routes(app_module.app)]
+
+    seed_path = build_seed(rows, app_module, accounts)
+    workdir = tempfile.mkdtemp(prefix='run-', dir=CACHE_FOLDER)
+    os.makedirs(os.path.join(workdir, 'instance'))
+    shutil.copy(seed_path, os.path.join(workdir, 'instance', 'financas.db'))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    # Sem servidor de autenticação nem BrasilAPI durante a medição
+    app_module.auth_client.verify_token = lambda token: {'valid': True}
+    app_module.cnpj_handler.get_company_info = lambda cnpj: None
+    conn = app_module.get_db_connection()
+    account_id = conn.execute('SELECT MIN(id) FROM accounts').fetchone()[0]
+    cnpj = conn.execute('SELECT document FROM counterparties WHERE account_id = ? ORDER BY total_credit DESC LIMIT 1',
+                        (account_id,)).fetchone()[0]
+    conn.close()
+
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['token'] = 'benchmark'
+        session['account_id'] = account_id
+
+    budgets = load_baseline().get(seed_key(rows, accounts), {})
+    results = {}
+
+    print(f"{'route':<75} {'status':>6} {'median':>10} {'baseline':>10}")
+    try:
+        for route in ROUTES:
+            url = route.format(cnpj=cnpj)
+            with QueryRecorder() as recorder:
+                status, median = measure(client, url, runs)
+
+            path = route.split('?')[0]
+            plan_conn = app_module.partition_handler.connect()
+            scans = [(table, sql) for table, sql in full_scans(plan_conn, recorder.statements)
+                     if (path, table) not in ALLOWED_SCANS]
+            plan_conn.close()
+
+            results[route] = round(median, 2)
+            reference = budgets.get(route)
+            verdict = ''
+            if status != 200:
+                verdict = 'FAIL status'
+                failures.append(f'{route}: HTTP {status}')
+            elif reference is None and require_baseline:
+                verdict = 'NO BASELINE'
+                failures.append(f'{route}: no baseline for {seed_key(rows, accounts)} rows')
+            elif reference is not None and median > reference * (1 + threshold) + slack_ms:
+                verdict = 'REGRESSION'
+                failures.append(f'{route}: {median:.1f} ms > {reference:.1f} ms baseline')
+            print(f"{route[:75]:<75} {status:>6} {median:>8.1f}ms "
+                  f"{(f'{reference:.1f}ms' if reference is not None else '-'):>10} {verdict}")
+            for table, sql in scans:
+                print(f'    full scan of {table}: {sql}')
+                failures.append(f'{route}: full scan of {table}')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--accounts', type=int, default=1,
+                        help='accounts the rows are spread over; the routes read the first one')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown over the baseline (0.25 = 25%%)')
+    parser.add_argument('--slack-ms', type=float, default=5.0,
+                        help='absolute tolerance added to every budget, absorbs timer noise on fast routes')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    results, failures = run(args.rows, args.accounts, args.runs, args.threshold, args.slack_ms,
+                            require_baseline=not args.update_baseline)
+    key = seed_key(args.rows, args.accounts)
+
+    if args.update_baseline:
+        baseline = load_baseline()
+        baseline[key] = results
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline for {key} rows written to {BASELINE_PATH}')
+        return 0
+
+    if failures:
+        print('\nFailed:')
+        for failure in failures:
+            print(f'  - {failure}')
+        return 1
+    print('\nAll routes within budget')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
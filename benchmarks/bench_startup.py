@@ -0,0 +1,62 @@
+"""Startup benchmark: import time of app.py and time to first request.
+
+Each measurement runs in a fresh interpreter, as a gunicorn worker would.
+
+    python benchmarks/bench_startup.py [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Executado em um processo novo, com cwd em um diretório temporário para que
+# o banco criado pelo primeiro request não seja o de instance/ do projeto
+CHILD = r'''
+import json, sys, time
+sys.path.insert(0, ROOT)
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+response = client.get('/auth')  # sem token: redireciona sem chamar o servidor de auth
+first_request = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'first_request': first_request - start,
+    'status': response.status_code,
+    'pandas_loaded': 'pandas' in sys.modules,
+    'requests_loaded': 'requests' in sys.modules
+}))
+'''
+
+
+def run_once():
+    with tempfile.TemporaryDirectory() as cwd:
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD.replace('ROOT', repr(ROOT))],
+            cwd=cwd, capture_output=True, text=True, check=True
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    for key in ['import', 'first_request']:
+        values = [r[key] * 1000 for r in results]
+        print(f'{key:>14}: median {statistics.median(values):7.1f} ms  '
+              f'min {min(values):7.1f} ms  max {max(values):7.1f} ms')
+    print(f"pandas loaded at startup: {results[-1]['pandas_loaded']}")
+    print(f"requests loaded at startup: {results[-1]['requests_loaded']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Memory and throughput: list of dicts vs TransactionBatch.
+
+Builds N synthetic parsed transactions both ways (the old read_excel
+output and TransactionBatchBuilder) and reports the memory retained after
+building (tracemalloc) plus build and iteration throughput.
+
+    python benchmarks/bench_transaction_batch.py [--rows 1000000]
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transaction_batch import TransactionBatchBuilder
+
+TIPOS = ['PIX RECEBIDO', 'PIX ENVIADO', 'TED RECEBIDA', 'PAGAMENTO', 'TARIFA', 'IOF', 'OUTROS']
+
+
+def synthetic_rows(count, seed=42):
+    rng = random.Random(seed)
+    start = date(2020, 1, 1)
+    documents = [f'{rng.randrange(10 ** 13, 10 ** 14)}' for _ in range(2000)]
+    for i in range(count):
+        tipo = rng.choice(TIPOS)
+        document = rng.choice(documents) if tipo in ('PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO') else ''
+        yield (
+            (start + timedelta(days=rng.randrange(1800))).strftime('%Y-%m-%d'),
+            f'{tipo} {document} {rng.randrange(10 ** 6)}',
+            round(rng.uniform(-5000, 5000), 2),
+            tipo,
+            document,
+            str(rng.randrange(10 ** 8)) if tipo.startswith('PIX') else None
+        )
+
+
+def build_dicts(rows):
+    return [{
+        'date': data,
+        'description': description,
+        'value': valor,
+        'type': tipo,
+        'document': document,
+        'identifier': identifier,
+        'transaction_type': 'receita' if valor > 0 else 'despesa'
+    } for data, description, valor, tipo, document, identifier in rows]
+
+
+def build_batch(rows):
+    builder = TransactionBatchBuilder()
+    for row in rows:
+        builder.append(*row)
+    return builder.build()
+
+
+def measure(name, build, rows):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build(rows)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    total = sum(item['value'] for item in result)
+    iterate = time.perf_counter() - start
+
+    print(f'{name:>16}: retained {current / 2 ** 20:8.1f} MB  peak {peak / 2 ** 20:8.1f} MB  '
+          f'build {len(rows) / elapsed:10,.0f} rows/s  iterate {len(rows) / iterate:10,.0f} rows/s')
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    # As strings de entrada são geradas antes e não entram na medição
+    rows = list(synthetic_rows(args.rows))
+    print(f'{args.rows:,} transactions')
+    a = measure('list of dicts', build_dicts, rows)
+    b = measure('TransactionBatch', build_batch, rows)
+    assert abs(a - b) < 1e-3
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Payload size and latency: row-object JSON vs the columnar /api/transactions.
+
+Uses the seeded database of bench_routes.py and compares, for all credit
+transactions (what /recebidos shows):
+
+- the old approach: every row as a JSON object in one response, and the
+  server-rendered /recebidos HTML (reconstructed with the same row markup);
+- the new one: the first 500-row window the virtualized table needs before
+  the page is usable, and the whole result fetched window by window.
+
+Sizes are reported raw and gzipped; "first paint" is the server time until
+the browser has the rows it needs to draw the table.
+
+    python benchmarks/bench_transactions_api.py [--rows 100000]
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_routes import CACHE_FOLDER, ROOT, build_seed
+
+ROW_HTML = '''                    <tr>
+                        <td>{date}</td>
+                        <td>
+                            <span class="badge bg-success">
+                                {type}
+                            </span>
+                        </td>
+                        <td>{description}</td>
+                        <td class="text-success">
+                            R$ {value}
+                        </td>
+                    </tr>
+'''
+
+
+def report(label, body, elapsed):
+    print(f'{label:<42} {len(body) / 1024:>10.0f} KB {len(gzip.compress(body, 5)) / 1024:>9.0f} KB '
+          f'{elapsed * 1000:>9.0f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--window', type=int, default=500)
+    args = parser.parse_args()
+
+    import app as app_module
+
+    seed_path = build_seed(args.rows, app_module)
+    workdir = tempfile.mkdtemp(prefix='run-', dir=CACHE_FOLDER)
+    os.makedirs(os.path.join(workdir, 'instance'))
+    shutil.copy(seed_path, os.path.join(workdir, 'instance', 'financas.db'))
+    os.chdir(workdir)
+
+    app_module.auth_client.verify_token = lambda token: {'valid': True}
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['token'] = 'benchmark'
+
+    try:
+        print(f"{'':<42} {'raw':>13} {'gzip':>12} {'time':>12}")
+
+        started = time.perf_counter()
+        conn = app_module.get_db_connection()
+        rows = [dict(row) for row in conn.execute(
+            "SELECT * FROM transactions WHERE type = 'CREDITO' ORDER BY date DESC, id DESC")]
+        conn.close()
+        body = json.dumps(rows).encode('utf-8')
+        report(f'before: row objects ({len(rows)} rows)', body, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        body = ''.join(ROW_HTML.format(
+            date=row['date'], type=row['transaction_type'], description=row['description'],
+            value=f"{row['value']:.2f}".replace('.', ',')
+        ) for row in rows).encode('utf-8')
+        report('before: /recebidos table HTML', body, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        response = client.get('/recebidos')
+        report('after: /recebidos page (no rows)', response.data, time.perf_counter() - started)
+
+        headers = {'Accept-Encoding': 'gzip'}
+        started = time.perf_counter()
+        response = client.get(f'/api/transactions?type=CREDITO&limit={args.window}', headers=headers)
+        first = time.perf_counter() - started
+        wire = len(response.data)
+        payload = json.loads(gzip.decompress(response.data))
+        total = payload['total']
+        print(f"{'after: first window (' + str(args.window) + ' rows)':<42} "
+              f"{len(json.dumps(payload, separators=(',', ':')).encode()) / 1024:>10.0f} KB "
+              f"{wire / 1024:>9.0f} KB {first * 1000:>9.0f} ms")
+
+        started = time.perf_counter()
+        wire = raw = 0
+        cursor = ''
+        while True:
+            response = client.get(f'/api/transactions?type=CREDITO&limit=5000{cursor}', headers=headers)
+            wire += len(response.data)
+            raw += len(gzip.decompress(response.data))
+            window = json.loads(gzip.decompress(response.data))['next']
+            if not window:
+                break
+            cursor = f"&after_date={window['date']}&after_id={window['id']}"
+        print(f"{'after: all ' + str(total) + ' rows in 5000-row windows':<42} {raw / 1024:>10.0f} KB "
+              f"{wire / 1024:>9.0f} KB {(time.perf_counter() - started) * 1000:>9.0f} ms")
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Route regression check run by pytest on the small seeded database.
+
+Every application route must be measured (or listed with a reason in
+UNMEASURED_ROUTES), answer 200, avoid full scans of the large tables and
+stay within baseline * (1 + BENCH_THRESHOLD) + BENCH_SLACK_MS. The seed is
+built once and cached under benchmarks/.cache.
+
+    python -m pytest benchmarks
+    BENCH_ROWS=100000 python -m pytest benchmarks
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_routes
+
+ROWS = int(os.environ.get('BENCH_ROWS', 10000))
+THRESHOLD = float(os.environ.get('BENCH_THRESHOLD', 0.25))
+SLACK_MS = float(os.environ.get('BENCH_SLACK_MS', 5.0))
+
+
+def test_every_route_is_measured():
+    import app as app_module
+
+    assert bench_routes.unmeasured_routes(app_module.app) == []
+
+
+def test_every_route_has_a_baseline():
+    budgets = bench_routes.load_baseline().get(bench_routes.seed_key(ROWS, 1), {})
+    assert [route for route in bench_routes.ROUTES if route not in budgets] == []
+
+
+def test_routes_within_budget():
+    results, failures = bench_routes.run(ROWS, runs=5, threshold=THRESHOLD, slack_ms=SLACK_MS)
+    assert set(results) == set(bench_routes.ROUTES)
+    assert failures == [], '\n'.join(failures)
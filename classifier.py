@@ -0,0 +1,50 @@
+import re
+
+# Incrementar RULES_VERSION sempre que TIPO_MAPPING mudar: cada transação guarda
+# a versão que definiu seu transaction_type e o job de reclassificação
+# (reclassify_handler.py) reaplica as regras novas sem precisar de re-upload.
+RULES_VERSION = 1
+
+# A ordem importa: vale o primeiro tipo cujo keyword aparece no histórico
+TIPO_MAPPING = {
+    'PIX RECEBIDO': ['PIX RECEBIDO'],
+    'PIX ENVIADO': ['PIX ENVIADO'],
+    'TED RECEBIDA': ['TED RECEBIDA', 'TED CREDIT'],
+    'TED ENVIADA': ['TED ENVIADA', 'TED DEBIT'],
+    'PAGAMENTO': ['PAGAMENTO', 'PGTO', 'PAG'],
+    'TARIFA': ['TARIFA', 'TAR'],
+    'IOF': ['IOF'],
+    'RESGATE': ['RESGATE'],
+    'APLICACAO': ['APLICACAO', 'APLICAÇÃO'],
+    'COMPRA': ['COMPRA'],
+    'COMPENSACAO': ['COMPENSACAO', 'COMPENSAÇÃO'],
+    'CHEQUE DEVOLVIDO': ['CHEQUE DEVOLVIDO', 'CH DEVOLVIDO'],
+    'JUROS': ['JUROS'],
+    'MULTA': ['MULTA'],
+    'ANTECIPACAO': ['ANTECIPACAO', 'ANTECIPAÇÃO'],
+    'CHEQUE EMITIDO': ['CHEQUE EMITIDO', 'CH EMITIDO']
+}
+
+DEFAULT_TIPO = 'OUTROS'
+
+
+def classify(historico):
+    """Transaction type of a single description"""
+    historico = historico.upper()
+    for tipo, keywords in TIPO_MAPPING.items():
+        if any(keyword in historico for keyword in keywords):
+            return tipo
+    return DEFAULT_TIPO
+
+
+def classify_batch(descriptions):
+    """Vectorized classify() over a Series of descriptions"""
+    import pandas as pd
+
+    upper = descriptions.fillna('').astype(str).str.upper()
+    result = pd.Series(DEFAULT_TIPO, index=descriptions.index, dtype=object)
+    # Do último para o primeiro, para que os tipos de maior prioridade sobrescrevam
+    for tipo, keywords in reversed(list(TIPO_MAPPING.items())):
+        mask = upper.str.contains('|'.join(map(re.escape, keywords)), regex=True)
+        result[mask.to_numpy()] = tipo
+    return result
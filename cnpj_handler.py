@@ -1,27 +1,106 @@
-import re
-import requests
+import json
+import time
+from datetime import datetime, timedelta
+
+from document_extractor import extract_document
 
 class CNPJHandler:
-    PATTERNS = [
-        r'CNPJ[:\s]*(\d{14,15})',
-        r'CNPJ[:\s]*(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})',
-        r'\b(\d{14,15})\b',
-        r'\b(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})\b'
-    ]
-
-    def __init__(self):
+    """Company data from BrasilAPI, cached in memory and in ``cnpj_cache``.
+
+    With a connection factory every successful lookup is also saved to the
+    database, so the cache survives restarts and is shared by the gunicorn
+    workers. Entries expire after ``ttl_days`` (razão social and addresses
+    change); an expired entry is still served, and ``refresh_expiring``
+    renews the ones closest to expiry in small, rate-limited batches from
+    the maintenance scheduler instead of on the request path.
+
+    The in-memory copy keeps each entry's ``expires_at``: once it passes,
+    the row is read again from ``cnpj_cache``, so a worker picks up the
+    names another worker's scheduler refreshed. A row that is itself
+    expired is re-read at most every ``MEMORY_RECHECK``.
+    """
+
+    API_URL = 'https://brasilapi.com.br/api/cnpj/v1/{}'
+    # Parâmetros por consulta IN do SQLite
+    CHUNK = 500
+    # Entrada vencida no banco: a memória a reaproveita por este tempo antes de reler a linha
+    MEMORY_RECHECK = timedelta(hours=1)
+
+    def __init__(self, get_connection=None, ttl_days=30):
         self.cache = {}
         self.failed_cnpjs = set()
+        self.get_connection = get_connection
+        self.ttl_days = ttl_days
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cnpj_cache (
+                cnpj TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                fetched_at TIMESTAMP NOT NULL,
+                expires_at TIMESTAMP NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cnpj_cache_expires ON cnpj_cache(expires_at)')
+
+    def _fetch(self, cnpj):
+        import requests
+
+        response = requests.get(self.API_URL.format(cnpj), timeout=5)
+        if response.status_code == 200:
+            return response.json()
+        return None
+
+    def _remember(self, cnpj, company_info, expires_at):
+        self.cache[cnpj] = (company_info, max(expires_at, datetime.now() + self.MEMORY_RECHECK))
+        return company_info
+
+    def _store(self, cnpj, company_info):
+        now = datetime.now()
+        expires_at = now + timedelta(days=self.ttl_days)
+        self._remember(cnpj, company_info, expires_at)
+        if not self.get_connection:
+            return
+        conn = self.get_connection()
+        try:
+            conn.execute('''
+                INSERT INTO cnpj_cache (cnpj, data, fetched_at, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(cnpj) DO UPDATE SET
+                    data = excluded.data, fetched_at = excluded.fetched_at, expires_at = excluded.expires_at
+            ''', (cnpj, json.dumps(company_info), now, expires_at))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def lookup(self, cnpjs):
+        """Cached company data of the given CNPJs, without calling the API"""
+        now = datetime.now()
+        found = {cnpj: self.cache[cnpj][0] for cnpj in cnpjs if cnpj in self.cache and self.cache[cnpj][1] > now}
+        missing = [cnpj for cnpj in set(cnpjs) if cnpj and cnpj not in found]
+        if not missing or not self.get_connection:
+            return found
+        conn = self.get_connection()
+        try:
+            for start in range(0, len(missing), self.CHUNK):
+                chunk = missing[start:start + self.CHUNK]
+                for cnpj, data, expires_at in conn.execute(f'''
+                    SELECT cnpj, data, expires_at FROM cnpj_cache WHERE cnpj IN ({', '.join('?' for _ in chunk)})
+                ''', chunk).fetchall():
+                    found[cnpj] = self._remember(cnpj, json.loads(data), datetime.fromisoformat(str(expires_at)))
+        finally:
+            conn.close()
+        return found
 
     def get_company_info(self, cnpj):
-        if cnpj in self.cache:
-            return self.cache[cnpj]
-        
+        cached = self.lookup([cnpj])
+        if cnpj in cached:
+            return cached[cnpj]
+
         try:
-            response = requests.get(f'https://brasilapi.com.br/api/cnpj/v1/{cnpj}', timeout=5)
-            if response.status_code == 200:
-                company_info = response.json()
-                self.cache[cnpj] = company_info
+            company_info = self._fetch(cnpj)
+            if company_info:
+                self._store(cnpj, company_info)
                 if cnpj in self.failed_cnpjs:
                     self.failed_cnpjs.remove(cnpj)
                 return company_info
@@ -32,19 +111,76 @@ class CNPJHandler:
             self.failed_cnpjs.add(cnpj)
         return None
 
+    def refresh_expiring(self, limit=20, interval=1.0, within_days=3):
+        """Re-fetches up to ``limit`` entries expiring within ``within_days``, ``interval`` seconds apart.
+
+        Returns {'refreshed', 'failed', 'renamed'}, where ``renamed`` maps
+        the CNPJs whose razão social changed to the new name. A failed entry
+        keeps its data and is retried a day later, so one CNPJ the API keeps
+        rejecting does not hold back the rest of the queue.
+        """
+        now = datetime.now()
+        conn = self.get_connection()
+        try:
+            rows = conn.execute('''
+                SELECT cnpj, data FROM cnpj_cache WHERE expires_at < ? ORDER BY expires_at LIMIT ?
+            ''', (now + timedelta(days=within_days), limit)).fetchall()
+        finally:
+            conn.close()
+
+        result = {'refreshed': 0, 'failed': 0, 'renamed': {}}
+        postponed = []
+        for i, (cnpj, data) in enumerate(rows):
+            # Limite de requisições da BrasilAPI
+            if i:
+                time.sleep(interval)
+            try:
+                company_info = self._fetch(cnpj)
+            except Exception as e:
+                print(f"Error refreshing company info: {e}")
+                company_info = None
+            if not company_info:
+                result['failed'] += 1
+                postponed.append((now + timedelta(days=1), cnpj))
+                continue
+            self._store(cnpj, company_info)
+            result['refreshed'] += 1
+            name = company_info.get('razao_social')
+            if name and name != json.loads(data).get('razao_social'):
+                result['renamed'][cnpj] = name
+
+        if postponed:
+            conn = self.get_connection()
+            try:
+                conn.executemany('UPDATE cnpj_cache SET expires_at = ? WHERE cnpj = ?', postponed)
+                conn.commit()
+            finally:
+                conn.close()
+        return result
+
+    def prune(self, max_age_days=180):
+        """Drops entries that could not be refreshed for ``max_age_days``; returns how many"""
+        conn = self.get_connection()
+        try:
+            removed = conn.execute('DELETE FROM cnpj_cache WHERE fetched_at < ?',
+                                   (datetime.now() - timedelta(days=max_age_days),)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        if removed:
+            # A memória é recarregada do banco sob demanda
+            self.cache.clear()
+        return removed
+
     def extract_and_enrich_cnpj(self, description, transaction_type):
-        for pattern in self.PATTERNS:
-            match = re.search(pattern, description)
-            if match:
-                cnpj = ''.join(filter(str.isdigit, match.group(1)))
-                if len(cnpj) == 15 and cnpj.startswith('0'):
-                    cnpj = cnpj[1:]
-                elif len(cnpj) != 14:
-                    continue
-
-                company_info = self.get_company_info(cnpj)
-                if company_info:
-                    razao_social = company_info.get('razao_social', '')
-                    return description.replace(match.group(0), f"{razao_social} (CNPJ: {cnpj})")
-        
-        return description
\ No newline at end of file
+        document = extract_document(description)
+        if not document or document['document_kind'] != 'CNPJ':
+            return description
+
+        cnpj = document['document']
+        company_info = self.get_company_info(cnpj)
+        if company_info:
+            razao_social = company_info.get('razao_social', '')
+            return description.replace(document['document_text'], f"{razao_social} (CNPJ: {cnpj})")
+
+        return description
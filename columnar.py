@@ -0,0 +1,42 @@
+import gzip
+import json
+
+# Respostas menores que isso não compensam o custo de compressão
+GZIP_MIN_SIZE = 1024
+
+
+def encode_columns(rows, fields, dictionary_fields=()):
+    """Turns a list of row tuples into one array per field.
+
+    Fields listed in ``dictionary_fields`` are dictionary-encoded: the column
+    holds integer codes into ``dictionaries[field]`` (-1 for NULL), so a
+    transaction type or counterparty repeated over thousands of rows is sent
+    once.
+    """
+    columns = {field: list(values) for field, values in zip(fields, zip(*rows))} if rows \
+        else {field: [] for field in fields}
+    dictionaries = {}
+    for field in dictionary_fields:
+        index = {}
+        codes = []
+        for value in columns[field]:
+            if value is None:
+                codes.append(-1)
+                continue
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(index)
+            codes.append(code)
+        columns[field] = codes
+        dictionaries[field] = list(index)
+    return columns, dictionaries
+
+
+def json_response(payload, accept_encoding=''):
+    """Compact JSON body, gzipped when the client accepts it; returns (body, headers)"""
+    body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    headers = {'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'}
+    if 'gzip' in accept_encoding and len(body) >= GZIP_MIN_SIZE:
+        body = gzip.compress(body, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+    return body, headers
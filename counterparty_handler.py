@@ -0,0 +1,244 @@
+class CounterpartyHandler:
+    """Materialized per-document totals, kept up to date on every import.
+
+    ``counterparties`` holds one row per account and CNPJ/CPF with running
+    credit/debit totals and counts, first/last seen dates and the company
+    name from the CNPJ enrichment; ``counterparty_months`` holds the same
+    totals per month. Imports add their batch aggregates with an upsert, so
+    top-N and per-counterparty series are index lookups instead of GROUP BYs
+    over transactions.
+
+    ``rebuild`` reads through ``history_connection`` when given
+    (partition_handler.connect), so archived years count in the profiles.
+    """
+
+    def __init__(self, get_connection, history_connection=None):
+        self.get_connection = get_connection
+        self.history_connection = history_connection or get_connection
+
+    @staticmethod
+    def init_schema(cursor):
+        # Perfis anteriores às contas: renomeados e copiados para a conta padrão abaixo
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(counterparties)')]
+        legacy = bool(columns) and 'account_id' not in columns
+        if legacy:
+            cursor.execute('DROP INDEX IF EXISTS idx_counterparties_total_credit')
+            cursor.execute('DROP INDEX IF EXISTS idx_counterparties_total_debit')
+            cursor.execute('DROP INDEX IF EXISTS idx_counterparty_months_month')
+            cursor.execute('ALTER TABLE counterparties RENAME TO counterparties_legacy')
+            cursor.execute('ALTER TABLE counterparty_months RENAME TO counterparty_months_legacy')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS counterparties (
+                account_id INTEGER NOT NULL,
+                document TEXT NOT NULL,
+                name TEXT,
+                total_credit REAL NOT NULL DEFAULT 0,
+                total_debit REAL NOT NULL DEFAULT 0,
+                credit_count INTEGER NOT NULL DEFAULT 0,
+                debit_count INTEGER NOT NULL DEFAULT 0,
+                first_seen DATE,
+                last_seen DATE,
+                PRIMARY KEY (account_id, document)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS counterparty_months (
+                account_id INTEGER NOT NULL,
+                document TEXT NOT NULL,
+                month TEXT NOT NULL,
+                total_credit REAL NOT NULL DEFAULT 0,
+                total_debit REAL NOT NULL DEFAULT 0,
+                credit_count INTEGER NOT NULL DEFAULT 0,
+                debit_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (account_id, document, month)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_counterparties_total_credit ON counterparties(account_id, total_credit DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_counterparties_total_debit ON counterparties(account_id, total_debit)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_counterparties_document ON counterparties(document)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_counterparty_months_month ON counterparty_months(account_id, month)')
+
+        if legacy:
+            # Antes das contas havia uma conta só: a primeira criada (AccountHandler.adopt_orphans)
+            cursor.execute('''
+                INSERT INTO counterparties
+                SELECT a.id, l.* FROM counterparties_legacy l
+                JOIN (SELECT MIN(id) AS id FROM accounts) a ON a.id IS NOT NULL
+            ''')
+            cursor.execute('''
+                INSERT INTO counterparty_months
+                SELECT a.id, l.* FROM counterparty_months_legacy l
+                JOIN (SELECT MIN(id) AS id FROM accounts) a ON a.id IS NOT NULL
+            ''')
+            cursor.execute('DROP TABLE counterparties_legacy')
+            cursor.execute('DROP TABLE counterparty_months_legacy')
+
+    @staticmethod
+    def _aggregate(frame, keys):
+        credit = frame['value'].where(frame['value'] > 0, 0)
+        debit = frame['value'].where(frame['value'] < 0, 0)
+        grouped = frame.assign(
+            total_credit=credit,
+            total_debit=debit,
+            credit_count=(frame['value'] > 0).astype(int),
+            debit_count=(frame['value'] < 0).astype(int)
+        ).groupby(keys, sort=False)
+        return grouped.agg(
+            total_credit=('total_credit', 'sum'),
+            total_debit=('total_debit', 'sum'),
+            credit_count=('credit_count', 'sum'),
+            debit_count=('debit_count', 'sum'),
+            first_seen=('date', 'min'),
+            last_seen=('date', 'max')
+        ).reset_index()
+
+    def apply(self, conn, account_id, documents, dates, values):
+        """Adds a batch of one account's transactions to the profiles; runs inside the caller's transaction"""
+        import pandas as pd
+
+        frame = pd.DataFrame({'document': documents, 'date': dates, 'value': values})
+        frame = frame[frame['document'].notna() & (frame['document'] != '')]
+        if frame.empty:
+            return 0
+        frame['date'] = pd.to_datetime(frame['date']).dt.strftime('%Y-%m-%d')
+        frame['month'] = frame['date'].str[:7]
+
+        totals = self._aggregate(frame, ['document']).assign(account_id=account_id)
+        conn.executemany('''
+            INSERT INTO counterparties
+                (account_id, document, total_credit, total_debit, credit_count, debit_count, first_seen, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(account_id, document) DO UPDATE SET
+                total_credit = total_credit + excluded.total_credit,
+                total_debit = total_debit + excluded.total_debit,
+                credit_count = credit_count + excluded.credit_count,
+                debit_count = debit_count + excluded.debit_count,
+                first_seen = MIN(COALESCE(first_seen, excluded.first_seen), excluded.first_seen),
+                last_seen = MAX(COALESCE(last_seen, excluded.last_seen), excluded.last_seen)
+        ''', totals[['account_id', 'document', 'total_credit', 'total_debit', 'credit_count', 'debit_count',
+                     'first_seen', 'last_seen']].itertuples(index=False, name=None))
+
+        months = self._aggregate(frame, ['document', 'month']).assign(account_id=account_id)
+        conn.executemany('''
+            INSERT INTO counterparty_months
+                (account_id, document, month, total_credit, total_debit, credit_count, debit_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(account_id, document, month) DO UPDATE SET
+                total_credit = total_credit + excluded.total_credit,
+                total_debit = total_debit + excluded.total_debit,
+                credit_count = credit_count + excluded.credit_count,
+                debit_count = debit_count + excluded.debit_count
+        ''', months[['account_id', 'document', 'month', 'total_credit', 'total_debit', 'credit_count',
+                     'debit_count']].itertuples(index=False, name=None))
+        return len(totals)
+
+    def set_names(self, conn, names, account_id=None):
+        """names: {document: razao_social} from the CNPJ enrichment, set on one account's or every account's profile"""
+        if account_id is None:
+            conn.executemany('UPDATE counterparties SET name = ? WHERE document = ?',
+                             ((name, document) for document, name in names.items()))
+        else:
+            conn.executemany('UPDATE counterparties SET name = ? WHERE account_id = ? AND document = ?',
+                             ((name, account_id, document) for document, name in names.items()))
+
+    def rebuild(self, account_id=None):
+        """Recomputes the profiles of one account (or of all) from the transactions, archived years included"""
+        conn = self.history_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            if account_id is None:
+                accounts = [row[0] for row in cursor.execute('SELECT id FROM accounts ORDER BY id').fetchall()]
+            else:
+                accounts = [account_id]
+            names = {}
+            for account in accounts:
+                names.update(conn.execute('''
+                    SELECT document, name FROM counterparties WHERE account_id = ? AND name IS NOT NULL
+                ''', (account,)).fetchall())
+                conn.execute('DELETE FROM counterparties WHERE account_id = ?', (account,))
+                conn.execute('DELETE FROM counterparty_months WHERE account_id = ?', (account,))
+            for account_id in accounts:
+                cursor.execute('''
+                    SELECT document, date, value FROM transactions
+                    WHERE account_id = ? AND document IS NOT NULL AND document != ''
+                ''', (account_id,))
+                while True:
+                    rows = cursor.fetchmany(100000)
+                    if not rows:
+                        break
+                    documents, dates, values = zip(*rows)
+                    self.apply(conn, account_id, documents, dates, values)
+            for account_id in accounts:
+                self.set_names(conn, names, account_id)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def top(self, account_id, n=10, by='credit', start_month=None, end_month=None):
+        """Top-N counterparties of an account by received (credit) or paid (debit) volume"""
+        conn = self.get_connection()
+        try:
+            order = 'total_credit DESC' if by == 'credit' else 'total_debit ASC'
+            if not start_month and not end_month:
+                # Lê direto do índice de totais: custo proporcional a N
+                return [dict(row) for row in conn.execute(f'''
+                    SELECT document, name, total_credit, total_debit, credit_count,
+                           debit_count, first_seen, last_seen
+                    FROM counterparties
+                    WHERE account_id = ?
+                    ORDER BY {order}
+                    LIMIT ?
+                ''', (account_id, n))]
+
+            params = [account_id]
+            where = ['m.account_id = ?']
+            if start_month:
+                where.append('m.month >= ?')
+                params.append(start_month)
+            if end_month:
+                where.append('m.month <= ?')
+                params.append(end_month)
+            return [dict(row) for row in conn.execute(f'''
+                SELECT m.document, c.name,
+                       SUM(m.total_credit) AS total_credit, SUM(m.total_debit) AS total_debit,
+                       SUM(m.credit_count) AS credit_count, SUM(m.debit_count) AS debit_count,
+                       c.first_seen, c.last_seen
+                FROM counterparty_months m
+                JOIN counterparties c ON c.account_id = m.account_id AND c.document = m.document
+                WHERE {' AND '.join(where)}
+                GROUP BY m.document
+                ORDER BY {order}
+                LIMIT ?
+            ''', params + [n])]
+        finally:
+            conn.close()
+
+    def profile(self, account_id, document):
+        """Totals plus the monthly series of one counterparty of an account, or None"""
+        conn = self.get_connection()
+        try:
+            row = conn.execute('SELECT * FROM counterparties WHERE account_id = ? AND document = ?',
+                               (account_id, document)).fetchone()
+            if not row:
+                return None
+            profile = dict(row)
+            profile['months'] = [dict(month) for month in conn.execute('''
+                SELECT month, total_credit, total_debit, credit_count, debit_count
+                FROM counterparty_months
+                WHERE account_id = ? AND document = ?
+                ORDER BY month
+            ''', (account_id, document))]
+            return profile
+        finally:
+            conn.close()
+
+    def cnpj_options(self, conn, account_id):
+        """(cnpj, name) pairs of an account's paying companies for the /recebidos dropdown"""
+        return conn.execute('''
+            SELECT document AS cnpj, COALESCE(name, 'CNPJ ' || document) AS name
+            FROM counterparties
+            WHERE account_id = ? AND credit_count > 0 AND length(document) = 14
+            ORDER BY name
+        ''', (account_id,)).fetchall()
@@ -0,0 +1,142 @@
+import re
+
+# Um único padrão para todos os formatos de documento encontrados nos históricos:
+#   - "CNPJ 12345678000190" / "CPF: 12345678909" (aceita 11 a 15 dígitos após o rótulo)
+#   - "12.345.678/0001-90" e "123.456.789-09" (com ou sem rótulo antes)
+#   - sequências soltas de exatamente 14 (CNPJ) ou 11 (CPF) dígitos
+DOCUMENT_PATTERN = re.compile(
+    r'(?P<text>'
+    r'(?P<label>CNPJ|CPF)[:\s]*(?P<prefixed>\d{11,15})(?!\d)'
+    r'|(?:(?:CNPJ|CPF)[:\s]*)?(?<![\d.])(?P<formatted>\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}|\d{3}\.\d{3}\.\d{3}-\d{2})(?!\d)'
+    r'|(?<!\d)(?P<raw>\d{14}|\d{11})(?!\d)'
+    r')'
+)
+
+CNPJ_WEIGHTS = (
+    (5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2),
+    (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2),
+)
+CPF_WEIGHTS = (
+    tuple(range(10, 1, -1)),
+    tuple(range(11, 1, -1)),
+)
+
+DOCUMENT_COLUMNS = ['document', 'document_kind', 'document_text']
+
+
+def _normalize(label, digits):
+    """Returns (document, kind) for a raw candidate, or (None, None) if it can't be a document"""
+    if label == 'CPF' or (not label and len(digits) == 11):
+        return (digits, 'CPF') if len(digits) == 11 else (None, None)
+
+    if len(digits) == 15:
+        if not digits.startswith('0'):
+            return None, None
+        digits = digits[1:]
+    return digits.zfill(14), 'CNPJ'
+
+
+def _check_digits(digits, weights):
+    """Vectorized mod-11 check: digits is an (n, size) int array, returns a boolean mask"""
+    import numpy as np
+
+    valid = np.ones(len(digits), dtype=bool)
+    for w in weights:
+        size = len(w)
+        remainder = (digits[:, :size] @ np.array(w)) % 11
+        expected = np.where(remainder < 2, 0, 11 - remainder)
+        valid &= digits[:, size] == expected
+    # Sequências repetidas (00000000000000, 11111111111...) passam no cálculo mas não existem
+    valid &= (digits != digits[:, :1]).any(axis=1)
+    return valid
+
+
+def _digit_matrix(documents, size):
+    import numpy as np
+
+    raw = ''.join(documents).encode('ascii')
+    return (np.frombuffer(raw, dtype=np.uint8).reshape(-1, size) - 48).astype(np.int64)
+
+
+def _check_digits_scalar(document, weights):
+    # Mesmo cálculo de _check_digits para um único documento, sem numpy
+    digits = [int(c) for c in document]
+    for w in weights:
+        remainder = sum(d * k for d, k in zip(digits, w)) % 11
+        if digits[len(w)] != (0 if remainder < 2 else 11 - remainder):
+            return False
+    return len(set(document)) > 1
+
+
+def is_valid_cnpj(cnpj):
+    return len(cnpj) == 14 and cnpj.isdigit() and _check_digits_scalar(cnpj, CNPJ_WEIGHTS)
+
+
+def is_valid_cpf(cpf):
+    return len(cpf) == 11 and cpf.isdigit() and _check_digits_scalar(cpf, CPF_WEIGHTS)
+
+
+def extract_document(description):
+    """Returns the first valid CNPJ/CPF in a single description as a dict, or None"""
+    for match in DOCUMENT_PATTERN.finditer(str(description).upper()):
+        candidate = match.group('prefixed') or match.group('formatted') or match.group('raw')
+        document, kind = _normalize(match.group('label'), re.sub(r'\D', '', candidate))
+        if kind == 'CNPJ' and is_valid_cnpj(document) or kind == 'CPF' and is_valid_cpf(document):
+            return {
+                'document': document,
+                'document_kind': kind,
+                'document_text': match.group('text')
+            }
+    return None
+
+
+def extract_documents(descriptions):
+    """Extract the first valid CNPJ/CPF of every description in a Series.
+
+    Returns a DataFrame aligned with ``descriptions`` with the columns
+    document, document_kind ('CNPJ', 'CPF' or '') and document_text (the
+    matched text, used to rewrite the description). Candidates that fail the
+    check digits are discarded here, so they never reach the CNPJ API.
+    """
+    import numpy as np
+    import pandas as pd
+
+    result = pd.DataFrame('', index=descriptions.index, columns=DOCUMENT_COLUMNS)
+    if descriptions.empty:
+        return result
+
+    candidates = descriptions.astype(str).str.upper().str.extractall(DOCUMENT_PATTERN)
+    if candidates.empty:
+        return result
+
+    digits = (
+        candidates['prefixed']
+        .fillna(candidates['formatted'])
+        .fillna(candidates['raw'])
+        .str.replace(r'\D', '', regex=True)
+    )
+    label = candidates['label'].fillna('')
+    length = digits.str.len()
+
+    is_cpf = (label == 'CPF') | ((label == '') & (length == 11))
+    cnpj = digits.where(~(length == 15) | ~digits.str.startswith('0'), digits.str[1:]).str.zfill(14)
+    document = cnpj.where(~is_cpf, digits)
+
+    valid = pd.Series(False, index=candidates.index)
+    cpf_mask = is_cpf & (length == 11)
+    cnpj_mask = ~is_cpf & (document.str.len() == 14)
+    if cpf_mask.any():
+        valid[cpf_mask] = _check_digits(_digit_matrix(document[cpf_mask], 11), CPF_WEIGHTS)
+    if cnpj_mask.any():
+        valid[cnpj_mask] = _check_digits(_digit_matrix(document[cnpj_mask], 14), CNPJ_WEIGHTS)
+
+    found = pd.DataFrame({
+        'document': document,
+        'document_kind': np.where(is_cpf, 'CPF', 'CNPJ'),
+        'document_text': candidates['text']
+    })[valid.to_numpy()]
+    # Primeiro documento válido de cada descrição
+    found = found.groupby(level=0).first()
+
+    result.loc[found.index, DOCUMENT_COLUMNS] = found[DOCUMENT_COLUMNS].to_numpy()
+    return result
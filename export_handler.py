@@ -0,0 +1,223 @@
+import csv
+import hashlib
+import io
+import os
+import tempfile
+
+EXPORT_COLUMNS = ['id', 'date', 'description', 'value', 'type', 'transaction_type', 'document']
+
+
+class _ChunkSink:
+    """Write-only file object for ParquetWriter; the bytes written so far are taken with ``drain``"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ExportHandler:
+    """Streams transactions out of SQLite as CSV, XLSX or Parquet.
+
+    Rows are read with fetchmany in chunks of ``chunk_size``, so memory stays
+    flat regardless of the table size. CSV and Parquet are produced directly
+    as generators: Parquet is written one row group per chunk (only the
+    footer comes at the end), and each row group is sent as soon as it is
+    encoded. XLSX is a zip container that openpyxl can only finish at the
+    end, so it is written (write-only mode, one row at a time) to a
+    temporary file that is then streamed back, and it is capped at the
+    sheet limit of Excel (``XLSX_MAX_ROWS``); larger exports must use CSV
+    or Parquet.
+    """
+
+    FORMATS = {
+        'csv': 'text/csv',
+        'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'parquet': 'application/vnd.apache.parquet'
+    }
+    # Limite de linhas de uma planilha do Excel, menos o cabeçalho
+    XLSX_MAX_ROWS = 1048576 - 1
+
+    def __init__(self, get_connection, cache_folder='exports', chunk_size=10000):
+        self.get_connection = get_connection
+        self.cache_folder = cache_folder
+        self.chunk_size = chunk_size
+
+    def iter_chunks(self, query, params):
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                yield [tuple(row) for row in rows]
+        finally:
+            conn.close()
+
+    def stream_csv(self, query, params):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in self.iter_chunks(query, params):
+            writer.writerows(rows)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+    def write_csv(self, path, query, params):
+        with open(path, 'wb') as f:
+            for data in self.stream_csv(query, params):
+                f.write(data)
+
+    def count(self, query, params):
+        conn = self.get_connection()
+        try:
+            return conn.execute(f'SELECT COUNT(*) FROM ({query})', params).fetchone()[0]
+        finally:
+            conn.close()
+
+    def write_xlsx(self, path, query, params):
+        from openpyxl import Workbook
+
+        # Verificado antes de abrir a planilha: a contagem sai do índice, a escrita não
+        if self.count(query, params) > self.XLSX_MAX_ROWS:
+            raise ValueError(f'Exportação XLSX limitada a {self.XLSX_MAX_ROWS} linhas; use CSV ou Parquet')
+
+        # write_only mantém apenas a linha atual em memória
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('Transações')
+        sheet.append(EXPORT_COLUMNS)
+        for rows in self.iter_chunks(query, params):
+            for row in rows:
+                sheet.append(row)
+        workbook.save(path)
+
+    @staticmethod
+    def _require_pyarrow():
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise RuntimeError('Exportação Parquet requer o pacote pyarrow')
+
+    def stream_parquet(self, query, params):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([
+            ('id', pa.int64()),
+            ('date', pa.string()),
+            ('description', pa.string()),
+            ('value', pa.float64()),
+            ('type', pa.string()),
+            ('transaction_type', pa.string()),
+            ('document', pa.string())
+        ])
+        sink = _ChunkSink()
+        with pq.ParquetWriter(sink, schema, compression='snappy') as writer:
+            for rows in self.iter_chunks(query, params):
+                # Cada chunk vira um row group, enviado assim que é gravado
+                columns = list(zip(*rows))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                    schema=schema
+                ))
+                yield sink.drain()
+        # Rodapé com os metadados dos row groups
+        yield sink.drain()
+
+    def write_parquet(self, path, query, params):
+        self._require_pyarrow()
+        with open(path, 'wb') as f:
+            for data in self.stream_parquet(query, params):
+                f.write(data)
+
+    def write(self, fmt, path, query, params):
+        getattr(self, f'write_{fmt}')(path, query, params)
+
+    def stream_file(self, path, remove=False, block_size=64 * 1024):
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(block_size)
+                    if not data:
+                        break
+                    yield data
+        finally:
+            if remove and os.path.exists(path):
+                os.remove(path)
+
+    def cache_path(self, fmt, query, params, data_version):
+        key = hashlib.sha1(repr((query, params)).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_folder, f'{key}-v{data_version}.{fmt}')
+
+    def export(self, fmt, query, params, data_version=None):
+        """Returns a generator of bytes for the export.
+
+        When ``data_version`` is given the file is cached under
+        ``cache_folder`` and reused until the data changes.
+        """
+        if fmt not in self.FORMATS:
+            raise ValueError(f'Formato não suportado: {fmt}')
+
+        if data_version is not None:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            path = self.cache_path(fmt, query, params, data_version)
+            if not os.path.exists(path):
+                fd, tmp_path = tempfile.mkstemp(dir=self.cache_folder, suffix=f'.{fmt}.tmp')
+                os.close(fd)
+                try:
+                    self.write(fmt, tmp_path, query, params)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+            return self.stream_file(path)
+
+        if fmt == 'csv':
+            return self.stream_csv(query, params)
+        if fmt == 'parquet':
+            self._require_pyarrow()
+            return self.stream_parquet(query, params)
+
+        fd, tmp_path = tempfile.mkstemp(suffix=f'.{fmt}')
+        os.close(fd)
+        try:
+            self.write(fmt, tmp_path, query, params)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return self.stream_file(tmp_path, remove=True)
+
+    def prune_cache(self, data_version):
+        """Remove cached exports from older data versions"""
+        if not os.path.isdir(self.cache_folder):
+            return
+        suffix = f'-v{data_version}'
+        for name in os.listdir(self.cache_folder):
+            if name.endswith('.tmp'):
+                continue
+            if suffix + '.' not in name:
+                os.remove(os.path.join(self.cache_folder, name))
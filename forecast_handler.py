@@ -0,0 +1,493 @@
+import threading
+from datetime import date, datetime, timedelta
+
+
+class ForecastHandler:
+    """Recurring-payment detection and a daily cash-flow forecast.
+
+    Transactions are grouped into series: by counterparty document and
+    transaction type when there is a document, otherwise by the description
+    with digits and punctuation stripped (so "TARIFA PACOTE 0123" and
+    "TARIFA PACOTE 0456" fall together). Same-day rows of a series are
+    summed, and the day intervals between occurrences are summarized per
+    series in one groupby (count, median, mean, std). A series is recurring
+    when it has at least ``min_occurrences`` occurrences, a median interval
+    between 6 and 400 days, a low coefficient of variation and a last
+    occurrence no older than two periods.
+
+    The forecast starts the day after the last transaction (the end of the
+    imported statements) and, for each of the next ``horizon_days``, adds
+    the expected recurring inflows/outflows plus the average daily net of
+    the non-recurring transactions in the last ``baseline_days``.
+
+    Everything is computed per account. Results are cached in
+    ``recurring_series`` and ``forecast_days``;
+    ``app_metadata.forecast_data_version:<account_id>`` records the
+    account's data_version they were computed for, so a write to one
+    account never stales the others. Writers record the series their rows
+    belong to with ``touch``, in their own commit
+    (``forecast_pending_series``); ``update`` (after an import) and
+    ``catch_up`` (after reclassification, or when a stale cache is read)
+    re-detect only the pending series and clear them. ``refresh`` recomputes
+    the whole account only when there is no cache. All of them run off the
+    request path.
+
+    ``forecast`` reads the cache tables through ``get_connection``;
+    ``history_connection(start_date=None, end_date=None)`` must behave like
+    PartitionHandler.connect, so archived years count in the balance, and is
+    only used by the recomputations.
+    """
+
+    MIN_PERIOD = 6
+    MAX_PERIOD = 400
+    MAX_VARIATION = 0.35
+
+    def __init__(self, get_connection, horizon_days=60, history_days=5 * 365,
+                 baseline_days=90, min_occurrences=3, history_connection=None):
+        self.get_connection = get_connection
+        self.history_connection = history_connection or get_connection
+        self.horizon_days = horizon_days
+        self.history_days = history_days
+        self.baseline_days = baseline_days
+        self.min_occurrences = min_occurrences
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def version_key(account_id):
+        return f'forecast_data_version:{account_id}'
+
+    @staticmethod
+    def init_schema(cursor):
+        # Cache anterior às contas: descartado, é recalculado por conta na primeira consulta
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(recurring_series)')]
+        if columns and 'account_id' not in columns:
+            cursor.execute('DROP TABLE recurring_series')
+            cursor.execute('DROP TABLE IF EXISTS forecast_days')
+            cursor.execute("DELETE FROM app_metadata WHERE key = 'forecast_data_version'")
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS recurring_series (
+                account_id INTEGER NOT NULL,
+                series_key TEXT NOT NULL,
+                document TEXT,
+                pattern TEXT NOT NULL,
+                occurrences INTEGER NOT NULL,
+                period_days REAL NOT NULL,
+                variation REAL NOT NULL,
+                amount REAL NOT NULL,
+                last_date DATE NOT NULL,
+                next_date DATE NOT NULL,
+                updated_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (account_id, series_key)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS forecast_days (
+                account_id INTEGER NOT NULL,
+                date DATE NOT NULL,
+                inflow REAL NOT NULL,
+                outflow REAL NOT NULL,
+                baseline REAL NOT NULL,
+                balance REAL NOT NULL,
+                PRIMARY KEY (account_id, date)
+            )
+        ''')
+        # Séries a redetectar: gravadas por quem altera as linhas, na mesma transação
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS forecast_pending_series (
+                account_id INTEGER NOT NULL,
+                series_key TEXT NOT NULL,
+                document TEXT NOT NULL,
+                transaction_type TEXT NOT NULL,
+                PRIMARY KEY (account_id, series_key, transaction_type)
+            )
+        ''')
+
+    @classmethod
+    def touch(cls, conn, account_id, descriptions, documents, transaction_types):
+        """Records the series of changed rows as pending; runs in the writer's transaction"""
+        touched = cls._touched(descriptions, documents, transaction_types)
+        conn.executemany('''
+            INSERT OR IGNORE INTO main.forecast_pending_series (account_id, series_key, document, transaction_type)
+            VALUES (?, ?, ?, ?)
+        ''', zip([account_id] * len(touched), touched['series_key'].tolist(), touched['document'].tolist(),
+                 touched['transaction_type'].tolist()))
+
+    @classmethod
+    def _touched(cls, descriptions, documents, transaction_types):
+        import pandas as pd
+
+        frame = cls.series_keys(pd.DataFrame({
+            'description': list(descriptions), 'document': list(documents), 'transaction_type': list(transaction_types)
+        }, dtype=object))
+        frame['transaction_type'] = frame['transaction_type'].fillna('')
+        return frame[['series_key', 'document', 'transaction_type']].drop_duplicates()
+
+    def _pending(self, conn, account_id):
+        import pandas as pd
+
+        return pd.read_sql_query('''
+            SELECT series_key, document, transaction_type FROM main.forecast_pending_series WHERE account_id = ?
+        ''', conn, params=(account_id,))
+
+    @staticmethod
+    def series_keys(frame):
+        """Adds pattern, series_key and an integer series_code to a frame with description, document and transaction_type"""
+        import numpy as np
+        import pandas as pd
+
+        document = frame['document'].fillna('').astype(str)
+        has_document = (document != '').to_numpy()
+        # Normaliza só as descrições distintas sem documento
+        codes, uniques = pd.factorize(frame['description'].where(~has_document, ''))
+        normalized = (
+            pd.Series(uniques, dtype=object).str.upper()
+            .str.replace(r'[\d\W_]+', ' ', regex=True)
+            .str.strip()
+        )
+        pattern = np.where(has_document, frame['transaction_type'].fillna('').to_numpy(dtype=object),
+                           normalized.to_numpy()[codes])
+
+        # Código inteiro por (documento, padrão); as strings da chave só são montadas por série
+        document_codes, documents = pd.factorize(document)
+        pattern_codes, patterns = pd.factorize(pattern)
+        series_code, pairs = pd.factorize(document_codes.astype('int64') * (len(patterns) + 1) + pattern_codes)
+        keys = np.array([f'{documents[pair // (len(patterns) + 1)]}|{patterns[pair % (len(patterns) + 1)]}'
+                         for pair in pairs], dtype=object)
+        return frame.assign(document=document, pattern=pattern,
+                            series_code=series_code, series_key=keys[series_code])
+
+    # A descrição só entra na chave das transações sem documento
+    COLUMNS = '''
+        date, CASE WHEN document IS NULL OR document = '' THEN description END, value, document, transaction_type
+    '''
+
+    def _load(self, conn, query, params):
+        import pandas as pd
+
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        return pd.DataFrame.from_records(
+            cursor.execute(query, params).fetchall(),
+            columns=['date', 'description', 'value', 'document', 'transaction_type']
+        )
+
+    def detect(self, frame, reference):
+        """Recurring series of a frame returned by series_keys (with date and value)"""
+        import numpy as np
+        import pandas as pd
+
+        columns = ['series_key', 'document', 'pattern', 'occurrences', 'period_days',
+                   'variation', 'amount', 'last_date', 'next_date']
+        if frame.empty:
+            return pd.DataFrame(columns=columns)
+
+        code = frame['series_code'].to_numpy()
+        day = pd.to_datetime(frame['date']).to_numpy().astype('datetime64[D]').astype('int64')
+        value = frame['value'].to_numpy(dtype=float)
+
+        # Ordena por série e dia e soma as linhas do mesmo dia
+        order = np.lexsort((day, code))
+        code, day, value = code[order], day[order], value[order]
+        starts = np.flatnonzero(np.r_[True, (code[1:] != code[:-1]) | (day[1:] != day[:-1])])
+        code, day, value = code[starts], day[starts], np.add.reduceat(value, starts)
+        first = np.r_[True, code[1:] != code[:-1]]
+        interval = np.where(first, np.nan, np.r_[0, np.diff(day)])
+
+        days = pd.DataFrame({'code': code, 'day': day, 'value': value, 'interval': interval})
+        grouped = days.groupby('code', sort=False)
+        stats = grouped.agg(
+            occurrences=('day', 'size'),
+            last_day=('day', 'max'),
+            period_days=('interval', 'median'),
+            mean_interval=('interval', 'mean'),
+            std_interval=('interval', 'std')
+        )
+        stats['variation'] = (stats['std_interval'].fillna(0) / stats['mean_interval']).fillna(np.inf)
+        stats = stats[
+            (stats['occurrences'] >= self.min_occurrences)
+            & stats['period_days'].between(self.MIN_PERIOD, self.MAX_PERIOD)
+            & (stats['variation'] <= self.MAX_VARIATION)
+        ]
+        recent = days[days['code'].isin(stats.index)].groupby('code', sort=False).tail(3)
+        stats = stats.assign(
+            amount=recent.groupby('code')['value'].median(),
+            last_date=pd.to_datetime(stats['last_day'], unit='D')
+        )
+
+        names = frame.drop_duplicates('series_code').set_index('series_code')[['series_key', 'document', 'pattern']]
+        recurring = stats.join(names).reset_index(drop=True)
+        return self.schedule(recurring, reference)[columns]
+
+    @staticmethod
+    def schedule(series, reference):
+        """Drops series silent for over two periods and sets next_date after ``reference``"""
+        import numpy as np
+        import pandas as pd
+
+        reference = pd.Timestamp(reference)
+        elapsed = (reference - series['last_date']).dt.days
+        series = series[elapsed <= 2 * series['period_days']].copy()
+
+        # Próxima ocorrência depois da data de referência (pula as atrasadas)
+        period = series['period_days'].round().clip(lower=1)
+        steps = np.floor(elapsed[series.index] / period) + 1
+        series['next_date'] = series['last_date'] + pd.to_timedelta(steps * period, unit='D')
+        return series.reset_index(drop=True)
+
+    def project(self, conn, account_id, series, reference, baseline):
+        """Daily forecast frame (date, inflow, outflow, baseline, balance)"""
+        import numpy as np
+        import pandas as pd
+
+        start = pd.Timestamp(reference) + pd.Timedelta(days=1)
+        index = pd.date_range(start, periods=self.horizon_days, freq='D')
+        forecast = pd.DataFrame({'inflow': 0.0, 'outflow': 0.0}, index=index)
+
+        if not series.empty:
+            period = series['period_days'].round().clip(lower=1).to_numpy().astype('int64')
+            offsets = (pd.to_datetime(series['next_date']) - start).dt.days.to_numpy()
+            # Ocorrências de todas as séries no horizonte de uma vez: k-ésima = offset + k * período
+            repeats = np.maximum(0, (self.horizon_days - 1 - offsets) // period + 1)
+            series_index = np.repeat(np.arange(len(series)), repeats)
+            k = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+            day = offsets[series_index] + k * period[series_index]
+            amount = series['amount'].to_numpy()[series_index]
+            forecast['inflow'] = np.bincount(day, weights=np.where(amount > 0, amount, 0), minlength=self.horizon_days)
+            forecast['outflow'] = np.bincount(day, weights=np.where(amount < 0, amount, 0), minlength=self.horizon_days)
+
+        forecast['baseline'] = baseline
+        start_balance = conn.execute('SELECT COALESCE(SUM(value), 0) FROM transactions WHERE account_id = ?',
+                                     (account_id,)).fetchone()[0]
+        forecast['balance'] = start_balance + (forecast['inflow'] + forecast['outflow'] + forecast['baseline']).cumsum()
+        return forecast.rename_axis('date').reset_index()
+
+    def _baseline(self, conn, account_id, reference, series_keys):
+        """Average daily net of the non-recurring transactions in the last baseline_days"""
+        since = (reference - timedelta(days=self.baseline_days - 1)).isoformat()
+        recent = self.series_keys(self._load(conn, f'''
+            SELECT {self.COLUMNS} FROM transactions WHERE account_id = ? AND date >= ?
+        ''', [account_id, since]))
+        other = recent[~recent['series_key'].isin(series_keys)]
+        return float(other['value'].sum()) / self.baseline_days
+
+    def _reference(self, conn, account_id):
+        last = conn.execute('SELECT MAX(date) FROM transactions WHERE account_id = ?', (account_id,)).fetchone()[0]
+        return date.fromisoformat(str(last)[:10]) if last else None
+
+    def _save(self, conn, account_id, series, forecast, data_version):
+        # Poucas centenas de séries: regravar tudo é mais simples que conciliar as removidas
+        now = datetime.now().isoformat(' ')
+        conn.execute('DELETE FROM recurring_series WHERE account_id = ?', (account_id,))
+        conn.executemany('''
+            INSERT INTO recurring_series
+                (account_id, series_key, document, pattern, occurrences, period_days, variation, amount,
+                 last_date, next_date, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', zip(
+            [account_id] * len(series),
+            series['series_key'].tolist(),
+            [d or None for d in series['document'].tolist()],
+            series['pattern'].tolist(),
+            series['occurrences'].astype(int).tolist(),
+            series['period_days'].astype(float).tolist(),
+            series['variation'].astype(float).tolist(),
+            series['amount'].astype(float).tolist(),
+            [d.strftime('%Y-%m-%d') for d in series['last_date']],
+            [d.strftime('%Y-%m-%d') for d in series['next_date']],
+            [now] * len(series)
+        ))
+        conn.execute('DELETE FROM forecast_days WHERE account_id = ?', (account_id,))
+        conn.executemany('''
+            INSERT INTO forecast_days (account_id, date, inflow, outflow, baseline, balance)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', zip(
+            [account_id] * len(forecast),
+            forecast['date'].dt.strftime('%Y-%m-%d').tolist(),
+            forecast['inflow'].tolist(),
+            forecast['outflow'].tolist(),
+            forecast['baseline'].tolist(),
+            forecast['balance'].tolist()
+        ))
+        self._save_version(conn, account_id, data_version)
+
+    def _save_version(self, conn, account_id, data_version):
+        conn.execute('''
+            INSERT INTO main.app_metadata (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (self.version_key(account_id), str(data_version)))
+
+    def _cached_series(self, conn, account_id):
+        import pandas as pd
+
+        frame = pd.read_sql_query('SELECT * FROM recurring_series WHERE account_id = ?', conn,
+                                  params=(account_id,)).drop(columns='account_id')
+        frame['document'] = frame['document'].fillna('')
+        frame['last_date'] = pd.to_datetime(frame['last_date'])
+        frame['next_date'] = pd.to_datetime(frame['next_date'])
+        return frame
+
+    def refresh(self, account_id, data_version):
+        """Recomputes every series and the forecast of an account from the last history_days"""
+        conn = self.history_connection()
+        try:
+            reference = self._reference(conn, account_id)
+            if reference is None:
+                # Conta sem transações: registra a versão para não recalcular a cada consulta
+                self._save_version(conn, account_id, data_version)
+                conn.commit()
+                return 0
+            since = (reference - timedelta(days=self.history_days)).isoformat()
+            # Faixa (account_id, date) do índice: só as linhas da conta são lidas
+            history = self.series_keys(self._load(conn, f'''
+                SELECT {self.COLUMNS} FROM transactions WHERE account_id = ? AND date >= ?
+            ''', [account_id, since]))
+            series = self.detect(history, reference)
+            forecast = self.project(conn, account_id, series, reference,
+                                    self._baseline(conn, account_id, reference, series['series_key']))
+            self._save(conn, account_id, series, forecast, data_version)
+            conn.execute('DELETE FROM main.forecast_pending_series WHERE account_id = ?', (account_id,))
+            conn.commit()
+            return len(series)
+        finally:
+            conn.close()
+
+    def update(self, account_id, descriptions, documents, transaction_types, data_version):
+        """Incremental refresh after an import: only the series of the imported rows are re-detected"""
+        touched = self._touched(descriptions, documents, transaction_types)
+        with self.lock:
+            return self._update(account_id, touched, data_version)
+
+    def _update(self, account_id, touched, data_version):
+        import pandas as pd
+
+        conn = self.history_connection()
+        try:
+            reference = self._reference(conn, account_id)
+            has_cache = conn.execute('SELECT 1 FROM app_metadata WHERE key = ?', (self.version_key(account_id),)).fetchone()
+            if reference is None or not has_cache:
+                conn.close()
+                conn = None
+                return self.refresh(account_id, data_version)
+
+            since = (reference - timedelta(days=self.history_days)).isoformat()
+            cached = self._cached_series(conn, account_id)
+            # Uma linha que mudou de tipo foi registrada com o tipo antigo e o novo:
+            # as duas séries documento|tipo estão em touched
+            keys = set(touched['series_key'])
+            has_document = touched['document'] != ''
+            documents = sorted(set(touched.loc[has_document, 'document']))
+            document_types = sorted(set(touched.loc[has_document, 'transaction_type']))
+            types = sorted(set(touched.loc[~has_document, 'transaction_type']))
+            # Histórico só das séries afetadas: com documento pelo índice (account_id, document),
+            # já somado por dia como em detect; sem documento, pelo tipo
+            frames = []
+            if documents:
+                frames.append(self._load(conn, f'''
+                    SELECT date, NULL, SUM(value), document, transaction_type
+                    FROM transactions
+                    WHERE account_id = ? AND document IN ({', '.join('?' for _ in documents)})
+                      AND transaction_type IN ({', '.join('?' for _ in document_types)}) AND date >= ?
+                    GROUP BY document, transaction_type, date
+                ''', [account_id] + documents + document_types + [since]))
+            if types:
+                frames.append(self._load(conn, f'''
+                    SELECT {self.COLUMNS}
+                    FROM transactions
+                    WHERE account_id = ? AND date >= ? AND (document IS NULL OR document = '')
+                      AND transaction_type IN ({', '.join('?' for _ in types)})
+                ''', [account_id, since] + types))
+            history = self.series_keys(pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+                columns=['date', 'description', 'value', 'document', 'transaction_type']))
+            history = history[history['series_key'].isin(keys)]
+
+            changed = self.detect(history, reference)
+            # As demais séries só são reagendadas para a nova data de referência
+            # (o quadro vazio de detect tem colunas object: fica de fora do concat)
+            series = pd.concat([self.schedule(cached[~cached['series_key'].isin(keys)], reference)]
+                               + ([changed] if not changed.empty else []), ignore_index=True)
+            forecast = self.project(conn, account_id, series, reference,
+                                    self._baseline(conn, account_id, reference, series['series_key']))
+            self._save(conn, account_id, series, forecast, data_version)
+            conn.executemany('DELETE FROM main.forecast_pending_series WHERE account_id = ? AND series_key = ?',
+                             ((account_id, key) for key in sorted(set(touched['series_key']))))
+            conn.commit()
+            return len(changed)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def catch_up(self, account_id, data_version):
+        """Brings the cache up to ``data_version``: the pending series, or everything when there is no cache"""
+        with self.lock:
+            return self._catch_up(account_id, data_version)
+
+    def _catch_up(self, account_id, data_version):
+        conn = self.get_connection()
+        try:
+            has_cache = conn.execute('SELECT 1 FROM app_metadata WHERE key = ?', (self.version_key(account_id),)).fetchone()
+            pending = self._pending(conn, account_id)
+            if has_cache and pending.empty:
+                # Nada a redetectar (nomes de CNPJ, por exemplo): as séries continuam valendo
+                self._save_version(conn, account_id, data_version)
+                conn.commit()
+                return 0
+        finally:
+            conn.close()
+        if not has_cache:
+            return self.refresh(account_id, data_version)
+        return self._update(account_id, pending, data_version)
+
+    def _refresh_in_background(self, account_id, data_version):
+        if not self.lock.acquire(blocking=False):
+            return  # já existe um recálculo em andamento
+        def run():
+            try:
+                self._catch_up(account_id, data_version)
+            except Exception as e:
+                print(f"Error refreshing forecast: {str(e)}")
+            finally:
+                self.lock.release()
+        threading.Thread(target=run, daemon=True).start()
+
+    def forecast(self, account_id, data_version):
+        """Cached forecast and recurring series of an account.
+
+        When the account's data changed since the cache was computed
+        (reclassification, CNPJ retries), the cached result is returned with
+        ``stale`` set and ``catch_up`` runs in the background. With no cache
+        yet the full refresh also runs in the background and an empty result
+        is returned with ``pending`` set. Only the cache tables are read here.
+        """
+        conn = self.get_connection()
+        try:
+            row = conn.execute('SELECT value FROM app_metadata WHERE key = ?', (self.version_key(account_id),)).fetchone()
+        finally:
+            conn.close()
+        stale = bool(row) and row[0] != str(data_version)
+        if not row or stale:
+            self._refresh_in_background(account_id, data_version)
+
+        conn = self.get_connection()
+        try:
+            days = conn.execute('''
+                SELECT date, inflow, outflow, baseline, balance FROM forecast_days
+                WHERE account_id = ?
+                ORDER BY date
+            ''', (account_id,)).fetchall()
+            series = conn.execute('''
+                SELECT s.series_key, s.document, s.pattern, s.occurrences, s.period_days, s.variation,
+                       s.amount, s.last_date, s.next_date, c.name
+                FROM recurring_series s
+                LEFT JOIN counterparties c ON c.account_id = s.account_id AND c.document = s.document
+                WHERE s.account_id = ?
+                ORDER BY ABS(s.amount * 30 / s.period_days) DESC
+            ''', (account_id,)).fetchall()
+            return {
+                'days': [dict(day) for day in days],
+                'recurring': [dict(item) for item in series],
+                'stale': stale,
+                'pending': not row
+            }
+        finally:
+            conn.close()
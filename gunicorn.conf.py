@@ -0,0 +1,17 @@
+import os
+
+
+def on_starting(server):
+    # Cria/migra o schema uma única vez no master, antes dos workers subirem.
+    # Os workers herdam DB_INITIALIZED e pulam o init_db (ver app.ensure_db).
+    from app import init_db
+
+    init_db()
+    os.environ['DB_INITIALIZED'] = '1'
+
+
+def post_worker_init(worker):
+    # Threads não sobrevivem ao fork: cada worker inicia o seu agendador de manutenção
+    from app import start_maintenance
+
+    start_maintenance()
@@ -0,0 +1,210 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+
+class ImportHandler:
+    """Streams uploads to disk and remembers every imported file by SHA-256.
+
+    ``save`` copies the uploaded stream in fixed-size chunks to a unique
+    temporary path inside ``folder`` while hashing it, so neither concurrent
+    uploads with the same name nor large files are a problem. ``begin``
+    registers the hash in ``imports``; a file that was already imported (or
+    is being imported right now) into the same account returns the existing
+    record instead, and the caller skips the processing. The hash is unique
+    per account: the same file uploaded to another account (or by another
+    tenant) is a separate import and never sees the other one's record.
+
+    The progress of an import in flight lives in its row too (``report``
+    writes current/total/message and a heartbeat in ``updated_at``), so any
+    worker can answer the progress polls. The importer reports on a time
+    interval as well as per row count, so a live import never goes
+    ``stale_minutes`` without a heartbeat; an import that did belonged to a
+    worker that died: ``begin`` lets the same file be imported again instead
+    of pointing at it. ``report`` and ``finish`` are keyed by process_id, so
+    a late thread only ever touches its own record.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, get_connection, folder='uploads', stale_minutes=15):
+        self.get_connection = get_connection
+        self.folder = folder
+        self.stale_minutes = stale_minutes
+
+    @staticmethod
+    def init_schema(cursor):
+        # Antes o sha256 era único no banco todo: a tabela é recriada com a chave por conta
+        legacy = cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'imports'"
+        ).fetchone()
+        if legacy and 'UNIQUE (account_id, sha256)' not in legacy[0]:
+            cursor.execute('DROP TABLE IF EXISTS imports_legacy')
+            cursor.execute('ALTER TABLE imports RENAME TO imports_legacy')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS imports (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                account_id INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                process_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                row_count INTEGER,
+                message TEXT,
+                created_at TIMESTAMP NOT NULL,
+                finished_at TIMESTAMP,
+                current INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP,
+                UNIQUE (account_id, sha256)
+            )
+        ''')
+        # Colunas de progresso de tabelas criadas antes delas
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(imports)')]
+        for column, definition in [('current', 'INTEGER NOT NULL DEFAULT 0'),
+                                   ('total', 'INTEGER NOT NULL DEFAULT 0'),
+                                   ('updated_at', 'TIMESTAMP')]:
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE imports ADD COLUMN {column} {definition}')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_imports_process_id ON imports(process_id)')
+        if legacy and 'UNIQUE (account_id, sha256)' not in legacy[0]:
+            legacy_columns = [row[1] for row in cursor.execute('PRAGMA table_info(imports_legacy)')]
+            # Importações anteriores às contas pertencem à conta padrão (a primeira criada)
+            account = 'account_id' if 'account_id' in legacy_columns else 'NULL'
+            cursor.execute(f'''
+                INSERT INTO imports (id, account_id, sha256, filename, size, process_id, status,
+                                     row_count, message, created_at, finished_at)
+                SELECT id, COALESCE({account}, (SELECT MIN(id) FROM accounts)), sha256, filename, size,
+                       process_id, status, row_count, message, created_at, finished_at
+                FROM imports_legacy
+            ''')
+            cursor.execute('DROP TABLE imports_legacy')
+
+    def save(self, stream, suffix=''):
+        """Writes a file-like object to a unique path; returns (path, sha256, size)"""
+        os.makedirs(self.folder, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path, digest.hexdigest(), size
+
+    @property
+    def stale_before(self):
+        return datetime.now() - timedelta(minutes=self.stale_minutes)
+
+    def begin(self, account_id, sha256, filename, size, process_id):
+        """Registers a new import into an account; returns (True, None) or (False, previous import)"""
+        now = datetime.now()
+        conn = self.get_connection()
+        try:
+            # Uma importação que falhou, ou cujo worker morreu no meio, pode ser refeita com o mesmo arquivo
+            conn.execute('''
+                DELETE FROM imports WHERE account_id = ? AND sha256 = ?
+                AND (status = 'error' OR (status = 'processing' AND COALESCE(updated_at, created_at) < ?))
+            ''', (account_id, sha256, self.stale_before))
+            try:
+                conn.execute('''
+                    INSERT INTO imports (sha256, account_id, filename, size, process_id, status, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, 'processing', ?, ?)
+                ''', (sha256, account_id, filename, size, process_id, now, now))
+            except sqlite3.IntegrityError:
+                # Mesmo arquivo já importado ou sendo importado por outra requisição
+                conn.rollback()
+                row = conn.execute('SELECT * FROM imports WHERE account_id = ? AND sha256 = ?',
+                                   (account_id, sha256)).fetchone()
+                return False, dict(row)
+            conn.commit()
+            return True, None
+        finally:
+            conn.close()
+
+    def report(self, process_id, current=None, total=None, message=None):
+        """Records the progress of an import in flight (and its heartbeat)"""
+        conn = self.get_connection()
+        try:
+            conn.execute('''
+                UPDATE imports SET current = COALESCE(?, current), total = COALESCE(?, total),
+                                   message = COALESCE(?, message), updated_at = ?
+                WHERE process_id = ? AND status = 'processing'
+            ''', (current, total, message, datetime.now(), process_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def progress(self, tenant_id, process_id):
+        """Status, current, total and message of one of the tenant's imports, or None"""
+        conn = self.get_connection()
+        try:
+            row = conn.execute('''
+                SELECT i.status, i.current, i.total, i.message, i.row_count, i.account_id
+                FROM imports i
+                JOIN accounts a ON a.id = i.account_id
+                WHERE i.process_id = ? AND a.tenant_id = ?
+            ''', (process_id, tenant_id)).fetchone()
+            return dict(row) if row else None
+        finally:
+            conn.close()
+
+    def finish(self, process_id, status, row_count=None, message=None):
+        """Records the outcome of an import.
+
+        Keyed by ``process_id``: a thread that outlived its heartbeat (and
+        whose file was imported again) never overwrites the newer import.
+        """
+        now = datetime.now()
+        conn = self.get_connection()
+        try:
+            conn.execute('''
+                UPDATE imports SET status = ?, row_count = ?, message = ?, finished_at = ?, updated_at = ?,
+                                   current = CASE WHEN ? = 'completed' THEN total ELSE current END
+                WHERE process_id = ?
+            ''', (status, row_count, message, now, now, status, process_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def prune(self, error_days=30):
+        """Cleans up after failed and interrupted imports; returns the counts per kind.
+
+        An import still 'processing' with no progress for ``stale_minutes``
+        belonged to a worker that died: it is marked as an error. Error
+        records older than ``error_days`` are deleted, and so are leftover
+        upload files older than a stale import (processed files are removed
+        as soon as the import ends).
+        """
+        now = datetime.now()
+        stale = self.stale_before
+        conn = self.get_connection()
+        try:
+            interrupted = conn.execute('''
+                UPDATE imports SET status = 'error', message = 'Importação interrompida', finished_at = ?
+                WHERE status = 'processing' AND COALESCE(updated_at, created_at) < ?
+            ''', (now, stale)).rowcount
+            deleted = conn.execute("DELETE FROM imports WHERE status = 'error' AND created_at < ?",
+                                   (now - timedelta(days=error_days),)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+
+        files = 0
+        if os.path.isdir(self.folder):
+            for entry in os.scandir(self.folder):
+                if entry.is_file() and entry.stat().st_mtime < stale.timestamp():
+                    os.remove(entry.path)
+                    files += 1
+        return {'interrupted': interrupted, 'deleted': deleted, 'files': files}
@@ -0,0 +1,345 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+
+class MaintenanceHandler:
+    """Periodic maintenance jobs, run by one process at a time.
+
+    Jobs are registered with an interval (``register``). The built-in ones
+    keep the SQLite file healthy: ``optimize`` (PRAGMA optimize, which
+    re-analyzes only the tables whose statistics drifted), ``analyze`` (a
+    full ANALYZE) and ``vacuum`` (returns free pages to the file system with
+    incremental vacuum and truncates the WAL). Converting a database created
+    without auto_vacuum takes a full VACUUM, which rewrites the file and
+    blocks writers, so it is never scheduled: an operator runs ``convert``
+    (``python maintenance_handler.py convert``) in a quiet window.
+
+    Every gunicorn worker runs a scheduler thread (``start``), but jobs only
+    run under the lease in ``maintenance_locks``: a row claimed with a
+    conditional upsert that lapses by itself if its holder dies, so a single
+    worker runs maintenance at a time and another takes over when it goes
+    away. Whether a job is due is decided from ``maintenance_runs``, the run
+    history shared by all workers, which also records the outcome, timing
+    and details of every run.
+    """
+
+    LOCK_NAME = 'maintenance'
+
+    def __init__(self, get_connection, tick_seconds=60, lease_seconds=3600, vacuum_pages=25000, history_days=90):
+        self.get_connection = get_connection
+        self.tick_seconds = tick_seconds
+        self.lease_seconds = lease_seconds
+        self.vacuum_pages = vacuum_pages
+        self.history_days = history_days
+        self.jobs = {}
+        self.token = uuid.uuid4().hex[:8]
+        # A concessão é por processo: o lock evita que o agendador e um "executar agora" rodem juntos
+        self.lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.register('optimize', 3600, self.optimize)
+        self.register('analyze', 24 * 3600, self.analyze)
+        self.register('vacuum', 24 * 3600, self.vacuum)
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job TEXT NOT NULL,
+                status TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                started_at TIMESTAMP NOT NULL,
+                finished_at TIMESTAMP,
+                duration_ms REAL,
+                detail TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_maintenance_runs_job ON maintenance_runs(job, started_at)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_locks (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at TIMESTAMP NOT NULL
+            )
+        ''')
+
+    @property
+    def owner(self):
+        # O pid muda no fork dos workers; o token distingue processos com o mesmo pid
+        return f'{os.getpid()}-{self.token}'
+
+    @property
+    def running(self):
+        return self.lock.locked()
+
+    def register(self, name, interval_seconds, func):
+        """Adds a job; ``func()`` returns a JSON-serializable dict stored as the run detail"""
+        self.jobs[name] = {'interval': interval_seconds, 'func': func}
+
+    def acquire(self):
+        """Claims (or renews) the lease; True if this process holds it"""
+        now = datetime.now()
+        conn = self.get_connection()
+        try:
+            acquired = conn.execute('''
+                INSERT INTO maintenance_locks (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE maintenance_locks.owner = excluded.owner OR maintenance_locks.expires_at < ?
+            ''', (self.LOCK_NAME, self.owner, now + timedelta(seconds=self.lease_seconds), now)).rowcount
+            conn.commit()
+            return bool(acquired)
+        finally:
+            conn.close()
+
+    def release(self):
+        conn = self.get_connection()
+        try:
+            conn.execute('DELETE FROM maintenance_locks WHERE name = ? AND owner = ?', (self.LOCK_NAME, self.owner))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _last_runs(self, conn):
+        rows = conn.execute('''
+            SELECT r.* FROM maintenance_runs r
+            JOIN (SELECT job, MAX(id) AS id FROM maintenance_runs GROUP BY job) last ON last.id = r.id
+        ''').fetchall()
+        return {row['job']: dict(row) for row in rows}
+
+    def due(self):
+        """Names of the jobs whose interval has elapsed since their last run (of any outcome)"""
+        now = datetime.now()
+        conn = self.get_connection()
+        try:
+            last = self._last_runs(conn)
+        finally:
+            conn.close()
+        return [name for name, job in self.jobs.items()
+                if name not in last
+                or datetime.fromisoformat(last[name]['started_at']) + timedelta(seconds=job['interval']) <= now]
+
+    def run_job(self, name, func=None):
+        """Runs one job (the caller holds the lease) and records it; returns the run"""
+        func = func or self.jobs[name]['func']
+        conn = self.get_connection()
+        try:
+            run_id = conn.execute('''
+                INSERT INTO maintenance_runs (job, status, owner, started_at) VALUES (?, 'running', ?, ?)
+            ''', (name, self.owner, datetime.now())).lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+
+        started = time.perf_counter()
+        try:
+            status, detail = 'ok', func() or {}
+        except Exception as e:
+            print(f"Error running maintenance job {name}: {str(e)}")
+            status, detail = 'error', {'error': str(e)}
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+
+        conn = self.get_connection()
+        try:
+            conn.execute('''
+                UPDATE maintenance_runs SET status = ?, finished_at = ?, duration_ms = ?, detail = ?
+                WHERE id = ?
+            ''', (status, datetime.now(), duration_ms, json.dumps(detail), run_id))
+            conn.commit()
+        finally:
+            conn.close()
+        return {'id': run_id, 'job': name, 'status': status, 'duration_ms': duration_ms, 'detail': detail}
+
+    def run_pending(self):
+        """Runs every due job if this process gets the lease; returns the runs"""
+        if not self.lock.acquire(blocking=False):
+            return []
+        runs = []
+        try:
+            if not self.acquire():
+                return []
+            try:
+                for name in self.due():
+                    runs.append(self.run_job(name))
+                    # Renova a concessão entre jobs longos
+                    self.acquire()
+            finally:
+                self.release()
+        finally:
+            self.lock.release()
+        return runs
+
+    def run_now(self, name):
+        """Runs a job immediately; RuntimeError if another process holds the lease"""
+        if name not in self.jobs:
+            raise KeyError(name)
+        return self._run_exclusive(name, self.jobs[name]['func'])
+
+    def _run_exclusive(self, name, func):
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError('Manutenção já em andamento')
+        try:
+            if not self.acquire():
+                raise RuntimeError('Manutenção em andamento em outro processo')
+            try:
+                return self.run_job(name, func)
+            finally:
+                self.release()
+        finally:
+            self.lock.release()
+
+    def start(self):
+        """Starts this process's scheduler thread (once); call after forking"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        def loop():
+            # Intervalo com variação aleatória: os workers não disputam a concessão ao mesmo tempo
+            while not self._stop.wait(self.tick_seconds * random.uniform(0.8, 1.2)):
+                try:
+                    self.run_pending()
+                except Exception as e:
+                    print(f"Error in maintenance scheduler: {str(e)}")
+
+        self._thread = threading.Thread(target=loop, daemon=True, name='maintenance')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self, limit=50):
+        """Jobs with their last run and next due time, the lease holder and the recent runs"""
+        conn = self.get_connection()
+        try:
+            last = self._last_runs(conn)
+            lock = conn.execute('SELECT owner, expires_at FROM maintenance_locks WHERE name = ?',
+                                (self.LOCK_NAME,)).fetchone()
+            runs = [dict(row) for row in conn.execute('''
+                SELECT id, job, status, owner, started_at, finished_at, duration_ms, detail
+                FROM maintenance_runs ORDER BY id DESC LIMIT ?
+            ''', (limit,))]
+        finally:
+            conn.close()
+
+        jobs = []
+        for name, job in self.jobs.items():
+            run = last.get(name)
+            next_due = None
+            if run:
+                next_due = str(datetime.fromisoformat(run['started_at']) + timedelta(seconds=job['interval']))
+            jobs.append({
+                'job': name,
+                'interval_seconds': job['interval'],
+                'last_status': run and run['status'],
+                'last_started_at': run and run['started_at'],
+                'last_duration_ms': run and run['duration_ms'],
+                'last_detail': json.loads(run['detail']) if run and run['detail'] else None,
+                'next_due': next_due
+            })
+        for run in runs:
+            run['detail'] = json.loads(run['detail']) if run['detail'] else None
+        return {'jobs': jobs, 'lock': dict(lock) if lock else None, 'runs': runs}
+
+    def optimize(self):
+        conn = self.get_connection()
+        try:
+            conn.execute('PRAGMA optimize')
+        finally:
+            conn.close()
+        return {}
+
+    def analyze(self):
+        conn = self.get_connection()
+        try:
+            conn.execute('ANALYZE')
+            conn.commit()
+        finally:
+            conn.close()
+        return {}
+
+    def vacuum(self):
+        """Frees up to ``vacuum_pages`` pages and truncates the WAL.
+
+        On a database still without incremental auto_vacuum the pragma frees
+        nothing; the run reports ``needs_conversion`` until ``convert`` is run.
+        """
+        conn = self.get_connection()
+        try:
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            # 2 = INCREMENTAL
+            needs_conversion = conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2
+            if not needs_conversion:
+                # executescript roda o pragma até o fim; execute() libera uma página por passo
+                conn.executescript(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)});')
+            free_after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        finally:
+            conn.close()
+        return {
+            'needs_conversion': needs_conversion,
+            'freed_mb': round((free_before - free_after) * page_size / 1024 / 1024, 1),
+            'free_pages': free_after
+        }
+
+    def convert(self):
+        """Enables incremental auto_vacuum on an existing database (full VACUUM), under the lease.
+
+        Recorded in the run history as ``convert``; RuntimeError if another
+        process holds the lease.
+        """
+        return self._run_exclusive('convert', self._convert)
+
+    def _convert(self):
+        conn = self.get_connection()
+        try:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                return {'converted': False}
+            size_before = conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+            size_after = conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        finally:
+            conn.close()
+        return {'converted': True, 'freed_mb': round((size_before - size_after) / 1024 / 1024, 1)}
+
+    def prune(self):
+        """Deletes runs older than ``history_days``; returns how many"""
+        conn = self.get_connection()
+        try:
+            removed = conn.execute('DELETE FROM maintenance_runs WHERE started_at < ?',
+                                   (datetime.now() - timedelta(days=self.history_days),)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        return removed
+
+
+def main():
+    from app import init_db, maintenance_handler
+
+    parser = argparse.ArgumentParser(description='Manutenção do banco de dados')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('convert', help='Ativa o auto_vacuum incremental com um VACUUM completo')
+    run = subparsers.add_parser('run', help='Executa uma tarefa agora')
+    run.add_argument('job', choices=sorted(maintenance_handler.jobs))
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == 'convert':
+        run = maintenance_handler.convert()
+    else:
+        run = maintenance_handler.run_now(args.job)
+    print(f"{run['job']}: {run['status']} em {run['duration_ms']:.0f} ms {json.dumps(run['detail'])}")
+    return 0 if run['status'] == 'ok' else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
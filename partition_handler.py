@@ -0,0 +1,440 @@
+import argparse
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from document_extractor import extract_documents
+
+
+class PartitionHandler:
+    """Year partitions for historical transactions.
+
+    The ``transactions`` table in the main database holds the hot data. Cold
+    years can be archived out of it, either into the shared archive database
+    (``storage='sqlite'``: ``archive.db`` in ``folder``, one table for every
+    archived year) or to a per-year zstd-compressed Parquet file
+    (``storage='parquet'``).
+
+    ``connect(start_date, end_date)`` returns a read connection where the
+    name ``transactions`` resolves to a TEMP view over the main table plus
+    the archive, so the existing queries work unchanged. A range that no
+    archived year overlaps never touches the archive; otherwise the archive
+    is attached once (one ATTACH however many years are archived, so
+    SQLite's limit of 10 attached databases is never reached) and queried in
+    place through its own indexes. A Parquet year is copied into the
+    archive's ``parquet_cache`` table the first time a query needs it and
+    read from there afterwards, instead of being reloaded per connection.
+    The copy is uncompressed and indexed like the archive, so a cached year
+    takes about as much disk as a year archived as SQLite; Parquet saves the
+    space only for the years no query has reached. ``uncache_year`` (the
+    ``uncache`` command) drops the copy, which is rebuilt on the next query.
+
+    Dates that are empty or not ISO dates (``YYYY-MM-DD``, ``YYYY-MM`` or
+    ``YYYY``) impose no bound: the range then covers every archived year.
+
+    Rows archived before accounts existed get the default account when they
+    are copied into the archive, so the account indexes apply to them too.
+    Write paths: reclassification covers the archive's ``transactions``
+    table as well; Parquet years are read-only and are reclassified once
+    restored. The counterparty and anomaly rebuilds read through
+    ``connect()``, so archived rows count in them.
+    """
+
+    STORAGES = ['sqlite', 'parquet']
+    ARCHIVE_FILE = 'archive.db'
+    # parquet_cache: cópia dos anos em Parquet já lidos, válida até o ano ser arquivado de novo ou restaurado
+    ARCHIVE_TABLES = ['transactions', 'parquet_cache']
+    ARCHIVE_INDEXES = {
+        'date': '(date)',
+        'account_date': '(account_id, date)',
+        'account_type': '(account_id, type)',
+        'account_document': '(account_id, document)',
+        'account_rule_version': '(account_id, rule_version)',
+    }
+
+    def __init__(self, get_connection, folder='instance/partitions'):
+        self.get_connection = get_connection
+        self.folder = folder
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS partitions (
+                year INTEGER PRIMARY KEY,
+                storage TEXT NOT NULL,
+                path TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                archived_at TIMESTAMP NOT NULL
+            )
+        ''')
+
+    @property
+    def archive_path(self):
+        return os.path.join(self.folder, self.ARCHIVE_FILE)
+
+    @staticmethod
+    def year_bounds(year):
+        return f'{year}-01-01', f'{year + 1}-01-01'
+
+    @staticmethod
+    def table_columns(conn, schema='main', table='transactions'):
+        return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info({table})')]
+
+    def list_partitions(self, conn=None):
+        own = conn is None
+        conn = conn or self.get_connection()
+        try:
+            return [dict(row) for row in conn.execute(
+                'SELECT year, storage, path, row_count, archived_at FROM partitions ORDER BY year'
+            )]
+        finally:
+            if own:
+                conn.close()
+
+    @staticmethod
+    def parse_date(value):
+        """The date prefix of value (YYYY-MM-DD, YYYY-MM or YYYY), or None when it is empty or invalid"""
+        text = str(value or '')[:10]
+        for fmt in ('%Y-%m-%d', '%Y-%m', '%Y'):
+            try:
+                datetime.strptime(text, fmt)
+                return text
+            except ValueError:
+                continue
+        return None
+
+    def partitions_for_range(self, conn, start_date=None, end_date=None):
+        """Archived partitions that can contain rows between start_date and end_date"""
+        query = 'SELECT year, storage, path FROM partitions WHERE 1 = 1'
+        params = []
+        # Data inválida não limita o intervalo: todas as partições daquele lado entram
+        start_date = self.parse_date(start_date)
+        end_date = self.parse_date(end_date)
+        if start_date:
+            query += ' AND year >= ?'
+            params.append(int(start_date[:4]))
+        if end_date:
+            query += ' AND year <= ?'
+            params.append(int(end_date[:4]))
+        try:
+            return [dict(row) for row in conn.execute(query + ' ORDER BY year', params)]
+        except sqlite3.OperationalError:
+            # Banco ainda sem a tabela de partições (init_db não rodou)
+            return []
+
+    def connect(self, start_date=None, end_date=None):
+        conn = self.get_connection()
+        partitions = self.partitions_for_range(conn, start_date, end_date)
+        if not partitions:
+            return conn
+
+        self._attach_archive(conn)
+        parquet = [p for p in partitions if p['storage'] == 'parquet']
+        if parquet:
+            self._cache_parquet(conn, parquet)
+
+        columns = ', '.join(self.table_columns(conn))
+        sources = ['main.transactions', 'archive.transactions'] + (['archive.parquet_cache'] if parquet else [])
+        conn.execute(f"CREATE TEMP VIEW transactions AS {' UNION ALL '.join(f'SELECT {columns} FROM {source}' for source in sources)}")
+        return conn
+
+    def _attach_archive(self, conn):
+        os.makedirs(self.folder, exist_ok=True)
+        conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        if not conn.execute("SELECT 1 FROM archive.sqlite_master WHERE name = 'cached_years'").fetchone():
+            self._ensure_archive_schema(conn)
+
+    def _ensure_archive_schema(self, conn):
+        """Creates the archive tables, or adds the columns the main table gained since"""
+        create_sql = conn.execute(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = 'transactions'"
+        ).fetchone()[0]
+        info = conn.execute('PRAGMA main.table_info(transactions)').fetchall()
+        for table in self.ARCHIVE_TABLES:
+            conn.execute(create_sql.replace('CREATE TABLE transactions', f'CREATE TABLE IF NOT EXISTS archive.{table}', 1))
+            available = set(self.table_columns(conn, 'archive', table))
+            for row in info:
+                if row[1] not in available:
+                    conn.execute(f'ALTER TABLE archive.{table} ADD COLUMN {row[1]} {row[2]}')
+            for name, columns in self.ARCHIVE_INDEXES.items():
+                conn.execute(f'CREATE INDEX IF NOT EXISTS archive.idx_{table}_{name} ON {table}{columns}')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.cached_years (
+                year INTEGER PRIMARY KEY,
+                cached_at TIMESTAMP NOT NULL
+            )
+        ''')
+
+    @staticmethod
+    def _legacy_defaults(conn):
+        # Anos arquivados antes das contas pertencem à primeira conta, como as linhas
+        # antigas da tabela principal (AccountHandler.adopt_orphans)
+        row = conn.execute('SELECT id, tenant_id FROM main.accounts ORDER BY id LIMIT 1').fetchone()
+        return {'account_id': row[0], 'tenant_id': row[1]} if row else {}
+
+    def _cache_parquet(self, conn, partitions):
+        """Copies the Parquet years not yet in archive.parquet_cache into it (once per year)"""
+        cached = {row[0] for row in conn.execute('SELECT year FROM archive.cached_years')}
+        missing = [p for p in partitions if p['year'] not in cached]
+        if not missing:
+            return
+        with self.lock:
+            defaults = self._legacy_defaults(conn)
+            for partition in missing:
+                try:
+                    # A chave de cached_years impede que dois processos copiem o mesmo ano
+                    conn.execute('INSERT INTO archive.cached_years (year, cached_at) VALUES (?, ?)',
+                                 (partition['year'], datetime.now()))
+                except sqlite3.IntegrityError:
+                    conn.rollback()
+                    continue
+                self._load_parquet(conn, partition['path'], 'archive.parquet_cache', defaults)
+                conn.commit()
+
+    def _load_parquet(self, conn, path, table, defaults):
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(path)
+        names = parquet.schema_arrow.names
+        columns = self.table_columns(conn, *table.split('.'))
+        placeholders = ', '.join('?' for _ in columns)
+        for batch in parquet.iter_batches(batch_size=50000):
+            data = {name: column.to_pylist() for name, column in zip(names, batch.columns)}
+            self._fill_documents(data, batch.num_rows)
+            # Colunas criadas depois do arquivamento: padrão legado ou NULL
+            rows = zip(*[
+                [defaults.get(col) if v is None else v for v in data[col]] if col in data
+                else [defaults.get(col)] * batch.num_rows
+                for col in columns
+            ])
+            conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+    @staticmethod
+    def _fill_documents(data, num_rows):
+        # Anos arquivados antes da extração de documentos: extraídos ao copiar, como em backfill_documents
+        import pandas as pd
+
+        documents = data.get('document') or [None] * num_rows
+        missing = [i for i, document in enumerate(documents) if document is None]
+        if not missing or 'description' not in data:
+            return
+        found = extract_documents(pd.Series([data['description'][i] for i in missing], dtype=object))['document']
+        for i, document in zip(missing, found.tolist()):
+            documents[i] = document
+        data['document'] = documents
+
+    def _uncache_parquet(self, conn, year):
+        start, end = self.year_bounds(year)
+        conn.execute('DELETE FROM archive.parquet_cache WHERE date >= ? AND date < ?', (start, end))
+        conn.execute('DELETE FROM archive.cached_years WHERE year = ?', (year,))
+
+    def uncache_year(self, year=None):
+        """Drops the parquet_cache copy of ``year`` (every cached year when None). Returns the years dropped."""
+        if not os.path.exists(self.archive_path):
+            return []
+        conn = self.get_connection()
+        try:
+            self._attach_archive(conn)
+            cached = [row[0] for row in conn.execute('SELECT year FROM archive.cached_years ORDER BY year')]
+            years = [y for y in cached if year is None or y == year]
+            with self.lock:
+                for cached_year in years:
+                    self._uncache_parquet(conn, cached_year)
+                conn.commit()
+            return years
+        finally:
+            conn.close()
+
+    def prepare(self):
+        """Brings the archive up to date with the main schema; run by init_db.
+
+        Years archived by earlier versions into one SQLite file per year are
+        moved into the shared archive once, and the archive tables get the
+        columns added to the main table since they were created.
+        """
+        conn = self.get_connection()
+        try:
+            legacy = [p for p in self.partitions_for_range(conn)
+                      if p['storage'] == 'sqlite' and p['path'] != self.archive_path]
+            if not legacy and not os.path.exists(self.archive_path):
+                return 0
+            self._attach_archive(conn)
+            self._ensure_archive_schema(conn)
+            defaults = self._legacy_defaults(conn)
+            moved = 0
+            for partition in legacy:
+                conn.execute('ATTACH DATABASE ? AS legacy', (partition['path'],))
+                available = set(self.table_columns(conn, 'legacy'))
+                columns = self.table_columns(conn, 'archive')
+                select = [
+                    (f'COALESCE({col}, ?)' if col in available else '?') if col in defaults
+                    else (col if col in available else 'NULL')
+                    for col in columns
+                ]
+                params = [defaults[col] for col in columns if col in defaults]
+                moved += conn.execute(f'''
+                    INSERT INTO archive.transactions ({', '.join(columns)})
+                    SELECT {', '.join(select)} FROM legacy.transactions
+                ''', params).rowcount
+                conn.execute('UPDATE partitions SET path = ? WHERE year = ?', (self.archive_path, partition['year']))
+                conn.commit()
+                conn.execute('DETACH DATABASE legacy')
+                os.remove(partition['path'])
+            return moved
+        finally:
+            conn.close()
+
+    def archive_year(self, year, storage='sqlite'):
+        """Move every row of ``year`` out of the hot table. Returns the number of rows moved."""
+        if storage not in self.STORAGES:
+            raise ValueError(f'Storage inválido: {storage}')
+        if year >= datetime.now().year:
+            raise ValueError('Não é possível arquivar o ano corrente')
+
+        start, end = self.year_bounds(year)
+        conn = self.get_connection()
+        try:
+            existing = conn.execute('SELECT storage FROM partitions WHERE year = ?', (year,)).fetchone()
+            if existing and existing['storage'] != storage:
+                raise ValueError(f"Ano {year} já arquivado como {existing['storage']}")
+
+            self._attach_archive(conn)
+            if storage == 'sqlite':
+                path = self.archive_path
+                columns = ', '.join(self.table_columns(conn))
+                moved = conn.execute(f'''
+                    INSERT INTO archive.transactions ({columns})
+                    SELECT {columns} FROM main.transactions WHERE date >= ? AND date < ?
+                ''', (start, end)).rowcount
+            else:
+                path = os.path.join(self.folder, f'transactions_{year}.parquet')
+                moved = self._write_parquet(conn, path, start, end)
+                # O arquivo mudou: a cópia em cache é refeita na próxima leitura
+                self._uncache_parquet(conn, year)
+
+            conn.execute('''
+                INSERT INTO partitions (year, storage, path, row_count, archived_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(year) DO UPDATE SET
+                    row_count = row_count + excluded.row_count,
+                    archived_at = excluded.archived_at
+            ''', (year, storage, path, moved, datetime.now()))
+            conn.execute('DELETE FROM main.transactions WHERE date >= ? AND date < ?', (start, end))
+            # Cópia, registro da partição e remoção da tabela principal no mesmo commit
+            conn.commit()
+            return moved
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _write_parquet(self, conn, path, start, end, chunk_size=50000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {'INTEGER': pa.int64(), 'REAL': pa.float64()}
+        info = list(conn.execute('PRAGMA main.table_info(transactions)'))
+        schema = pa.schema([(row[1], types.get(row[2].upper(), pa.string())) for row in info])
+
+        cursor = conn.execute(
+            f"SELECT {', '.join(schema.names)} FROM main.transactions WHERE date >= ? AND date < ? ORDER BY date",
+            (start, end)
+        )
+        moved = 0
+        tmp_path = path + '.tmp'
+        with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+            # Anexa ao arquivo existente se o ano já tinha sido arquivado
+            if os.path.exists(path):
+                for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+                    old = pa.Table.from_batches([batch])
+                    writer.write_table(pa.Table.from_arrays([
+                        old.column(field.name).cast(field.type) if field.name in old.column_names
+                        else pa.nulls(len(old), field.type)
+                        for field in schema
+                    ], schema=schema))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                writer.write_table(pa.Table.from_arrays([
+                    pa.array([None if v is None else str(v) for v in col] if field.type == pa.string() else col,
+                             type=field.type)
+                    for col, field in zip(columns, schema)
+                ], schema=schema))
+                moved += len(rows)
+        os.replace(tmp_path, path)
+        return moved
+
+    def restore_year(self, year):
+        """Move an archived year back into the hot table"""
+        start, end = self.year_bounds(year)
+        conn = self.get_connection()
+        try:
+            partition = conn.execute('SELECT year, storage, path FROM partitions WHERE year = ?', (year,)).fetchone()
+            if not partition:
+                raise ValueError(f'Ano {year} não está arquivado')
+
+            self._attach_archive(conn)
+            if partition['storage'] == 'sqlite':
+                source = 'archive.transactions'
+            else:
+                self._cache_parquet(conn, [dict(partition)])
+                source = 'archive.parquet_cache'
+
+            columns = ', '.join(self.table_columns(conn))
+            conn.execute(f'''
+                INSERT INTO main.transactions ({columns})
+                SELECT {columns} FROM {source} WHERE date >= ? AND date < ?
+            ''', (start, end))
+            if partition['storage'] == 'sqlite':
+                conn.execute('DELETE FROM archive.transactions WHERE date >= ? AND date < ?', (start, end))
+            else:
+                self._uncache_parquet(conn, year)
+            conn.execute('DELETE FROM partitions WHERE year = ?', (year,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if partition['storage'] == 'parquet':
+            os.remove(partition['path'])
+
+
+def main():
+    from app import get_db_connection, init_db
+
+    parser = argparse.ArgumentParser(description='Arquivamento de transações por ano')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    archive = subparsers.add_parser('archive', help='Arquiva um ano fora da tabela principal')
+    archive.add_argument('year', type=int)
+    archive.add_argument('--storage', choices=PartitionHandler.STORAGES, default='sqlite')
+    restore = subparsers.add_parser('restore', help='Traz um ano arquivado de volta')
+    restore.add_argument('year', type=int)
+    uncache = subparsers.add_parser('uncache', help='Libera a cópia em cache dos anos em Parquet')
+    uncache.add_argument('year', type=int, nargs='?')
+    subparsers.add_parser('list', help='Lista os anos arquivados')
+    args = parser.parse_args()
+
+    init_db()
+    handler = PartitionHandler(get_db_connection)
+    if args.command == 'archive':
+        moved = handler.archive_year(args.year, args.storage)
+        print(f'{moved} transações de {args.year} arquivadas ({args.storage})')
+    elif args.command == 'restore':
+        handler.restore_year(args.year)
+        print(f'Ano {args.year} restaurado')
+    elif args.command == 'uncache':
+        years = handler.uncache_year(args.year)
+        print(f"Cache liberado: {', '.join(map(str, years)) or 'nenhum ano'}")
+    else:
+        for partition in handler.list_partitions():
+            print(f"{partition['year']}: {partition['row_count']} linhas ({partition['storage']}) {partition['path']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,9 @@ import os
 import time
 from functools import wraps
 from datetime import datetime
+from document_extractor import extract_documents, extract_document
+from classifier import classify
+from transaction_batch import TransactionBatchBuilder
 
 MAX_RETRIES = 3
 RETRY_DELAY = 5  # seconds
@@ -30,7 +33,7 @@ def find_matching_column(df, possible_names):
             return matches[0]
     return None
 
-def extract_transaction_info(historico, valor):
+def extract_transaction_info(historico, valor, document=None):
     """Extract detailed transaction information from the historic text"""
     historico = historico.upper()
     info = {
@@ -41,67 +44,18 @@ def extract_transaction_info(historico, valor):
         'description': historico  # Mantém a descrição original por padrão
     }
     
-    # Mapeamento de palavras-chave para tipos de transação
-    tipo_mapping = {
-        'PIX RECEBIDO': ['PIX RECEBIDO'],
-        'PIX ENVIADO': ['PIX ENVIADO'],
-        'TED RECEBIDA': ['TED RECEBIDA', 'TED CREDIT'],
-        'TED ENVIADA': ['TED ENVIADA', 'TED DEBIT'],
-        'PAGAMENTO': ['PAGAMENTO', 'PGTO', 'PAG'],
-        'TARIFA': ['TARIFA', 'TAR'],
-        'IOF': ['IOF'],
-        'RESGATE': ['RESGATE'],
-        'APLICACAO': ['APLICACAO', 'APLICAÇÃO'],
-        'COMPRA': ['COMPRA'],
-        'COMPENSACAO': ['COMPENSACAO', 'COMPENSAÇÃO'],
-        'CHEQUE DEVOLVIDO': ['CHEQUE DEVOLVIDO', 'CH DEVOLVIDO'],
-        'JUROS': ['JUROS'],
-        'MULTA': ['MULTA'],
-        'ANTECIPACAO': ['ANTECIPACAO', 'ANTECIPAÇÃO'],
-        'CHEQUE EMITIDO': ['CHEQUE EMITIDO', 'CH EMITIDO']
-    }
-    
-    # Procura por padrões específicos
-    for tipo, keywords in tipo_mapping.items():
-        if any(keyword in historico for keyword in keywords):
-            info['tipo'] = tipo
-            break
-    
-    # Se nenhum tipo específico foi encontrado
-    if info['tipo'] is None:
-        info['tipo'] = 'OUTROS'
+    info['tipo'] = classify(historico)
     
-    # Procura por CNPJ no histórico
+    # Procura por CNPJ no histórico (já validado pelos dígitos verificadores)
     if info['tipo'] in ['PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO']:
-        import re
-        
-        # Procura por CNPJ em formato texto (ex: "CNPJ 12345678901234")
-        cnpj_text_match = re.search(r'CNPJ[:\s]+(\d{12,14})', historico)
-        if cnpj_text_match:
-            cnpj = cnpj_text_match.group(1)
-            # Remove zeros à esquerda e garante que tenha 14 dígitos
-            cnpj = str(int(cnpj)).zfill(14)
-            info['document'] = cnpj
+        if document is None:
+            document = extract_document(historico)
+        if document and document['document_kind'] == 'CNPJ':
+            info['document'] = document['document']
             
             # Mantém a descrição original para processamento posterior
             if info['tipo'] == 'PAGAMENTO':
-                info['description'] = historico.replace(cnpj_text_match.group(0), f"CNPJ {str(int(cnpj))}")
-        else:
-            # Procura por sequência de 14 dígitos
-            cnpj_match = re.search(r'\b\d{14}\b', historico)
-            if cnpj_match:
-                cnpj = cnpj_match.group()
-                # Remove zeros à esquerda
-                cnpj = str(int(cnpj)).zfill(14)
-                info['document'] = cnpj
-            else:
-                # Procura por CNPJ formatado
-                cnpj_match = re.search(r'\b\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}\b', historico)
-                if cnpj_match:
-                    cnpj = ''.join(filter(str.isdigit, cnpj_match.group()))
-                    # Remove zeros à esquerda
-                    cnpj = str(int(cnpj)).zfill(14)
-                    info['document'] = cnpj
+                info['description'] = historico.replace(document['document_text'], f"CNPJ {document['document']}")
     
     # Tenta extrair identificador após o tipo de transação
     if info['tipo'] in ['PIX RECEBIDO', 'PIX ENVIADO', 'TED RECEBIDA', 'TED ENVIADA']:
@@ -136,7 +90,7 @@ def find_header_row(df):
 
 @retry_on_error()
 def process_excel_file(file):
-    """Process Excel file and extract transaction data"""
+    """Process Excel file and extract transaction data as a TransactionBatch"""
     try:
         df = pd.read_excel(file)
         
@@ -157,7 +111,11 @@ def process_excel_file(file):
         if not all([data_col, historico_col, valor_col]):
             raise Exception("Não foi possível encontrar todas as colunas necessárias")
         
-        transactions = []
+        # Extrai e valida CNPJs/CPFs da coluna inteira de uma vez
+        documents = extract_documents(df[historico_col].fillna('').astype(str).str.strip())
+        
+        # Colunas compactas em vez de uma lista de dicts (ver transaction_batch.py)
+        transactions = TransactionBatchBuilder()
         
         for _, row in df.iterrows():
             try:
@@ -210,26 +168,25 @@ def process_excel_file(file):
                     valor = float(valor_str.replace('.', '').replace(',', '.'))
                 
                 # Extract transaction info
-                info = extract_transaction_info(historico, valor)
+                info = extract_transaction_info(historico, valor, documents.loc[_].to_dict())
                 
-                transactions.append({
-                    'date': data,
-                    'description': info['description'],
-                    'value': valor,
-                    'type': info['tipo'],
-                    'document': info.get('document', ''),
-                    'identifier': info.get('identificador', ''),
-                    'transaction_type': 'receita' if valor > 0 else 'despesa'
-                })
+                transactions.append(
+                    data,
+                    info['description'],
+                    valor,
+                    info['tipo'],
+                    info.get('document', ''),
+                    info.get('identificador', '')
+                )
                 
             except Exception as e:
                 print(f"Erro ao processar linha: {e}")
                 continue
         
-        if not transactions:
+        if not len(transactions):
             raise Exception("Nenhuma transação válida encontrada no arquivo")
             
-        return transactions
+        return transactions.build()
         
     except Exception as e:
         raise Exception(f"Erro ao processar arquivo Excel: {str(e)}")
@@ -0,0 +1,205 @@
+import json
+import threading
+from datetime import datetime, timedelta
+
+from classifier import classify_batch, RULES_VERSION
+
+
+class ReclassifyHandler:
+    """Re-applies the classifier rules to rows already in the database.
+
+    Only the rows stamped with an older (or no) rule_version are read, in
+    chunks through the (account_id, rule_version) index. Each chunk is
+    classified with classify_batch, and every row in it is stamped with the
+    current RULES_VERSION: the rows whose transaction_type changed get the
+    new type as well, and the rest only get the new version. A stamped row
+    leaves the selection. A run therefore only touches rows that predate the
+    current rules, and a run that was interrupted resumes where it stopped.
+    Every chunk is committed on its own, so with the database in WAL mode
+    readers are never blocked for longer than one chunk write.
+
+    A run covers one account. With ``partition_handler.connect`` as the
+    connection factory the archive's ``transactions`` table is walked after
+    the hot one, so years archived as SQLite are reclassified too; Parquet
+    years are read-only and keep their types until restored.
+
+    The progress of a run lives in ``reclassify_runs`` and is written in
+    the same commit as each chunk, so any worker can answer the progress
+    polls. The result lists the (old and new) types of the changed rows,
+    for the caller to refresh the rollups that depend on them.
+    ``on_change(conn, account_id, descriptions, documents, transaction_types)``,
+    when given, is called for each chunk with the changed rows under their
+    old and new types, before the chunk's commit.
+    """
+
+    def __init__(self, get_connection, chunk_size=50000, stale_minutes=15, on_change=None):
+        self.get_connection = get_connection
+        self.on_change = on_change
+        self.chunk_size = chunk_size
+        self.stale_minutes = stale_minutes
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reclassify_runs (
+                process_id TEXT PRIMARY KEY,
+                account_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                current INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                message TEXT,
+                result TEXT,
+                created_at TIMESTAMP NOT NULL,
+                updated_at TIMESTAMP NOT NULL
+            )
+        ''')
+
+    @property
+    def running(self):
+        return self.lock.locked()
+
+    @staticmethod
+    def _report(conn, process_id, **fields):
+        # Gravado na conexão da execução: vai no mesmo commit do lote
+        fields['updated_at'] = datetime.now()
+        conn.execute(f'''
+            UPDATE main.reclassify_runs SET {', '.join(f'{name} = ?' for name in fields)}
+            WHERE process_id = ?
+        ''', list(fields.values()) + [process_id])
+
+    def begin(self, account_id, process_id):
+        """Registers a run before its thread starts, so the first progress poll finds it"""
+        now = datetime.now()
+        conn = self.get_connection()
+        try:
+            conn.execute('''
+                INSERT INTO main.reclassify_runs (process_id, account_id, status, message, created_at, updated_at)
+                VALUES (?, ?, 'processing', 'Starting reclassification...', ?, ?)
+            ''', (process_id, account_id, now, now))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def progress(self, tenant_id, process_id):
+        """Status, current, total, message and result of one of the tenant's runs, or None"""
+        conn = self.get_connection()
+        try:
+            row = conn.execute('''
+                SELECT r.status, r.current, r.total, r.message, r.result, r.account_id
+                FROM main.reclassify_runs r
+                JOIN main.accounts a ON a.id = r.account_id
+                WHERE r.process_id = ? AND a.tenant_id = ?
+            ''', (process_id, tenant_id)).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        progress = dict(row)
+        progress['result'] = json.loads(progress['result']) if progress['result'] else None
+        return progress
+
+    def run(self, account_id, process_id):
+        """Returns {'scanned', 'changed', 'types'}; progress goes to the run's row"""
+        import pandas as pd
+
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError('Reclassificação já em andamento')
+
+        try:
+            conn = self.get_connection()
+            try:
+                # O arquivo só está anexado quando há anos arquivados
+                tables = ['main.transactions'] + [
+                    'archive.transactions' for row in conn.execute('PRAGMA database_list') if row[1] == 'archive'
+                ]
+                # Linhas de antes da coluna rule_version têm NULL
+                pending = 'account_id = ? AND (rule_version IS NULL OR rule_version < ?)'
+                total = sum(conn.execute(f'SELECT COUNT(*) FROM {table} WHERE {pending}',
+                                         (account_id, RULES_VERSION)).fetchone()[0] for table in tables)
+                self._report(conn, process_id, total=total, message='Reclassificando transações...')
+                conn.commit()
+
+                scanned = 0
+                changed = 0
+                types = set()
+                for table in tables:
+                    while True:
+                        # Cada lote sai da seleção ao ser carimbado: não há cursor de posição
+                        rows = conn.execute(f'''
+                            SELECT id, description, document, transaction_type
+                            FROM {table}
+                            WHERE {pending}
+                            LIMIT ?
+                        ''', (account_id, RULES_VERSION, self.chunk_size)).fetchall()
+                        if not rows:
+                            break
+
+                        chunk = pd.DataFrame([tuple(row) for row in rows],
+                                             columns=['id', 'description', 'document', 'transaction_type'])
+                        new_type = classify_batch(chunk['description'])
+                        is_changed = (new_type != chunk['transaction_type']).to_numpy()
+                        diff = chunk[is_changed]
+
+                        conn.executemany(
+                            f'UPDATE {table} SET transaction_type = ?, rule_version = ? WHERE id = ?',
+                            zip(new_type[diff.index], [RULES_VERSION] * len(diff), diff['id'].tolist())
+                        )
+                        # As demais só recebem a versão: o índice de transaction_type não é reescrito
+                        conn.executemany(
+                            f'UPDATE {table} SET rule_version = ? WHERE id = ?',
+                            ((RULES_VERSION, row_id) for row_id in chunk['id'][~is_changed].tolist())
+                        )
+                        if self.on_change and len(diff):
+                            self.on_change(conn, account_id, diff['description'].tolist() * 2,
+                                           diff['document'].tolist() * 2,
+                                           diff['transaction_type'].tolist() + new_type[diff.index].tolist())
+                        changed += len(diff)
+                        types.update(diff['transaction_type'].dropna())
+                        types.update(new_type[diff.index])
+
+                        scanned += len(chunk)
+                        self._report(conn, process_id, current=scanned,
+                                     message=f'{scanned} de {total} transações verificadas, {changed} alteradas')
+                        conn.commit()
+
+                conn.execute('''
+                    INSERT INTO app_metadata (key, value) VALUES ('rules_version', ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value
+                ''', (str(RULES_VERSION),))
+                result = {'scanned': scanned, 'changed': changed, 'types': sorted(types)}
+                self._report(conn, process_id, status='completed', result=json.dumps(result),
+                             message=f'Reclassificação concluída: {changed} transações alteradas')
+                conn.commit()
+            finally:
+                conn.close()
+            return result
+        except Exception as e:
+            self.finish(process_id, 'error', str(e))
+            raise
+        finally:
+            self.lock.release()
+
+    def finish(self, process_id, status, message):
+        conn = self.get_connection()
+        try:
+            self._report(conn, process_id, status=status, message=message)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def prune(self, days=30):
+        """Marks runs whose worker died as errors and deletes finished runs older than ``days``"""
+        now = datetime.now()
+        conn = self.get_connection()
+        try:
+            interrupted = conn.execute('''
+                UPDATE main.reclassify_runs SET status = 'error', message = 'Reclassificação interrompida'
+                WHERE status = 'processing' AND updated_at < ?
+            ''', (now - timedelta(minutes=self.stale_minutes),)).rowcount
+            deleted = conn.execute("DELETE FROM main.reclassify_runs WHERE status != 'processing' AND updated_at < ?",
+                                   (now - timedelta(days=days),)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        return {'interrupted': interrupted, 'deleted': deleted}
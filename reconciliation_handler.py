@@ -0,0 +1,339 @@
+from datetime import datetime
+
+OUTGOING_TYPES = ('PIX ENVIADO', 'TED ENVIADA')
+INCOMING_TYPES = ('PIX RECEBIDO', 'TED RECEBIDA')
+
+
+class ReconciliationHandler:
+    """Matches outgoing transfers and expected payments against transactions.
+
+    Two kinds of match are produced and stored in ``reconciliations``:
+
+    - ``transfer``: an outgoing PIX/TED (source) against an incoming PIX/TED
+      (target) with the same absolute value;
+    - ``expected``: a row of ``expected_payments`` (source) against a
+      transaction (target) with the same signed value.
+
+    Candidates are keyed by (document, value in cents) and joined with
+    pandas.merge_asof over the sorted dates (a sort-merge join, nearest date
+    within ``tolerance_days``). Matching runs over all accounts of a tenant,
+    so a transfer between two of its accounts is reconciled; expected
+    payments belong to an account and the review lists one account's items.
+    A first pass requires the same counterparty
+    document; a second pass matches by value alone when at least one side
+    has no document (a source with a document only looks at targets
+    without one, so its nearest valid target is the one merge_asof finds).
+    Each side is used at most once: when several sources pick the same
+    target, the closest date wins and the others retry against the
+    remaining targets.
+
+    Each match records the account of its source (``account_id``) and of
+    its target (``target_account_id``); the review lists the matches of an
+    account through their indexes.
+    """
+
+    # Limita as rodadas de desempate quando muitos itens disputam os mesmos alvos
+    MAX_ROUNDS = 20
+
+    def __init__(self, get_connection, tolerance_days=3):
+        self.get_connection = get_connection
+        self.tolerance_days = tolerance_days
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS expected_payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                account_id INTEGER,
+                due_date DATE NOT NULL,
+                value REAL NOT NULL,
+                document TEXT,
+                description TEXT,
+                created_at TIMESTAMP NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reconciliations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                source_id INTEGER NOT NULL,
+                target_id INTEGER NOT NULL,
+                value_cents INTEGER NOT NULL,
+                day_diff INTEGER NOT NULL,
+                matched_by TEXT NOT NULL,
+                account_id INTEGER,
+                target_account_id INTEGER,
+                created_at TIMESTAMP NOT NULL
+            )
+        ''')
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(expected_payments)')]
+        if 'account_id' not in columns:
+            # Pagamentos previstos anteriores às contas ficam com a primeira conta
+            cursor.execute('ALTER TABLE expected_payments ADD COLUMN account_id INTEGER')
+            cursor.execute('UPDATE expected_payments SET account_id = (SELECT MIN(id) FROM accounts)')
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(reconciliations)')]
+        if 'account_id' not in columns:
+            # Conciliações anteriores: contas lidas da origem (transação ou pagamento previsto) e do alvo
+            cursor.execute('ALTER TABLE reconciliations ADD COLUMN account_id INTEGER')
+            cursor.execute('ALTER TABLE reconciliations ADD COLUMN target_account_id INTEGER')
+            cursor.execute('''
+                UPDATE reconciliations SET
+                    account_id = CASE kind
+                        WHEN 'transfer' THEN (SELECT account_id FROM transactions WHERE id = reconciliations.source_id)
+                        ELSE (SELECT account_id FROM expected_payments WHERE id = reconciliations.source_id)
+                    END,
+                    target_account_id = (SELECT account_id FROM transactions WHERE id = reconciliations.target_id)
+            ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reconciliations_account ON reconciliations(account_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reconciliations_target_account ON reconciliations(target_account_id)')
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_reconciliations_source ON reconciliations(kind, source_id)')
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_reconciliations_target ON reconciliations(kind, target_id)')
+        cursor.execute('DROP INDEX IF EXISTS idx_expected_payments_due_date')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_expected_payments_account_due_date ON expected_payments(account_id, due_date)')
+        # Pendências da conta por tipo e data (review); a carga do tenant usa idx_transactions_tenant_date.
+        # Com value no fim o índice também cobre os totais por tipo de /transactions_summary
+        cursor.execute('DROP INDEX IF EXISTS idx_transactions_transaction_type_date')
+        cursor.execute('DROP INDEX IF EXISTS idx_transactions_account_transaction_type_date')
+        created = not cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_transactions_account_transaction_type_date_value'"
+        ).fetchone()
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_transactions_account_transaction_type_date_value
+            ON transactions(account_id, transaction_type, date, value)
+        ''')
+        # Como em init_db: num banco já analisado, o índice novo precisa de estatísticas
+        if created and cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+            cursor.execute('ANALYZE idx_transactions_account_transaction_type_date_value')
+
+    def add_expected_payment(self, account_id, due_date, value, document=None, description=None):
+        conn = self.get_connection()
+        try:
+            cursor = conn.execute('''
+                INSERT INTO expected_payments (account_id, due_date, value, document, description, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (account_id, due_date, value, document or None, description, datetime.now()))
+            conn.commit()
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def unmatch(self, tenant_id, reconciliation_id):
+        conn = self.get_connection()
+        try:
+            conn.execute('''
+                DELETE FROM reconciliations
+                WHERE id = ? AND EXISTS (
+                    SELECT 1 FROM main.transactions t WHERE t.id = reconciliations.target_id AND t.tenant_id = ?
+                )
+            ''', (reconciliation_id, tenant_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _load(self, conn, query, params, columns):
+        import pandas as pd
+
+        cursor = conn.cursor()
+        cursor.row_factory = None  # tuplas simples: bem mais rápido que sqlite3.Row
+        frame = pd.DataFrame.from_records(cursor.execute(query, params).fetchall(), columns=columns)
+        frame['date'] = pd.to_datetime(frame['date'])
+        frame['cents'] = (frame['value'].astype(float) * 100).round().astype('int64')
+        frame['document'] = frame['document'].fillna('').astype(str)
+        return frame.drop(columns='value')
+
+    def _reconciled_ids(self, conn, kind, column):
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        return [row[0] for row in cursor.execute(f'SELECT {column} FROM reconciliations WHERE kind = ?', (kind,))]
+
+    def _date_filter(self, column, start_date, end_date, params):
+        sql = ''
+        if start_date:
+            sql += f' AND {column} >= ?'
+            params.append(start_date)
+        if end_date:
+            sql += f' AND {column} <= ?'
+            params.append(end_date)
+        return sql
+
+    def _nearest(self, left, right, by):
+        import pandas as pd
+
+        if left.empty or right.empty:
+            return None
+        return pd.merge_asof(
+            left.sort_values('date'),
+            right.sort_values('date'),
+            on='date', by=by, tolerance=pd.Timedelta(days=self.tolerance_days),
+            direction='nearest', suffixes=('', '_target')
+        ).dropna(subset=['id_target'])
+
+    def match(self, left, right):
+        """Vectorized one-to-one matching of two candidate frames (id, date, cents, document, account_id)"""
+        import pandas as pd
+
+        right = right.assign(target_date=right['date'])
+        found = []
+        for matched_by in ('document', 'value'):
+            pool_left, pool_right = left, right
+            if matched_by == 'document':
+                pool_left = pool_left[pool_left['document'] != '']
+                pool_right = pool_right[pool_right['document'] != '']
+
+            for _ in range(self.MAX_ROUNDS):
+                if pool_left.empty or pool_right.empty:
+                    break
+                if matched_by == 'document':
+                    candidates = [self._nearest(pool_left, pool_right, ['document', 'cents'])]
+                else:
+                    # Ao menos um lado sem documento: a origem com documento só procura entre os
+                    # alvos sem documento, e o mais próximo encontrado nunca é um documento diferente
+                    has_document = pool_left['document'] != ''
+                    candidates = [
+                        self._nearest(pool_left[~has_document], pool_right, ['cents']),
+                        self._nearest(pool_left[has_document], pool_right[pool_right['document'] == ''], ['cents']),
+                    ]
+                candidates = [pairs for pairs in candidates if pairs is not None and not pairs.empty]
+                if not candidates:
+                    break
+                pairs = pd.concat(candidates, ignore_index=True)
+
+                pairs['day_diff'] = (pairs['target_date'] - pairs['date']).dt.days.abs()
+                pairs = pairs.sort_values(['day_diff', 'id']).drop_duplicates('id_target')
+                pairs = pairs.assign(matched_by=matched_by)
+                found.append(pairs[['id', 'id_target', 'cents', 'day_diff', 'matched_by', 'account_id', 'account_id_target']])
+
+                # Quem perdeu a disputa por um alvo tenta de novo com os alvos restantes
+                pool_left = pool_left[~pool_left['id'].isin(pairs['id'])]
+                pool_right = pool_right[~pool_right['id'].isin(pairs['id_target'])]
+                left = left[~left['id'].isin(pairs['id'])]
+                right = right[~right['id'].isin(pairs['id_target'])]
+
+        columns = ['source_id', 'target_id', 'value_cents', 'day_diff', 'matched_by', 'account_id', 'target_account_id']
+        if not found:
+            return pd.DataFrame(columns=columns)
+        result = pd.concat(found, ignore_index=True)
+        result.columns = columns
+        # merge_asof devolve as colunas do alvo como float (NaN antes do dropna)
+        result['target_id'] = result['target_id'].astype('int64')
+        result['target_account_id'] = result['target_account_id'].astype('int64')
+        return result
+
+    def _save(self, conn, kind, matches):
+        created_at = datetime.now().isoformat(' ')
+        conn.executemany('''
+            INSERT OR IGNORE INTO reconciliations
+                (kind, source_id, target_id, value_cents, day_diff, matched_by, account_id, target_account_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', zip(
+            [kind] * len(matches),
+            matches['source_id'].tolist(),
+            matches['target_id'].tolist(),
+            matches['value_cents'].tolist(),
+            matches['day_diff'].tolist(),
+            matches['matched_by'].tolist(),
+            matches['account_id'].tolist(),
+            matches['target_account_id'].tolist(),
+            [created_at] * len(matches)
+        ))
+
+    def run(self, tenant_id, start_date=None, end_date=None):
+        """Reconciles everything of the tenant still unmatched in the period; returns match counts"""
+        import pandas as pd
+
+        conn = self.get_connection()
+        try:
+            # Uma única leitura da tabela; os filtros por tipo e os itens já
+            # conciliados são aplicados em memória (mais rápido que anti-joins por linha)
+            params = [tenant_id]
+            transactions = self._load(conn, '''
+                SELECT id, date, value, document, transaction_type, account_id
+                FROM main.transactions
+                WHERE tenant_id = ?
+            ''' + self._date_filter('date', start_date, end_date, params), params,
+                ['id', 'date', 'value', 'document', 'transaction_type', 'account_id'])
+
+            outgoing = transactions[
+                transactions['transaction_type'].isin(OUTGOING_TYPES)
+                & ~transactions['id'].isin(self._reconciled_ids(conn, 'transfer', 'source_id'))
+            ].drop(columns='transaction_type')
+            # Débitos entram com o valor invertido para casar com o crédito de mesmo valor
+            outgoing = outgoing.assign(cents=-outgoing['cents'])
+            incoming = transactions[
+                transactions['transaction_type'].isin(INCOMING_TYPES)
+                & ~transactions['id'].isin(self._reconciled_ids(conn, 'transfer', 'target_id'))
+            ].drop(columns='transaction_type')
+            transfers = self.match(outgoing, incoming)
+            self._save(conn, 'transfer', transfers)
+
+            params = [tenant_id]
+            expected = self._load(conn, '''
+                SELECT e.id, e.due_date, e.value, e.document, e.account_id
+                FROM expected_payments e
+                WHERE e.account_id IN (SELECT id FROM accounts WHERE tenant_id = ?)
+                AND NOT EXISTS (SELECT 1 FROM reconciliations r WHERE r.kind = 'expected' AND r.source_id = e.id)
+            ''' + self._date_filter('e.due_date', start_date, end_date, params), params,
+                ['id', 'date', 'value', 'document', 'account_id'])
+            candidates = transactions.iloc[0:0].drop(columns='transaction_type')
+            if not expected.empty:
+                # Só transações dentro da janela dos pagamentos previstos
+                tolerance = pd.Timedelta(days=self.tolerance_days)
+                window = transactions['date'].between(expected['date'].min() - tolerance,
+                                                      expected['date'].max() + tolerance)
+                candidates = transactions[
+                    window & ~transactions['id'].isin(self._reconciled_ids(conn, 'expected', 'target_id'))
+                ].drop(columns='transaction_type')
+            payments = self.match(expected, candidates)
+            self._save(conn, 'expected', payments)
+
+            conn.commit()
+            return {
+                'transfers': len(transfers),
+                'expected': len(payments),
+                'unmatched_outgoing': len(outgoing) - len(transfers),
+                'unmatched_expected': len(expected) - len(payments)
+            }
+        finally:
+            conn.close()
+
+    def review(self, account_id, limit=200):
+        """Unmatched items and recent matches of an account for the review page"""
+        conn = self.get_connection()
+        try:
+            placeholders = ', '.join('?' for _ in OUTGOING_TYPES)
+            unmatched_outgoing = conn.execute(f'''
+                SELECT id, date, description, value, document
+                FROM main.transactions t
+                WHERE account_id = ? AND transaction_type IN ({placeholders})
+                AND NOT EXISTS (SELECT 1 FROM reconciliations r WHERE r.kind = 'transfer' AND r.source_id = t.id)
+                ORDER BY date DESC
+                LIMIT ?
+            ''', (account_id,) + OUTGOING_TYPES + (limit,)).fetchall()
+            unmatched_expected = conn.execute('''
+                SELECT id, due_date, description, value, document
+                FROM expected_payments e
+                WHERE account_id = ?
+                AND NOT EXISTS (SELECT 1 FROM reconciliations r WHERE r.kind = 'expected' AND r.source_id = e.id)
+                ORDER BY due_date DESC
+                LIMIT ?
+            ''', (account_id, limit)).fetchall()
+            matches = conn.execute('''
+                SELECT r.id, r.kind, r.value_cents, r.day_diff, r.matched_by,
+                       COALESCE(s.description, e.description) AS source_description,
+                       COALESCE(s.date, e.due_date) AS source_date,
+                       t.description AS target_description, t.date AS target_date
+                FROM reconciliations r
+                LEFT JOIN main.transactions s ON r.kind = 'transfer' AND s.id = r.source_id
+                LEFT JOIN expected_payments e ON r.kind = 'expected' AND e.id = r.source_id
+                LEFT JOIN main.transactions t ON t.id = r.target_id
+                WHERE r.account_id = ? OR r.target_account_id = ?
+                ORDER BY r.id DESC
+                LIMIT ?
+            ''', (account_id, account_id, limit)).fetchall()
+            return {
+                'unmatched_outgoing': unmatched_outgoing,
+                'unmatched_expected': unmatched_expected,
+                'matches': matches
+            }
+        finally:
+            conn.close()
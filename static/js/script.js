@@ -1,29 +1,22 @@
 document.addEventListener('DOMContentLoaded', function() {
-    const transactionForm = document.getElementById('transactionForm');
-    const transactionsTable = document.getElementById('transactionsTable');
-    
-    // Load initial data
-    loadTransactions();
-    updateSummary();
-
     // Sidebar toggle
     const sidebarCollapse = document.getElementById('sidebarCollapse');
     const sidebar = document.getElementById('sidebar');
-    
-    if (sidebarCollapse) {
+
+    if (sidebarCollapse && sidebar) {
         sidebarCollapse.addEventListener('click', function() {
             sidebar.classList.toggle('active');
         });
-    }
 
-    // Close sidebar on mobile when clicking outside
-    document.addEventListener('click', function(e) {
-        if (window.innerWidth <= 768) {
-            if (!sidebar.contains(e.target) && !sidebarCollapse.contains(e.target)) {
-                sidebar.classList.add('active');
+        // Close sidebar on mobile when clicking outside
+        document.addEventListener('click', function(e) {
+            if (window.innerWidth <= 768) {
+                if (!sidebar.contains(e.target) && !sidebarCollapse.contains(e.target)) {
+                    sidebar.classList.add('active');
+                }
             }
-        }
-    });
+        });
+    }
 
     // Format currency inputs
     const currencyInputs = document.querySelectorAll('input[type="number"][step="0.01"]');
@@ -36,95 +29,196 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
-    // Format dates to Brazilian format
-    const formatDate = (dateString) => {
-        const date = new Date(dateString);
-        return date.toLocaleDateString('pt-BR');
-    };
-
-    // Format currency to Brazilian format
-    const formatCurrency = (value) => {
-        return new Intl.NumberFormat('pt-BR', {
-            style: 'currency',
-            currency: 'BRL'
-        }).format(value);
-    };
-
-    transactionForm.addEventListener('submit', function(e) {
-        e.preventDefault();
-        
-        const transaction = {
-            type: document.getElementById('type').value,
-            description: document.getElementById('description').value,
-            value: parseFloat(document.getElementById('value').value),
-            date: document.getElementById('date').value
-        };
-
-        // Send transaction to the server
-        fetch('/api/transactions', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify(transaction)
-        })
-        .then(response => response.json())
-        .then(data => {
-            if (data.error) {
-                alert('Erro ao adicionar transação: ' + data.error);
-            } else {
-                loadTransactions();
-                updateSummary();
-                transactionForm.reset();
-            }
-        })
-        .catch(error => {
-            console.error('Error:', error);
-            alert('Erro ao adicionar transação');
+    // Tabelas virtualizadas: <div data-virtual-table data-url="..." data-columns="date,description,value">
+    document.querySelectorAll('[data-virtual-table]').forEach(container => {
+        new VirtualTable(container, {
+            url: container.dataset.url,
+            params: JSON.parse(container.dataset.params || '{}'),
+            columns: container.dataset.columns.split(','),
+            counter: document.getElementById(container.dataset.counter)
         });
     });
+});
 
-    function loadTransactions() {
-        fetch('/api/transactions')
-            .then(response => response.json())
-            .then(transactions => {
-                updateTransactionsTable(transactions);
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                alert('Erro ao carregar transações');
-            });
+// Format dates to Brazilian format (the API sends YYYY-MM-DD)
+const formatDate = (dateString) => {
+    const [year, month, day] = dateString.split('-');
+    return `${day}/${month}/${year}`;
+};
+
+// Format currency to Brazilian format
+const currencyFormat = new Intl.NumberFormat('pt-BR', {
+    style: 'currency',
+    currency: 'BRL'
+});
+const formatCurrency = (value) => currencyFormat.format(value);
+
+const escapeHtml = (text) => String(text).replace(/[&<>"']/g, c => ({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+}[c]));
+
+const TYPE_BADGES = {
+    'PIX RECEBIDO': 'bg-success',
+    'TED RECEBIDA': 'bg-info',
+    'PIX ENVIADO': 'bg-danger',
+    'TED ENVIADA': 'bg-danger'
+};
+
+// Cabeçalho e renderização de cada coluna disponível em /api/transactions
+const VIRTUAL_COLUMNS = {
+    date: {title: 'Data', render: row => formatDate(row.date)},
+    description: {title: 'Descrição', render: row => escapeHtml(row.description)},
+    transaction_type: {
+        title: 'Tipo',
+        render: row => `<span class="badge ${TYPE_BADGES[row.transaction_type] || 'bg-warning'}">${escapeHtml(row.transaction_type || '')}</span>`
+    },
+    document: {title: 'Contraparte', render: row => escapeHtml(row.counterparty || row.document || '')},
+    value: {
+        title: 'Valor',
+        render: row => `<span class="${row.value > 0 ? 'text-success' : 'text-danger'}">${formatCurrency(row.value)}</span>`
     }
+};
 
-    function updateTransactionsTable(transactions) {
-        transactionsTable.innerHTML = '';
-        
-        // Sort transactions by date (most recent first)
-        transactions.sort((a, b) => new Date(b.date) - new Date(a.date));
-
-        transactions.forEach(transaction => {
-            const row = document.createElement('tr');
-            row.innerHTML = `
-                <td>${formatDate(transaction.date)}</td>
-                <td>${transaction.description}</td>
-                <td class="transaction-${transaction.type}">${transaction.type === 'receita' ? 'Receita' : 'Despesa'}</td>
-                <td class="transaction-${transaction.type}">${formatCurrency(transaction.value)}</td>
-            `;
-            transactionsTable.appendChild(row);
-        });
+/**
+ * Table that only renders the rows in view.
+ *
+ * Rows are fetched from the columnar API in pages of ``pageSize`` as they
+ * scroll into view and kept in a small cache. Pages are fetched by key: each
+ * page's ``next`` key (its last date and id) is kept after the page itself is
+ * evicted, and a page further down than the last known key first loads the
+ * pages before it. The scroll height comes from
+ * the total sent with the first page, and two spacer rows stand in for
+ * everything above and below the rendered slice. Rows have a fixed height
+ * (see .virtual-table in style.css) so the visible range is just
+ * scrollTop / rowHeight.
+ */
+class VirtualTable {
+    constructor(container, options) {
+        this.container = container;
+        this.url = options.url;
+        this.params = options.params || {};
+        this.columns = options.columns;
+        this.counter = options.counter;
+        this.rowHeight = options.rowHeight || 37;
+        this.pageSize = options.pageSize || 500;
+        this.overscan = options.overscan || 10;
+        this.maxPages = options.maxPages || 20;
+        this.total = 0;
+        this.pages = new Map();
+        this.pending = new Map();
+        this.cursors = new Map([[0, null]]);
+        this.frame = null;
+
+        container.classList.add('virtual-table');
+        container.innerHTML = `
+            <table class="table table-striped mb-0">
+                <thead><tr>${this.columns.map(c => `<th>${VIRTUAL_COLUMNS[c].title}</th>`).join('')}</tr></thead>
+                <tbody></tbody>
+            </table>`;
+        this.body = container.querySelector('tbody');
+        container.addEventListener('scroll', () => this.scheduleRender());
+
+        this.loadPage(0).then(() => this.render());
     }
 
-    function updateSummary() {
-        fetch('/api/summary')
+    loadPage(page) {
+        if (this.pages.has(page)) {
+            return Promise.resolve(this.pages.get(page));
+        }
+        if (this.pending.has(page)) {
+            return this.pending.get(page);
+        }
+        if (!this.cursors.has(page)) {
+            // A chave de início da página vem da anterior
+            return this.loadPage(page - 1).then(() => this.cursors.has(page) ? this.loadPage(page) : null);
+        }
+        const cursor = this.cursors.get(page);
+        const query = new URLSearchParams({...this.params, limit: this.pageSize});
+        if (cursor) {
+            query.set('after_date', cursor.date);
+            query.set('after_id', cursor.id);
+        }
+        const request = fetch(`${this.url}?${query}`)
             .then(response => response.json())
             .then(data => {
-                document.querySelector('.bg-success .card-text').textContent = `${formatCurrency(data.receitas)}`;
-                document.querySelector('.bg-danger .card-text').textContent = `${formatCurrency(data.despesas)}`;
-                document.querySelector('.bg-info .card-text').textContent = `${formatCurrency(data.saldo)}`;
+                if (data.total !== undefined) {
+                    this.total = data.total;
+                    if (this.counter) {
+                        this.counter.textContent = data.total.toLocaleString('pt-BR');
+                    }
+                }
+                if (data.next) {
+                    this.cursors.set(page + 1, data.next);
+                }
+                this.pages.set(page, data);
+                this.pending.delete(page);
+                // Descarta as páginas mais antigas para manter a memória limitada
+                if (this.pages.size > this.maxPages) {
+                    this.pages.delete(this.pages.keys().next().value);
+                }
+                return data;
             })
             .catch(error => {
+                this.pending.delete(page);
                 console.error('Error:', error);
-                alert('Erro ao atualizar resumo');
             });
+        this.pending.set(page, request);
+        return request;
     }
-});
+
+    row(index) {
+        const data = this.pages.get(Math.floor(index / this.pageSize));
+        if (!data) {
+            return null;
+        }
+        const i = index % this.pageSize;
+        const columns = data.columns;
+        const dictionaries = data.dictionaries;
+        const document = dictionaries.document[columns.document[i]];
+        return {
+            id: columns.id[i],
+            date: columns.date[i],
+            description: columns.description[i],
+            value: columns.value[i],
+            transaction_type: dictionaries.transaction_type[columns.transaction_type[i]],
+            document: document,
+            counterparty: data.counterparties[document]
+        };
+    }
+
+    scheduleRender() {
+        if (this.frame === null) {
+            this.frame = requestAnimationFrame(() => {
+                this.frame = null;
+                this.render();
+            });
+        }
+    }
+
+    render() {
+        const height = this.container.clientHeight;
+        let first = Math.max(0, Math.floor(this.container.scrollTop / this.rowHeight) - this.overscan);
+        first -= first % 2;  // mantém a alternância de cores do table-striped ao rolar
+        const last = Math.min(this.total, Math.ceil((this.container.scrollTop + height) / this.rowHeight) + this.overscan);
+
+        const missing = new Set();
+        const html = [];
+        for (let index = first; index < last; index++) {
+            const row = this.row(index);
+            if (row) {
+                html.push(`<tr>${this.columns.map(c => `<td>${VIRTUAL_COLUMNS[c].render(row)}</td>`).join('')}</tr>`);
+            } else {
+                missing.add(Math.floor(index / this.pageSize));
+                html.push(`<tr>${this.columns.map(() => '<td>…</td>').join('')}</tr>`);
+            }
+        }
+
+        const colspan = this.columns.length;
+        this.body.innerHTML =
+            `<tr class="virtual-spacer" style="height: ${first * this.rowHeight}px"><td colspan="${colspan}"></td></tr>` +
+            html.join('') +
+            `<tr class="virtual-spacer" style="height: ${(this.total - last) * this.rowHeight}px"><td colspan="${colspan}"></td></tr>`;
+
+        missing.forEach(page => this.loadPage(page).then(() => this.scheduleRender()));
+    }
+}
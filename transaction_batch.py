@@ -0,0 +1,182 @@
+from array import array
+from datetime import date, datetime
+import numpy as np
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class StringTable:
+    """Interns strings into int codes; code -1 stands for None"""
+
+    __slots__ = ('strings', 'index')
+
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+
+    def intern(self, value):
+        if value is None:
+            return -1
+        code = self.index.get(value)
+        if code is None:
+            code = len(self.strings)
+            self.index[value] = code
+            self.strings.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class TransactionRecord:
+    """One transaction of a batch; also readable like the old dicts (record['date'])"""
+
+    __slots__ = ('date', 'description', 'value', 'type', 'document', 'identifier')
+    KEYS = __slots__ + ('transaction_type',)
+
+    def __init__(self, date, description, value, type, document, identifier):
+        self.date = date
+        self.description = description
+        self.value = value
+        self.type = type
+        self.document = document
+        self.identifier = identifier
+
+    @property
+    def transaction_type(self):
+        return 'receita' if self.value > 0 else 'despesa'
+
+    def keys(self):
+        return list(self.KEYS)
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.KEYS else default
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.KEYS}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class TransactionBatch:
+    """Struct-of-arrays storage for parsed transactions.
+
+    dates are datetime64[D], values float64, the transaction type is a
+    categorical code into ``types`` and description/document/identifier are
+    int32 codes into one shared, interned string table. A million rows take
+    ~25 bytes each plus the distinct strings, instead of a 7-key dict per row.
+    Iterating yields TransactionRecord objects for code that expects rows.
+    """
+
+    FIELDS = ['date', 'description', 'value', 'type', 'document', 'identifier']
+
+    def __init__(self, dates, values, type_codes, types, description_codes,
+                 document_codes, identifier_codes, strings):
+        self.dates = dates
+        self.values = values
+        self.type_codes = type_codes
+        self.types = types
+        self.description_codes = description_codes
+        self.document_codes = document_codes
+        self.identifier_codes = identifier_codes
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        arrays = [self.dates, self.values, self.type_codes, self.description_codes,
+                  self.document_codes, self.identifier_codes]
+        return sum(a.nbytes for a in arrays)
+
+    def _decode(self, codes):
+        strings = self.strings
+        return [strings[c] if c >= 0 else None for c in codes.tolist()]
+
+    def column(self, field, start=0, stop=None):
+        """A field as a plain Python list (dates as 'YYYY-MM-DD' strings)"""
+        window = slice(start, stop)
+        if field == 'date':
+            return np.datetime_as_string(self.dates[window], unit='D').tolist()
+        if field == 'value':
+            return self.values[window].tolist()
+        if field == 'type':
+            return [self.types[c] for c in self.type_codes[window].tolist()]
+        if field == 'transaction_type':
+            return np.where(self.values[window] > 0, 'receita', 'despesa').tolist()
+        return self._decode(getattr(self, f'{field}_codes')[window])
+
+    def iter_tuples(self, fields=None, chunk_size=10000):
+        """Yields one tuple per row with the requested fields, decoding chunk by chunk"""
+        fields = fields or self.FIELDS
+        for start in range(0, len(self), chunk_size):
+            stop = start + chunk_size
+            yield from zip(*[self.column(field, start, stop) for field in fields])
+
+    def __iter__(self):
+        for row in self.iter_tuples(self.FIELDS):
+            yield TransactionRecord(*row)
+
+    def to_frame(self):
+        import pandas as pd
+
+        return pd.DataFrame({
+            'date': self.dates,
+            'description': self.column('description'),
+            'value': self.values,
+            'type': pd.Categorical.from_codes(self.type_codes, self.types),
+            'document': self.column('document'),
+            'identifier': self.column('identifier')
+        })
+
+
+class TransactionBatchBuilder:
+    """Accumulates rows into compact typed arrays and builds a TransactionBatch"""
+
+    def __init__(self):
+        self.dates = array('i')
+        self.values = array('d')
+        self.type_codes = array('b')
+        self.description_codes = array('i')
+        self.document_codes = array('i')
+        self.identifier_codes = array('i')
+        self.types = {}
+        self.strings = StringTable()
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, date_value, description, value, type, document=None, identifier=None):
+        if isinstance(date_value, str):
+            date_value = date.fromisoformat(date_value)
+        elif isinstance(date_value, datetime):
+            date_value = date_value.date()
+        type_code = self.types.get(type)
+        if type_code is None:
+            type_code = self.types[type] = len(self.types)
+
+        self.dates.append(date_value.toordinal() - EPOCH_ORDINAL)
+        self.values.append(value)
+        self.type_codes.append(type_code)
+        self.description_codes.append(self.strings.intern(description))
+        self.document_codes.append(self.strings.intern(document or None))
+        self.identifier_codes.append(self.strings.intern(identifier or None))
+
+    def build(self):
+        return TransactionBatch(
+            dates=np.array(self.dates, dtype=np.int32).astype('datetime64[D]'),
+            values=np.array(self.values, dtype=np.float64),
+            type_codes=np.array(self.type_codes, dtype=np.int8),
+            types=list(self.types),
+            description_codes=np.array(self.description_codes, dtype=np.int32),
+            document_codes=np.array(self.document_codes, dtype=np.int32),
+            identifier_codes=np.array(self.identifier_codes, dtype=np.int32),
+            strings=self.strings.strings
+        )